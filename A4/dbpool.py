@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# dbpool.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from os import register_at_fork
+from threading import Lock
+from contextlib import contextmanager
+from sqlite3 import connect, Error
+
+# ----------------------------------------------------------------------
+
+# number of compiled statements each connection keeps around; sqlite3
+# reuses a prepared statement whenever the same SQL text is executed
+STATEMENT_CACHE_SIZE = 256
+
+# idle connections kept per database; extra ones are closed on release
+MAX_IDLE_CONNECTIONS = 8
+
+# PRAGMAs applied once to every pooled connection. The catalog is only
+# ever read, so we map it into memory, give it a generous page cache and
+# refuse writes outright.
+READ_ONLY_PRAGMAS = [
+    'PRAGMA query_only = ON',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -16384',
+    'PRAGMA temp_store = MEMORY'
+]
+
+_lock = Lock()
+
+# maps database url -> list of idle connections owned by this process
+_idle = {}
+
+# maps database url -> its generation, which retire() moves on, and
+# each connection of this process -> the generation it was opened in
+_generations = {}
+_opened_in = {}
+
+# connections inherited across a fork. SQLite must not touch these in
+# the child, so we hold on to them instead of letting them be closed.
+_orphans = []
+
+# ----------------------------------------------------------------------
+
+def _open(database_url):
+    connection = connect(database_url, isolation_level=None, uri=True,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE)
+    try:
+        for pragma in READ_ONLY_PRAGMAS:
+            connection.execute(pragma)
+    except Error:
+        connection.close()
+        raise
+    return connection
+
+# returns an idle connection to database_url, opening (and tuning) a
+# new one if there is none
+def acquire(database_url):
+    with _lock:
+        idle = _idle.get(database_url)
+        if idle:
+            return idle.pop()
+        generation = _generations.get(database_url, 0)
+    connection = _open(database_url)
+    with _lock:
+        _opened_in[connection] = generation
+    return connection
+
+# hands a connection back to the pool. Broken connections, ones opened
+# before database_url was last retired and ones beyond
+# MAX_IDLE_CONNECTIONS are closed instead.
+def release(database_url, connection, broken=False):
+    with _lock:
+        current = (_opened_in.get(connection)
+            == _generations.get(database_url, 0))
+        idle = _idle.setdefault(database_url, [])
+        if not broken and current and len(idle) < MAX_IDLE_CONNECTIONS:
+            idle.append(connection)
+            return
+        _opened_in.pop(connection, None)
+    connection.close()
+
+# with pooled_connection(url) as connection: ... borrows a connection
+# for the duration of the block. A connection that raised an sqlite3
+# error is not reused.
+@contextmanager
+def pooled_connection(database_url):
+    connection = acquire(database_url)
+    broken = False
+    try:
+        yield connection
+    except Error:
+        broken = True
+        raise
+    finally:
+        # also when a generator holding the connection is closed
+        release(database_url, connection, broken)
+
+# opens a connection to database_url ahead of the first request
+def warm(database_url):
+    try:
+        release(database_url, acquire(database_url))
+        return True
+    except Error:
+        return False
+
+# closes idle connections to database_url, or to every database
+def close_all(database_url=None):
+    with _lock:
+        if database_url is None:
+            closing = [conn for idle in _idle.values() for conn in idle]
+            _idle.clear()
+        else:
+            closing = _idle.pop(database_url, [])
+        for connection in closing:
+            _opened_in.pop(connection, None)
+    for connection in closing:
+        connection.close()
+
+# stops reusing the connections to database_url, e.g. once the file it
+# names has been replaced: the idle ones are closed now, and the ones
+# in use once they are handed back
+def retire(database_url):
+    with _lock:
+        _generations[database_url] = _generations.get(database_url,
+            0) + 1
+    close_all(database_url)
+
+# ----------------------------------------------------------------------
+# FORK HANDLING
+
+# runs in the child right after fork(): forget every connection
+# inherited from the parent so each process builds its own pool
+def drain_after_fork():
+    for idle in _idle.values():
+        _orphans.extend(idle)
+    _idle.clear()
+    _lock.release()
+
+# the lock is taken across fork(), so that the child never inherits it
+# held by a thread the child does not have
+register_at_fork(before=_lock.acquire, after_in_parent=_lock.release,
+    after_in_child=drain_after_fork)
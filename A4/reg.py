@@ -5,14 +5,30 @@
 # Author: Everett Shen, Trivan Menezes
 #-----------------------------------------------------------------------
 
-from flask import Flask, request, make_response, render_template
-from reghelpers import get_results_from_query as get_overview
+from uuid import uuid4
+from time import monotonic, perf_counter
+from flask import Flask, request, make_response, render_template, g
+from reghelpers import get_results_refined, get_page
+from reghelpers import enable_materialization
 from regdetails import get_table_results
+from reglog import log_request
 
 #-----------------------------------------------------------------------
 
 app = Flask(__name__, template_folder='.')
 
+# answer from the pre-joined catalog instead of joining per request;
+# importing the app writes nothing, the first search builds it
+enable_materialization(build_now=False)
+
+# names the browser's search session, see regrefine.py
+SESSION_COOKIE = 'regsession'
+
+# headers carrying the cursor of the next page of results, if any, and
+# the number of results in every page, if asked for
+CURSOR_HEADER = 'X-Next-Cursor'
+TOTAL_HEADER = 'X-Total-Count'
+
 #-----------------------------------------------------------------------
 
 HEADER = '''
@@ -39,6 +55,25 @@ PATTERN = '''
 
 #-----------------------------------------------------------------------
 
+# the searches and detail lookups are logged once answered, if the app
+# keeps a request log (see reglog.py), in the reg server's form: each
+# route sets g.query and g.result, and the seconds spent on them in
+# g.timings
+@app.before_request
+def start_timing():
+    g.arrived = monotonic()
+    g.timings = {}
+
+@app.after_request
+def log_answered(response):
+    if 'query' in g:
+        g.timings['bytes'] = response.calculate_content_length()
+        log_request(g.query, monotonic() - g.arrived, g.timings,
+            g.result, route=request.path, status=response.status_code)
+    return response
+
+#-----------------------------------------------------------------------
+
 # landing page
 @app.route('/', methods=['GET'])
 @app.route('/index', methods=['GET'])
@@ -47,7 +82,38 @@ def index():
     response = make_response(html)
     return response
 
-# search results route - return HTML fragment for class data from query
+# returns the table body for classes, or the error message if classes
+# is an error tuple
+def classes_html(classes, with_header):
+    if isinstance(classes, tuple):
+        return '<p>{}</p>'.format(classes[1])
+    html = '<tbody>'
+    if with_header:
+        html += HEADER
+    for entry in classes:
+        html += PATTERN.format(
+            entry[0],
+            entry[0],
+            entry[1],
+            entry[2],
+            entry[3],
+            entry[4])
+    html += '</tbody>'
+    return html
+
+# tells the cursor of the page after page and, if it was asked for, the
+# number of rows in the response's headers
+def add_page_headers(response, page):
+    if page['cursor'] is not None:
+        response.headers[CURSOR_HEADER] = page['cursor']
+    if page['total'] is not None:
+        response.headers[TOTAL_HEADER] = str(page['total'])
+
+# search results route - return HTML fragment for class data from query.
+# With a limit argument only one page of rows is returned: the first, or
+# the one after the cursor argument, without the header row. Its
+# response headers tell the cursor of the next page and, with a total
+# argument, how many rows there are.
 @app.route('/searchresults', methods=['GET'])
 def search_results():
     # convert arguments in URL to query for database
@@ -59,33 +125,40 @@ def search_results():
             query[abbreviations[i]] = request.args.get(value)
         else:
             query[abbreviations[i]] = ""
-    error_msg = ''
+    # each search narrows the previous one as the user types, so it
+    # can often filter that result instead of querying the database
+    session_id = request.cookies.get(SESSION_COOKIE)
+    new_session = not session_id
+    if new_session:
+        session_id = uuid4().hex
     # query database and handle data
-    classes = get_overview(query)
-    if isinstance(classes, tuple):
-        _, error_msg = classes
-
-    # construct HTML to return
-    html = ''
-    # handle error message
-    if error_msg != '':
-        html += '<p>{}</p>'.format(error_msg)
-    # return rows data about classes
+    cursor = request.args.get('cursor')
+    page = None
+    g.query = dict(query, session=session_id)
+    started = perf_counter()
+    if request.args.get('limit'):
+        g.query.update(limit=request.args.get('limit'), cursor=cursor,
+            total=bool(request.args.get('total')))
+        page = get_page(query, cursor, request.args.get('limit'),
+            bool(request.args.get('total')), session_id)
+        classes = page if isinstance(page, tuple) else page['rows']
     else:
-        html += '<tbody>'
-        html += HEADER
+        classes = get_results_refined(query, session_id)
+    g.timings['db'] = perf_counter() - started
+    g.result = page if page is not None else classes
 
-        for entry in classes:
-            html += PATTERN.format(
-                entry[0],
-                entry[0],
-                entry[1],
-                entry[2],
-                entry[3],
-                entry[4])
-        html += '</tbody>'
+    # construct HTML to return; later pages go under the first one's
+    # header
+    started = perf_counter()
+    html = classes_html(classes, page is None or not cursor)
+    g.timings['format'] = perf_counter() - started
 
     response = make_response(html)
+    if isinstance(page, dict):
+        add_page_headers(response, page)
+    if new_session:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True,
+            samesite='Strict')
     return response
 
 # regdetails route - opens on new page and shows to the user the
@@ -96,6 +169,7 @@ def regdetails():
     error_msg = ''
     #check if classid exists
     classid=request.args.get("classid")
+    g.query = {'class_id': classid}
     if not classid:
         error_msg = "missing classid"
         class_details=""
@@ -103,14 +177,21 @@ def regdetails():
         error_msg = "non-integer classid"
         class_details=""
     else:
+        g.query['class_id'] = int(classid)
+        started = perf_counter()
         class_details = get_table_results(classid)
+        g.timings['db'] = perf_counter() - started
         if isinstance(class_details, tuple):
             _, error_msg = class_details
+    g.result = (False, error_msg) if error_msg else (True,
+        class_details)
     # return HTML template with details data
+    started = perf_counter()
     html = render_template('regdetails.html',
         error_msg=error_msg,
         classid=request.args.get("classid"),
         class_details=class_details)
+    g.timings['format'] = perf_counter() - started
     response = make_response(html)
     return response
     
\ No newline at end of file
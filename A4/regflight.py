@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regflight.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from threading import Lock, Event
+from regbudget import current_budget, POLL_INTERVAL
+
+# ----------------------------------------------------------------------
+# The part of the reg server's regflight.py the app uses: identical
+# queries that arrive while one of them is being answered wait for that
+# answer instead of each reading the database. The app is one process,
+# so there are no flights to share with other processes, and nothing
+# reports the counters.
+# ----------------------------------------------------------------------
+
+# set once the flight's leader has its result
+class _Flight(Event):
+
+    def __init__(self):
+        super().__init__()
+        self.result = None
+        self.shared = False
+
+class SingleFlight:  # pylint: disable=too-few-public-methods
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = Lock()
+        # key -> the _Flight answering it
+        self._flights = {}
+
+    # returns compute(), or the result of a call for the same key that
+    # was already in progress. shareable(result) says whether a result
+    # may be handed to other callers (default: any). A caller that has
+    # to wait gives up with its reason once the current budget runs out.
+    def do(self, key, compute, shareable=None):
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _Flight()
+            if leader:
+                return self._lead(key, flight, compute, shareable)
+
+            reason = _wait(flight.wait)
+            if reason is not None:
+                return (False, reason)
+            if flight.shared:
+                return flight.result
+
+    def _lead(self, key, flight, compute, shareable):
+        try:
+            result = compute()
+            flight.result = result
+            flight.shared = shareable is None or shareable(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+# waits with wait(timeout) until it returns true; returns None, or the
+# reason the current budget ran out first
+def _wait(wait):
+    budget = current_budget()
+    if budget is None:
+        wait(None)
+        return None
+    while not wait(POLL_INTERVAL):
+        reason = budget.check()
+        if reason is not None:
+            return reason
+    return None
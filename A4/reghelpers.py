@@ -7,11 +7,23 @@
 
 from sys import argv, stderr
 from contextlib import closing
-from sqlite3 import connect, Error
+from sqlite3 import Error
+from dbpool import pooled_connection
+from regmaterialize import Materialization
+from regindex import file_stamp
+from regrefine import RefinementSessions
+from regflight import SingleFlight
+from regpage import page_key, decode_cursor, page_size, make_page
+from regpage import page_from_rows, DEFAULT_PAGE_SIZE
+from regpage import INVALID_PAGE_MSG
 
 # ----------------------------------------------------------------------
 
-DATABASE_URL = 'file:reg.sqlite?mode=ro'
+DATABASE_PATH = 'reg.sqlite'
+DATABASE_URL = 'file:' + DATABASE_PATH + '?mode=ro'
+
+# pre-joined copy of the catalog, see regmaterialize.py
+MATERIALIZED_PATH = 'reg.materialized.sqlite'
 
 def format_row(row):
     output = '{0:>5d}  {1:>3s}   {2:>4s}  {3:>3s} {4}'.format(
@@ -22,10 +34,10 @@ def format_row(row):
 # returns a list of unsorted rows
 
 # returns a tuple with (False, exception) if something fails
-def select_from_table(stmt_str, prepared_args):
+def select_from_table(stmt_str, prepared_args,
+                      database_url=DATABASE_URL):
     try:
-        with connect(DATABASE_URL, isolation_level=None,
-                     uri=True) as connection:
+        with pooled_connection(database_url) as connection:
 
             with closing(connection.cursor()) as cursor:
 
@@ -53,14 +65,15 @@ def row_array_to_string(row_array):
         to_return += "\n"
     return to_return.rstrip("\n")
 
-def get_table_results(stmt_str, prepared_args):
+def get_table_results(stmt_str, prepared_args,
+                      database_url=DATABASE_URL):
 
-    rows = select_from_table(stmt_str, prepared_args)
+    rows = select_from_table(stmt_str, prepared_args, database_url)
     # checks for error state
     if isinstance(rows, tuple):
         return rows
-    rows.sort(key=lambda x: x[2])
-    rows.sort(key=lambda x: x[1])
+    # by dept, course number and classid, the order pages are cut in
+    rows.sort(key=page_key)
     return rows
 
 BASE_STMT_STR = '''SELECT classes.classid, crosslistings.dept,
@@ -68,6 +81,20 @@ BASE_STMT_STR = '''SELECT classes.classid, crosslistings.dept,
     FROM classes, crosslistings, courses  
     WHERE classes.courseid = crosslistings.courseid 
     AND classes.courseid = courses.courseid '''
+MATERIALIZED_STMT_STR = '''SELECT classid, dept, coursenum, area,
+    title FROM overview WHERE 1 '''
+MATERIALIZED_ORDER_STR = ' ORDER BY pos'
+# page order, and the rows after a cursor in it, in the source database
+# and in the materialized overview table
+PAGE_ORDER_STR = ''' ORDER BY crosslistings.dept,
+    crosslistings.coursenum, classes.classid LIMIT ?'''
+MATERIALIZED_PAGE_ORDER_STR = ''' ORDER BY dept, coursenum, classid
+    LIMIT ?'''
+AFTER_STR = ''' AND (crosslistings.dept, crosslistings.coursenum,
+    classes.classid) > (?, ?, ?)'''
+MATERIALIZED_AFTER_STR = ''' AND (dept, coursenum, classid)
+    > (?, ?, ?)'''
+COUNT_STMT_STR = 'SELECT COUNT(*) FROM ({})'
 LIKE_STATEMENT_STRING = " LIKE ? ESCAPE \'\\\'"
 
 # appends to prepared_args in place,
@@ -86,24 +113,134 @@ def update_statement(and_stmt, searchstring, prepared_args):
     prepared_args.append(format_searchstring(searchstring))
     return and_stmt + LIKE_STATEMENT_STRING
 
-def get_results_from_query(query):
-    stmt_str = BASE_STMT_STR
+# query key and the column it filters in the source database and in
+# the materialized overview table, in statement order
+SEARCH_FIELDS = [
+    ("d", "AND lower(crosslistings.dept)", "AND dept_l"),
+    ("n", "AND lower(crosslistings.coursenum)", "AND coursenum_l"),
+    ("a", "AND lower(courses.area)", "AND area_l"),
+    ("t", "AND lower(courses.title)", "AND title_l")
+]
+
+# returns the statement selecting query's rows from the database at
+# materialized_url (None for the source database) and its arguments
+def overview_statement(query, materialized_url):
+    stmt_str = (BASE_STMT_STR if materialized_url is None
+        else MATERIALIZED_STMT_STR)
     prepared_args = []
-    if query["d"]:
-        stmt_str += update_statement(
-            "AND lower(crosslistings.dept)",
-                query["d"], prepared_args)
-    if query["n"]:
-        stmt_str += update_statement(
-            "AND lower(crosslistings.coursenum)",
-                query["n"], prepared_args)
-    if query["a"]:
-        stmt_str += update_statement(
-            "AND lower(courses.area)",
-                query["a"], prepared_args)
-    if query["t"]:
-        stmt_str += update_statement(
-            "AND lower(courses.title)",
-                query["t"], prepared_args)
-
-    return get_table_results(stmt_str, prepared_args)
+    for key, and_stmt, materialized_and_stmt in SEARCH_FIELDS:
+        if query[key]:
+            stmt_str += update_statement(
+                and_stmt if materialized_url is None
+                else materialized_and_stmt, query[key], prepared_args)
+    return (stmt_str, prepared_args)
+
+# searches ignore case, so "COS" and "cos" are the same search
+def query_key(query):
+    return tuple(query[field[0]].lower() for field in SEARCH_FIELDS)
+
+# identical searches made at the same time by the server's threads are
+# only run once
+overview_flight = SingleFlight('overviews')
+
+def get_results_from_query(query):
+    return overview_flight.do(query_key(query),
+        lambda: query_overviews(query))
+
+def query_overviews(query):
+    materialized_url = materialization.current_url()
+    stmt_str, prepared_args = overview_statement(query,
+        materialized_url)
+
+    if materialized_url is None:
+        return get_table_results(stmt_str, prepared_args)
+    stmt_str += MATERIALIZED_ORDER_STR
+    return get_table_results(stmt_str, prepared_args, materialized_url)
+
+# search sessions that type a query a character at a time; a result is
+# only narrowed while reg.sqlite is unchanged
+refinement_sessions = RefinementSessions(
+    lambda: file_stamp(DATABASE_PATH))
+
+# like get_results_from_query, but narrows the previous result of the
+# browser's search session when it can
+def get_results_refined(query, session_id):
+    return refinement_sessions.search(session_id, query,
+        get_results_from_query)
+
+# ----------------------------------------------------------------------
+# PAGES
+
+# returns one page of query's results (see regpage.py): {'rows',
+# 'cursor' for the next page or None, 'total' if with_total else
+# None}. With a search session its result is cut into pages; otherwise
+# the database reads just the rows of this page.
+def get_page(query, cursor=None, limit=DEFAULT_PAGE_SIZE,
+             with_total=False, session_id=None):
+    try:
+        after = decode_cursor(cursor)
+        limit = page_size(limit)
+    except (ValueError, TypeError):
+        return (False, INVALID_PAGE_MSG)
+
+    if session_id is not None:
+        rows = get_results_refined(query, session_id)
+        if isinstance(rows, tuple):
+            return rows
+        return page_from_rows(rows, after, limit, with_total)
+    return query_page(query, after, limit, with_total)
+
+# reads the page of query's rows after key after from the database
+def query_page(query, after, limit, with_total):
+    materialized_url = materialization.current_url()
+    database_url = (DATABASE_URL if materialized_url is None
+        else materialized_url)
+    stmt_str, prepared_args = overview_statement(query,
+        materialized_url)
+
+    total = None
+    if with_total and after is not None:
+        total = count_rows(stmt_str, prepared_args, database_url)
+        if isinstance(total, tuple):
+            return total
+
+    page_stmt_str = stmt_str
+    page_args = list(prepared_args)
+    if after is not None:
+        page_stmt_str += (AFTER_STR if materialized_url is None
+            else MATERIALIZED_AFTER_STR)
+        page_args.extend(after)
+    page_stmt_str += (PAGE_ORDER_STR if materialized_url is None
+        else MATERIALIZED_PAGE_ORDER_STR)
+    # one row more than the page tells us whether another follows
+    page_args.append(limit + 1)
+    rows = select_from_table(page_stmt_str, page_args, database_url)
+    if isinstance(rows, tuple):
+        return rows
+
+    # a first page holding everything is its own count
+    if with_total and total is None:
+        total = (len(rows) if len(rows) <= limit
+            else count_rows(stmt_str, prepared_args, database_url))
+        if isinstance(total, tuple):
+            return total
+    return make_page(rows, limit, total)
+
+# returns the number of rows stmt_str selects, or (False, err_message)
+def count_rows(stmt_str, prepared_args, database_url):
+    rows = select_from_table(COUNT_STMT_STR.format(stmt_str),
+        prepared_args, database_url)
+    if isinstance(rows, tuple):
+        return rows
+    return rows[0][0]
+
+# ----------------------------------------------------------------------
+# MATERIALIZED CATALOG
+
+materialization = Materialization(DATABASE_PATH, MATERIALIZED_PATH)
+
+# answers queries from the pre-joined catalog from now on, building it
+# now if needed (or, unless build_now, on the first query that needs
+# it); it is rebuilt whenever reg.sqlite changes
+def enable_materialization(build_now=True):
+    return materialization.enable(build_now)
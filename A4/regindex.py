@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regindex.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+import re
+from os import stat
+from string import ascii_uppercase, ascii_lowercase
+
+# ----------------------------------------------------------------------
+# The parts of the reg server's regindex.py the app uses: SQLite's LIKE
+# semantics, for regrefine.py to filter a session's rows with, and the
+# stamp that tells versions of the database apart. The app keeps no
+# trigram index of its own.
+# ----------------------------------------------------------------------
+
+# overview rows are (classid, dept, coursenum, area, title); these are
+# the searchable columns and the query keys that filter them
+SEARCH_COLUMNS = [(1, 'd'), (2, 'n'), (3, 'a'), (4, 't')]
+
+# SQLite's lower() and LIKE only fold ASCII letters, so we must too
+_ASCII_LOWER = str.maketrans(ascii_uppercase, ascii_lowercase)
+
+def sql_lower(value):
+    if value is None:
+        return None
+    return str(value).translate(_ASCII_LOWER)
+
+# ----------------------------------------------------------------------
+# LIKE PATTERNS
+
+# the pattern a search for searchstring uses: a case-insensitive
+# substring match, with the user's % and _ taken literally
+def like_pattern(searchstring):
+    # convert to lower case
+    searchstring = searchstring.lower()
+    # escape regex characters
+    searchstring = searchstring.replace("%", r"\%")
+    searchstring = searchstring.replace("_", r"\_")
+    # sandwich with percent signs (for regex)
+    return '%{}%'.format(searchstring)
+
+# splits a LIKE pattern into tokens: ('lit', text), ('any',) for % and
+# ('one',) for _. Returns None if the pattern can never match (SQLite
+# treats a trailing escape character that way).
+def parse_like(pattern, escape='\\'):
+    tokens = []
+    literal = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == escape:
+            if i + 1 == len(pattern):
+                return None
+            literal += pattern[i + 1]
+            i += 2
+            continue
+        if char in '%_':
+            if literal:
+                tokens.append(('lit', literal))
+                literal = ''
+            tokens.append(('any',) if char == '%' else ('one',))
+        else:
+            literal += char
+        i += 1
+    if literal:
+        tokens.append(('lit', literal))
+    return tokens
+
+# compiles a LIKE pattern into a predicate over sql_lower()ed values
+# with exactly SQLite's (ASCII case-insensitive) semantics
+def like_matcher(pattern, escape='\\'):
+    tokens = parse_like(pattern, escape)
+    if tokens is None:
+        return lambda value: False
+    regex = ''
+    for token in tokens:
+        if token[0] == 'lit':
+            regex += re.escape(sql_lower(token[1]))
+        elif token[0] == 'any':
+            regex += '.*'
+        else:
+            regex += '.'
+    compiled = re.compile(regex, re.DOTALL)
+    return lambda value: (value is not None
+        and compiled.fullmatch(value) is not None)
+
+# ----------------------------------------------------------------------
+
+# identifies a version of the database file
+def file_stamp(path):
+    info = stat(path)
+    return (info.st_size, info.st_mtime_ns)
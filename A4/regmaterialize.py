@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regmaterialize.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+import json
+from os import stat, replace, remove, getpid, path as os_path
+from threading import Lock
+from contextlib import closing
+from sqlite3 import connect, Error
+from dbpool import pooled_connection, retire
+
+# ----------------------------------------------------------------------
+
+# bump whenever the layout of the materialized database changes
+MATERIALIZED_FORMAT = 2
+
+SCHEMA_STMT_STRS = [
+    '''CREATE TABLE meta (key TEXT PRIMARY KEY, value)''',
+    # one row per (class, crosslisting) in the order overviews are
+    # shown, with the searchable columns lowercased by SQLite itself
+    '''CREATE TABLE overview (pos INTEGER PRIMARY KEY,
+        classid INTEGER, dept TEXT, coursenum TEXT, area TEXT,
+        title TEXT, dept_l TEXT, coursenum_l TEXT, area_l TEXT,
+        title_l TEXT)''',
+    # finds the page after a cursor without sorting, see regpage.py
+    '''CREATE UNIQUE INDEX overview_page
+        ON overview (dept, coursenum, classid)''',
+    # one row per class; depts is a JSON list of [dept, coursenum]
+    # pairs and profs a JSON list of names, both already sorted
+    '''CREATE TABLE details (classid INTEGER PRIMARY KEY,
+        courseid INTEGER, days TEXT, starttime TEXT, endtime TEXT,
+        bldg TEXT, roomnum TEXT, area TEXT, title TEXT, descrip TEXT,
+        prereqs TEXT, depts TEXT, profs TEXT)'''
+]
+
+SOURCE_OVERVIEW_STMT_STR = '''SELECT classes.classid,
+    crosslistings.dept, crosslistings.coursenum, courses.area,
+    courses.title
+    FROM classes, crosslistings, courses
+    WHERE classes.courseid = crosslistings.courseid
+    AND classes.courseid = courses.courseid
+    ORDER BY crosslistings.dept, crosslistings.coursenum,
+    classes.classid'''
+
+SOURCE_CLASSES_STMT_STR = '''SELECT classes.classid, classes.courseid,
+    classes.days, classes.starttime, classes.endtime, classes.bldg,
+    classes.roomnum, courses.area, courses.title, courses.descrip,
+    courses.prereqs
+    FROM classes, courses
+    WHERE classes.courseid = courses.courseid
+    ORDER BY classes.classid, classes.courseid'''
+
+SOURCE_DEPTS_STMT_STR = '''SELECT courseid, dept, coursenum
+    FROM crosslistings
+    ORDER BY courseid, dept, coursenum'''
+
+SOURCE_PROFS_STMT_STR = '''SELECT coursesprofs.courseid, profs.profname
+    FROM coursesprofs, profs
+    WHERE coursesprofs.profid = profs.profid
+    ORDER BY coursesprofs.courseid, profs.profname'''
+
+OVERVIEW_INSERT_STR = '''INSERT INTO overview VALUES
+    (?1, ?2, ?3, ?4, ?5, ?6, lower(?3), lower(?4), lower(?5),
+    lower(?6))'''
+
+DETAILS_INSERT_STR = '''INSERT OR IGNORE INTO details VALUES
+    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# ----------------------------------------------------------------------
+
+def file_stamp(path):
+    info = stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+def _select(cursor, stmt_str):
+    cursor.execute(stmt_str)
+    return cursor.fetchall()
+
+def _group(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[0], []).append(list(row[1:]))
+    return groups
+
+def _copy_catalog(source, target):
+    with closing(source.cursor()) as cursor:
+        overview = _select(cursor, SOURCE_OVERVIEW_STMT_STR)
+        classes = _select(cursor, SOURCE_CLASSES_STMT_STR)
+        depts = _group(_select(cursor, SOURCE_DEPTS_STMT_STR))
+        profs = _group(_select(cursor, SOURCE_PROFS_STMT_STR))
+
+    target.executemany(OVERVIEW_INSERT_STR,
+        [(pos,) + tuple(row) for pos, row in enumerate(overview)])
+    target.executemany(DETAILS_INSERT_STR,
+        [tuple(row) + (
+            json.dumps(depts.get(row[1], [])),
+            json.dumps([prof[0] for prof in profs.get(row[1], [])]))
+        for row in classes])
+
+# writes the materialized copy of source_path to target_path. The copy
+# is built in a temporary file and moved into place in one step, so
+# readers only ever see a complete copy.
+def build(source_path, target_path):
+    stamp = file_stamp(source_path)
+    temp_path = '{}.{}.tmp'.format(target_path, getpid())
+    try:
+        with closing(connect('file:{}?mode=ro'.format(source_path),
+                             uri=True)) as source, \
+             closing(connect(temp_path)) as target:
+            for stmt_str in SCHEMA_STMT_STRS:
+                target.execute(stmt_str)
+            _copy_catalog(source, target)
+            target.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('format', MATERIALIZED_FORMAT),
+                ('source_stamp', json.dumps(stamp))])
+            target.commit()
+        replace(temp_path, target_path)
+    finally:
+        if os_path.exists(temp_path):
+            remove(temp_path)
+    return stamp
+
+# returns the source stamp recorded in a materialized database, or None
+# if it cannot be read or has the wrong format
+def read_stamp(database_url):
+    try:
+        with pooled_connection(database_url) as connection:
+            meta = dict(connection.execute(
+                'SELECT key, value FROM meta').fetchall())
+        if meta.get('format') != MATERIALIZED_FORMAT:
+            return None
+        return json.loads(meta['source_stamp'])
+    except (Error, KeyError, ValueError):
+        return None
+
+# ----------------------------------------------------------------------
+
+class Materialization:
+
+    def __init__(self, source_path, target_path):
+        self._source_path = source_path
+        self._target_path = target_path
+        self._url = 'file:{}?mode=ro'.format(target_path)
+        self._lock = Lock()
+        self._enabled = False
+        # source stamp of the copy this process is reading from
+        self._stamp = None
+
+    def get_url(self):
+        return self._url
+
+    # reads from the materialized copy from now on. Unless build_now
+    # is false, makes sure it is up to date now rather than on the
+    # first query; returns false if it is unusable.
+    def enable(self, build_now=True):
+        self._enabled = True
+        return not build_now or self.current_url() is not None
+
+    # makes sure the materialized copy matches the source database,
+    # rebuilding it if not. Returns its url, or None if it is unusable
+    # and callers should read the source instead.
+    def current_url(self):
+        if not self._enabled:
+            return None
+        try:
+            stamp = file_stamp(self._source_path)
+        except OSError:
+            return None
+        if stamp == self._stamp:
+            return self._url
+
+        with self._lock:
+            if stamp == self._stamp:
+                return self._url
+            # the file may have been replaced (by us or by another
+            # process), so reopen it before trusting what it says
+            retire(self._url)
+            self._stamp = read_stamp(self._url)
+            if self._stamp != stamp:
+                try:
+                    build(self._source_path, self._target_path)
+                except (Error, OSError) as ex:
+                    print('Could not materialize {}: {}'.format(
+                        self._source_path, ex), file=stderr)
+                    self._stamp = None
+                    return None
+                retire(self._url)
+                self._stamp = read_stamp(self._url)
+            return self._url if self._stamp == stamp else None
+
+# ----------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Build the materialized catalog offline',
+        allow_abbrev=False)
+
+    parser.add_argument('source', nargs='?', default='reg.sqlite',
+        help='the registrar database')
+
+    parser.add_argument('target', nargs='?',
+        default='reg.materialized.sqlite',
+        help='the file the materialized catalog should be written to')
+
+    args = parser.parse_args()
+
+    try:
+        build(args.source, args.target)
+    except (Error, OSError) as ex:
+        print(ex, file=stderr)
+        exit(1)
+    print('Materialized {} into {}'.format(args.source, args.target))
+
+if __name__ == '__main__':
+    main()
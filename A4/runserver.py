@@ -8,6 +8,7 @@
 from sys import exit, stderr
 import argparse
 from reg import app
+from reglog import enable_request_log
 
 def main():
 
@@ -18,9 +19,20 @@ def main():
     parser.add_argument('port', type=int,
         help='the port at which the server should listen')
 
+    parser.add_argument('--request-log', metavar='file',
+        help='''append a JSON line to this file for every search and
+        detail lookup answered, for regreplay.py to send again''')
+
+    parser.add_argument('--slow-ms', type=float, default=None,
+        metavar='milliseconds',
+        help='''report requests that take at least this long on
+        stderr, and mark them slow in the request log''')
+
     args = parser.parse_args()
 
     port = args.port
+    if args.request_log is not None or args.slow_ms is not None:
+        enable_request_log(args.request_log, 'flask', args.slow_ms)
 
     try:
         app.run(host='0.0.0.0', port=port, debug=True)
@@ -7,11 +7,11 @@
 
 from sys import argv, stderr, exit
 from socket import socket
-from pickle import load, dump
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import QMainWindow, QFrame, QDesktopWidget
 from PyQt5.QtWidgets import QLabel, QLineEdit, QGridLayout
 from PyQt5.QtWidgets import QPushButton, QTextEdit
+from wirecodec import read_message, write_message
 
 #-----------------------------------------------------------------------
 
@@ -72,18 +72,18 @@ def author_slot_helper(host, port, author_lineedit, books_textedit):
             sock.connect((host, port))
 
             out_flo = sock.makefile(mode='wb')
-            dump(author, out_flo)
-            out_flo.flush()
+            write_message(out_flo, author)
 
+            # each book arrives as an (author, title, price) tuple
             in_flo = sock.makefile(mode='rb')
-            books = load(in_flo)
+            books = read_message(in_flo)
 
         if len(books) == 0:
             books_textedit.insertPlainText('(None)')
         else:
             pattern = '<strong>%s</strong>: %s ($%.2f)<br>'
             for book in books:
-                books_textedit.insertHtml(pattern % book.to_tuple())
+                books_textedit.insertHtml(pattern % book)
 
     except Exception as ex:
         books_textedit.insertPlainText(str(ex))
@@ -9,9 +9,9 @@ from os import name
 from sys import exit, argv, stderr
 from socket import socket
 from socket import SOL_SOCKET, SO_REUSEADDR
-from pickle import load, dump
 from time import process_time
 from database import search
+from wirecodec import read_message, write_message
 
 #-----------------------------------------------------------------------
 
@@ -27,7 +27,7 @@ def consume_cpu_time(delay):
 def handle_client(sock, delay):
 
     in_flo = sock.makefile(mode='rb')
-    author = load(in_flo)
+    author = read_message(in_flo)
     print('Received author: ' + author)
 
     # Consume delay seconds of CPU time.
@@ -39,7 +39,7 @@ def handle_client(sock, delay):
         books = search(author)  # Exception handling omitted
 
     out_flo = sock.makefile(mode='wb')
-    dump(books, out_flo)
+    write_message(out_flo, [book.to_tuple() for book in books])
     out_flo.flush()
 
 #-----------------------------------------------------------------------
@@ -5,9 +5,9 @@
 # Author: Bob Dondero
 #-----------------------------------------------------------------------
 
-from sqlite3 import connect
 from contextlib import closing
 from book import Book
+from dbpool import pooled_connection
 
 #-----------------------------------------------------------------------
 
@@ -17,7 +17,7 @@ def search(author):
 
     books = []
 
-    with connect(_DATABASE_URL, uri=True) as connection:
+    with pooled_connection(_DATABASE_URL) as connection:
 
         with closing(connection.cursor()) as cursor:
 
@@ -10,9 +10,9 @@ from sys import exit, argv, stderr
 from socket import socket
 from socket import SOL_SOCKET, SO_REUSEADDR
 from multiprocessing import Process, cpu_count
-from pickle import load, dump
 from time import process_time
 from database import search
+from wirecodec import read_message, write_message
 
 #-----------------------------------------------------------------------
 
@@ -31,7 +31,7 @@ def handle_client(sock, delay):
 
     try:
         in_flo = sock.makefile(mode='rb')
-        author = load(in_flo)
+        author = read_message(in_flo)
 
         print('Received author: ' + author)
 
@@ -44,7 +44,7 @@ def handle_client(sock, delay):
             books = search(author)  # Exception handling omitted
 
         out_flo = sock.makefile(mode='wb')
-        dump(books, out_flo)
+        write_message(out_flo, [book.to_tuple() for book in books])
         out_flo.flush()
 
         sock.close()
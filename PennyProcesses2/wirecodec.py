@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# wirecodec.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from struct import Struct, error as StructError
+
+# ----------------------------------------------------------------------
+# A small, self-describing binary format for what our servers and
+# clients exchange: None, bools, ints, floats, strings, bytes, lists,
+# tuples and dicts. Unlike pickle, decoding can only ever build those
+# types, so a malicious peer cannot make us run code.
+#
+# An encoded value starts with FORMAT_VERSION. Every item then starts
+# with a one-byte tag; lengths and counts are unsigned varints. Lists of
+# overview rows, (classid, dept, coursenum, area, title), are most of
+# what we send, so they are stored by column: every classid packed in
+# one block, then each text column as one NUL-separated string. That
+# keeps the per-row work inside struct and str methods, and encodes the
+# catalog faster than pickle does.
+#
+# Other values are encoded an item at a time in Python, so a small
+# message (a request, a class's details) takes a few microseconds where
+# pickle, written in C, takes one. We pay that for the safety: pickle
+# stays only for the clients that predate this format (see
+# regprotocol.py), and is only ever loaded as plain data.
+#
+# The Penny examples keep copies of this file, which must stay the same
+# as this one for as long as they share FORMAT_VERSION.
+# ----------------------------------------------------------------------
+
+FORMAT_VERSION = 1
+
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'i'
+_FLOAT = b'd'
+_STR = b's'
+_BYTES = b'b'
+_LIST = b'l'
+_TUPLE = b't'
+_DICT = b'm'
+_ROWS = b'R'
+
+_INT64 = Struct('!q')
+_DOUBLE = Struct('!d')
+_LENGTH = Struct('!I')
+# a tag and its fixed-size value, packed in one call
+_INT_ITEM = Struct('!cq')
+_FLOAT_ITEM = Struct('!cd')
+
+_ROW_LENGTH = 5
+_SEPARATOR = '\x00'
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+class CodecError(ValueError):
+    pass
+
+# ----------------------------------------------------------------------
+# ENCODING
+
+# most lengths and counts fit in one byte
+_SMALL_VARINTS = [bytes([number]) for number in range(0x80)]
+
+def _varint(number):
+    if number < 0x80:
+        return _SMALL_VARINTS[number]
+    out = bytearray()
+    while number >= 0x80:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+    return bytes(out)
+
+_INT32_SIZE = 4
+
+def _classid_struct(count):
+    return Struct('!{}i'.format(count))
+
+# returns (the packed classids, each text column joined) if value is
+# a list of overview rows that the column encoding can hold, else
+# None. The checks run over whole columns, inside set(), map(), pack()
+# and str.join(), not row by row; join() also takes str subclasses,
+# which come back as plain str here just as they do when encoded one
+# by one.
+def _overview_columns(value):
+    if set(map(type, value)) != {tuple} or set(
+            map(len, value)) != {_ROW_LENGTH}:
+        return None
+    columns = list(zip(*value))
+    classids = columns[0]
+    # bools are ints too, but would come back as 0 and 1
+    if set(map(type, classids)) != {int}:
+        return None
+    try:
+        packed = _classid_struct(len(classids)).pack(*classids)
+    except StructError:
+        # a classid that does not fit in 32 bits
+        return None
+    texts = []
+    for column in columns[1:]:
+        try:
+            text = _SEPARATOR.join(column)
+        except TypeError:
+            return None
+        # a separator inside a value would split it in two
+        if text.count(_SEPARATOR) != len(column) - 1:
+            return None
+        texts.append(text)
+    return (packed, texts)
+
+def _encode_none(_, out):
+    out.append(_NONE)
+
+def _encode_bool(value, out):
+    out.append(_TRUE if value else _FALSE)
+
+def _encode_int(value, out):
+    if not -2**63 <= value < 2**63:
+        raise CodecError('integer out of range')
+    out.append(_INT_ITEM.pack(_INT, value))
+
+def _encode_float(value, out):
+    out.append(_FLOAT_ITEM.pack(_FLOAT, value))
+
+def _encode_str(value, out):
+    data = value.encode('utf-8')
+    out += (_STR, _varint(len(data)), data)
+
+def _encode_bytes(value, out):
+    out += (_BYTES, _varint(len(value)), bytes(value))
+
+def _encode_items(tag, items, out):
+    out += (tag, _varint(len(items)))
+    for item in items:
+        (_ENCODERS.get(type(item)) or _encoder(item))(item, out)
+
+def _encode_list(value, out):
+    columns = _overview_columns(value) if value else None
+    if columns is None:
+        _encode_items(_LIST, value, out)
+        return
+    packed, texts = columns
+    out += (_ROWS, _varint(len(value)), packed)
+    for text in texts:
+        data = text.encode('utf-8')
+        out += (_varint(len(data)), data)
+
+def _encode_tuple(value, out):
+    _encode_items(_TUPLE, value, out)
+
+def _encode_dict(value, out):
+    out += (_DICT, _varint(len(value)))
+    for key, item in value.items():
+        (_ENCODERS.get(type(key)) or _encoder(key))(key, out)
+        (_ENCODERS.get(type(item)) or _encoder(item))(item, out)
+
+# type -> the function that appends a value of it to a list of bytes
+_ENCODERS = {
+    type(None): _encode_none,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    bytearray: _encode_bytes,
+    list: _encode_list,
+    tuple: _encode_tuple,
+    dict: _encode_dict}
+
+# returns the encoder for value, which may be of a subclass of the
+# types above (e.g. a namedtuple)
+def _encoder(value):
+    encoder = _ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder
+    for base in type(value).__mro__:
+        if base in _ENCODERS:
+            return _ENCODERS[base]
+    raise CodecError('cannot encode {}'.format(type(value).__name__))
+
+def dumps(value):
+    out = [bytes([FORMAT_VERSION])]
+    _encoder(value)(value, out)
+    return b''.join(out)
+
+# ----------------------------------------------------------------------
+# DECODING
+
+class _Reader:
+
+    def __init__(self, data):
+        self._data = bytes(data)
+        self._pos = 0
+
+    def remaining(self):
+        return len(self._data) - self._pos
+
+    def take(self, size):
+        end = self._pos + size
+        if end > len(self._data):
+            raise CodecError('truncated data')
+        chunk = self._data[self._pos:end]
+        self._pos = end
+        return chunk
+
+    def byte(self):
+        try:
+            byte = self._data[self._pos]
+        except IndexError as ex:
+            raise CodecError('truncated data') from ex
+        self._pos += 1
+        return byte
+
+    def unpack(self, struct):
+        end = self._pos + struct.size
+        if end > len(self._data):
+            raise CodecError('truncated data')
+        (value,) = struct.unpack_from(self._data, self._pos)
+        self._pos = end
+        return value
+
+    def varint(self):
+        number = 0
+        shift = 0
+        while True:
+            byte = self.byte()
+            number |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return number
+            shift += 7
+            if shift > 63:
+                raise CodecError('varint too long')
+
+    def text(self, size):
+        try:
+            return self.take(size).decode('utf-8')
+        except UnicodeDecodeError as ex:
+            raise CodecError(str(ex)) from ex
+
+def _decode_rows(reader, _):
+    count = reader.varint()
+    if count * _INT32_SIZE > reader.remaining():
+        raise CodecError('truncated data')
+    classid_struct = _classid_struct(count)
+    classids = classid_struct.unpack(reader.take(classid_struct.size))
+    columns = [classids]
+    for _ in range(_ROW_LENGTH - 1):
+        column = reader.text(reader.varint()).split(_SEPARATOR)
+        if len(column) != count:
+            raise CodecError('bad row column')
+        columns.append(column)
+    return list(zip(*columns))
+
+def _decode_list(reader, depth):
+    return [_decode(reader, depth + 1)
+        for _ in range(reader.varint())]
+
+def _decode_tuple(reader, depth):
+    return tuple(_decode_list(reader, depth))
+
+def _decode_dict(reader, depth):
+    to_return = {}
+    for _ in range(reader.varint()):
+        key = _decode(reader, depth + 1)
+        try:
+            to_return[key] = _decode(reader, depth + 1)
+        except TypeError as ex:
+            raise CodecError('unhashable key') from ex
+    return to_return
+
+# tag byte -> the function that reads the rest of the item
+_DECODERS = {
+    _NONE[0]: lambda reader, depth: None,
+    _TRUE[0]: lambda reader, depth: True,
+    _FALSE[0]: lambda reader, depth: False,
+    _INT[0]: lambda reader, depth: reader.unpack(_INT64),
+    _FLOAT[0]: lambda reader, depth: reader.unpack(_DOUBLE),
+    _STR[0]: lambda reader, depth: reader.text(reader.varint()),
+    _BYTES[0]: lambda reader, depth: reader.take(reader.varint()),
+    _LIST[0]: _decode_list,
+    _TUPLE[0]: _decode_tuple,
+    _DICT[0]: _decode_dict,
+    _ROWS[0]: _decode_rows}
+
+def _decode(reader, depth=0):
+    if depth > 64:
+        raise CodecError('nesting too deep')
+    tag = reader.byte()
+    decoder = _DECODERS.get(tag)
+    if decoder is None:
+        raise CodecError('unknown tag {!r}'.format(bytes([tag])))
+    return decoder(reader, depth)
+
+def loads(data):
+    reader = _Reader(data)
+    version = reader.byte()
+    if version != FORMAT_VERSION:
+        raise CodecError('unsupported format version {}'.format(
+            version))
+    value = _decode(reader)
+    if reader.remaining():
+        raise CodecError('trailing data')
+    return value
+
+# ----------------------------------------------------------------------
+# MESSAGES ON A STREAM
+
+# writes value to a binary file object as a length-prefixed message
+def write_message(out_flo, value):
+    payload = dumps(value)
+    out_flo.write(_LENGTH.pack(len(payload)) + payload)
+    out_flo.flush()
+
+# reads one length-prefixed message; returns None at EOF
+def read_message(in_flo):
+    header = in_flo.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return None
+    (size,) = _LENGTH.unpack(header)
+    if size > MAX_MESSAGE_SIZE:
+        raise CodecError('message too large')
+    payload = in_flo.read(size)
+    if len(payload) < size:
+        return None
+    return loads(payload)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_codec.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+from time import perf_counter
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+import wirecodec
+from reghelpers import select_all_overviews
+from regformat import row_array_to_string
+from regdetails import query_details
+
+# ----------------------------------------------------------------------
+
+EMPTY_QUERY = {'d': '', 'n': '', 'a': '', 't': ''}
+
+# a typical detail lookup: a class with crosslistings and professors
+DETAILS_CLASSID = 8321
+
+# full-catalog responses as the server frames them
+def make_messages():
+    rows = select_all_overviews()
+    if isinstance(rows, tuple):
+        raise RuntimeError(rows[1])
+    return [
+        ('catalog rows', {'id': 1, 'result': (True, rows)}),
+        ('catalog text', {'id': 1,
+            'result': (True, row_array_to_string(rows))}),
+        ('details', {'id': 1,
+            'result': (True, query_details(DETAILS_CLASSID))}),
+        ('request', {'id': 1, 'query': dict(EMPTY_QUERY, d='cos')})]
+
+def codecs():
+    return [
+        ('pickle', lambda value: dumps(value, HIGHEST_PROTOCOL), loads),
+        ('wirecodec', wirecodec.dumps, wirecodec.loads)]
+
+# returns the median time of func(value) over repetitions calls
+def median_time(func, value, repetitions):
+    times = []
+    for _ in range(repetitions):
+        start = perf_counter()
+        func(value)
+        times.append(perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Encode/decode cost and payload size: pickle vs '
+            'wirecodec',
+        allow_abbrev=False)
+
+    parser.add_argument('--repetitions', type=int, default=200,
+        help='the number of timed calls per message and codec')
+
+    args = parser.parse_args()
+
+    try:
+        messages = make_messages()
+    except Exception as ex:
+        print(ex, file=stderr)
+        exit(1)
+
+    print('{:<13s} {:<10s} {:>10s} {:>12s} {:>12s}'.format('message',
+        'codec', 'bytes', 'encode us', 'decode us'))
+    for label, message in messages:
+        for codec, encode, decode in codecs():
+            payload = encode(message)
+            # a codec that changes the message is not worth timing
+            if decode(payload) != message:
+                print('{}: {} does not round-trip'.format(label, codec),
+                    file=stderr)
+                exit(1)
+            print('{:<13s} {:<10s} {:>10d} {:>12.1f} {:>12.1f}'.format(
+                label, codec, len(payload),
+                median_time(encode, message, args.repetitions) * 1e6,
+                median_time(decode, payload, args.repetitions) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_details.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+from time import perf_counter
+from reghelpers import select_from_table
+from regdetails import format_details, query_details
+
+# ----------------------------------------------------------------------
+
+# the three statements regdetails used to run for every lookup
+OLD_BASE_STMT_STR = '''SELECT classes.courseid, classes.days,
+    classes.starttime, classes.endtime, classes.bldg,
+    classes.roomnum, courses.area, courses.title, courses.descrip,
+    courses.prereqs
+    FROM classes, crosslistings, courses
+    WHERE classes.classid = ?
+    AND classes.courseid = crosslistings.courseid
+    AND classes.courseid = courses.courseid'''
+
+OLD_DEPT_STMT_STR = '''SELECT crosslistings.dept,
+    crosslistings.coursenum
+    FROM classes, crosslistings
+    WHERE classes.classid = ?
+    AND crosslistings.courseid = classes.courseid'''
+
+OLD_PROF_STMT_STR = '''SELECT profname FROM classes, coursesprofs, profs
+    WHERE classes.classid = ?
+    AND classes.courseid = coursesprofs.courseid
+    AND coursesprofs.profid = profs.profid'''
+
+def old_query_details(classid):
+    base_rows = select_from_table(OLD_BASE_STMT_STR, [classid])
+    dept_rows = select_from_table(OLD_DEPT_STMT_STR, [classid])
+    prof_rows = select_from_table(OLD_PROF_STMT_STR, [classid])
+    for row in [base_rows, dept_rows, prof_rows]:
+        if isinstance(row, tuple):
+            return row
+    if len(base_rows) == 0:
+        return (False,
+            "No class with class id {} exists".format(classid))
+    dept_rows.sort(key=lambda x: x[1])
+    dept_rows.sort(key=lambda x: x[0])
+    prof_rows.sort(key=lambda x: x[0])
+    return format_details(base_rows[0], dept_rows, prof_rows)
+
+def measure(lookup, classids, rounds):
+    times = []
+    for _ in range(rounds):
+        for classid in classids:
+            start = perf_counter()
+            lookup(classid)
+            times.append(perf_counter() - start)
+    times.sort()
+    return (sum(times) / len(times), times[len(times) // 2],
+        times[int(len(times) * 0.99)])
+
+def report(label, results):
+    mean, median, p99 = results
+    print('{:<7s} mean {:8.1f} us  median {:8.1f} us  p99 {:8.1f} us'
+        .format(label, mean * 1e6, median * 1e6, p99 * 1e6))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Detail lookup latency over every classid',
+        allow_abbrev=False)
+
+    parser.add_argument('--rounds', type=int, default=3,
+        help='how many times to look up every classid')
+
+    args = parser.parse_args()
+
+    rows = select_from_table('SELECT classid FROM classes', [])
+    if isinstance(rows, tuple):
+        print(rows[1], file=stderr)
+        exit(1)
+    classids = [row[0] for row in rows]
+
+    # both paths must agree before their timings mean anything
+    for classid in classids:
+        if old_query_details(classid) != query_details(classid):
+            print('Mismatch for classid {}'.format(classid),
+                file=stderr)
+            exit(1)
+
+    before = measure(old_query_details, classids, args.rounds)
+    after = measure(query_details, classids, args.rounds)
+
+    print('{} classids, {} rounds'.format(len(classids), args.rounds))
+    report('before', before)
+    report('after', after)
+    print('mean speedup: {:.2f}x'.format(before[0] / after[0]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_hot.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+import json
+import gc
+from os import chdir, getcwd, symlink
+from os.path import abspath, dirname, exists, join
+from tempfile import TemporaryDirectory
+from statistics import mean, median, stdev
+from time import perf_counter
+from platform import python_version
+from importlib.util import spec_from_file_location, module_from_spec
+from contextlib import closing
+from sqlite3 import connect, Error
+import dbpool
+from regformat import format_row, row_array_to_string
+from reghelpers import update_statement, get_results_from_query
+from reghelpers import select_all_overviews
+from reghelpers import overview_cache, SEARCH_FIELDS, DATABASE_PATH
+from reghelpers import DATABASE_URL
+from regdetails import format_details, select_details
+
+# ----------------------------------------------------------------------
+# Microbenchmarks of the functions every request goes through, run
+# against each of the course databases. Each benchmark calls its
+# function on a batch of inputs read from the database, a few times to
+# warm up and then repetitions times; the time of a batch divided by
+# its calls is one sample. Just before each batch, a fixed workload of
+# plain Python, the calibration, is timed too, and the median of the
+# samples' multiples of it is the benchmark's ratio: a faster or slower
+# machine, or one whose speed drifts during the run, moves both. The
+# ratios can be saved as a baseline, and later runs report how far they
+# are from it and flag the benchmarks that got slower by more than a
+# threshold. The absolute timings are kept for reading, never compared.
+# ----------------------------------------------------------------------
+
+HERE = dirname(abspath(__file__))
+
+DATABASES = ['reg.sqlite', 'test1.sqlite', 'test2.sqlite',
+    'test3.sqlite', 'test4.sqlite']
+
+DEFAULT_BASELINE = 'bench_hot.json'
+DEFAULT_WARMUP = 3
+DEFAULT_REPETITIONS = 25
+# how much slower than the baseline a median may be, as a fraction
+DEFAULT_THRESHOLD = 0.10
+# how many classes to format details for
+DEFAULT_CLASSES = 200
+# the numbers the calibration formats in a batch
+CALIBRATION_SIZE = 2000
+
+# searches as the GUI sends them: one field, several, a pattern with
+# LIKE wildcards in it, and the whole catalog
+QUERIES = [
+    {'d': 'cos', 'n': '', 'a': '', 't': ''},
+    {'d': '', 'n': '3', 'a': 'qr', 't': ''},
+    {'d': '', 'n': '', 'a': '', 't': 'intro'},
+    {'d': '', 'n': '', 'a': '', 't': 'c%_'},
+    {'d': '', 'n': '', 'a': '', 't': ''}]
+
+# the Flask app's details formatter; A4/regdetails.py imports the same
+# helpers as ours, so it is loaded under another name next to them
+def load_format_details_2():
+    spec = spec_from_file_location('a4_regdetails',
+        join(HERE, 'A4', 'regdetails.py'))
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.format_details_2
+
+format_details_2 = load_format_details_2()
+
+# ----------------------------------------------------------------------
+
+# the calibration: string formatting, calls and list appends, like the
+# helpers under test, but the same work on every machine and database
+def calibration_batch():
+    parts = []
+    for number in range(CALIBRATION_SIZE):
+        parts.append('{:>5} {}'.format(number, str(number) * 3))
+    return ''.join(parts).count('1')
+
+# returns ([(base_row, dept_rows, prof_rows)] for up to class_count
+# classes spread over the catalog, None), or (None, err_message) if the
+# database in the current directory cannot be read
+def read_details(class_count):
+    # read directly, so a broken database is reported by its cause
+    # rather than as a server error
+    try:
+        with closing(connect(DATABASE_URL, uri=True)) as connection:
+            classids = [row[0] for row in connection.execute(
+                'SELECT classid FROM classes')]
+    except Error as ex:
+        return (None, str(ex))
+    step = max(1, len(classids) // max(1, class_count))
+    details = []
+    for classid in classids[::step][:class_count]:
+        found = select_details(classid)
+        if not isinstance(found[0], bool) and found[0]:
+            details.append((found[0][0], found[1], found[2]))
+    return (details, None)
+
+# returns ([(name, batch function, calls per batch)], None), or (None,
+# err_message) if the database in the current directory cannot be read
+def make_benchmarks(class_count):
+    details, error = read_details(class_count)
+    if error is not None:
+        return (None, error)
+    rows = select_all_overviews()
+    if isinstance(rows, tuple):
+        return (None, rows[1])
+
+    def format_rows():
+        for row in rows:
+            format_row(row)
+
+    def build_statements():
+        for query in QUERIES:
+            prepared_args = []
+            for key, and_stmt, _ in SEARCH_FIELDS:
+                if query[key]:
+                    update_statement(and_stmt, query[key],
+                        prepared_args)
+
+    # every search reads the database: the cache is emptied first
+    def search_cold():
+        for query in QUERIES:
+            overview_cache.clear()
+            get_results_from_query(query)
+
+    def search_cached():
+        for query in QUERIES:
+            get_results_from_query(query)
+
+    def format_all_details():
+        for base_row, dept_rows, prof_rows in details:
+            format_details(base_row, dept_rows, prof_rows)
+
+    def format_all_details_2():
+        for base_row, dept_rows, prof_rows in details:
+            format_details_2(base_row, dept_rows, prof_rows)
+
+    statement_count = sum(1 for query in QUERIES
+        for key, _, _ in SEARCH_FIELDS if query[key])
+    benchmarks = [
+        ('format_row', format_rows, len(rows)),
+        ('row_array_to_string', lambda: row_array_to_string(rows), 1),
+        ('update_statement', build_statements, statement_count),
+        ('get_results_from_query', search_cold, len(QUERIES)),
+        ('get_results_from_query cached', search_cached,
+            len(QUERIES)),
+        ('format_details', format_all_details, len(details)),
+        ('format_details_2', format_all_details_2, len(details))]
+    # a database without courses leaves nothing to format
+    return ([benchmark for benchmark in benchmarks if benchmark[2]],
+        None)
+
+# returns the time batch() takes, in microseconds per call
+def _timed(batch, calls):
+    started = perf_counter()
+    batch()
+    return (perf_counter() - started) / calls * 1e6
+
+# returns the figures of batch, in microseconds per call, with its
+# ratio to the calibration
+def measure(batch, calls, warmup, repetitions):
+    for _ in range(warmup):
+        calibration_batch()
+        batch()
+    samples = []
+    ratios = []
+    # like timeit, keep the collector from landing in some samples
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repetitions):
+            calibration = _timed(calibration_batch, CALIBRATION_SIZE)
+            samples.append(_timed(batch, calls))
+            ratios.append(samples[-1] / calibration)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {'calls': calls, 'median_us': median(samples),
+        'mean_us': mean(samples),
+        'stdev_us': stdev(samples) if len(samples) > 1 else 0.0,
+        'min_us': min(samples), 'max_us': max(samples),
+        'ratio': median(ratios)}
+
+# runs the benchmarks named in names (None: all of them) against
+# database, which the helpers read as reg.sqlite in a directory of its
+# own; returns {name: figures} or {'error': err_message}
+def run_database(database, names, options):
+    path = abspath(join(HERE, database))
+    if not exists(path):
+        return {'error': 'No such database'}
+    previous = getcwd()
+    with TemporaryDirectory() as directory:
+        symlink(path, join(directory, DATABASE_PATH))
+        chdir(directory)
+        # pooled connections and cached results are another database's
+        dbpool.close_all()
+        overview_cache.clear()
+        try:
+            benchmarks, error = make_benchmarks(options['classes'])
+            if error is not None:
+                return {'error': error}
+            return {name: measure(batch, calls, options['warmup'],
+                options['repetitions'])
+                for name, batch, calls in benchmarks
+                if names is None or name in names}
+        finally:
+            dbpool.close_all()
+            overview_cache.clear()
+            chdir(previous)
+
+# adds to results, for each benchmark the baseline has, its ratio there
+# and how much the ratio changed; returns the names of the benchmarks
+# slower than the baseline by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for database, figures in results['databases'].items():
+        before = baseline.get('databases', {}).get(database, {})
+        for name, current in figures.items():
+            if name == 'error' or 'ratio' not in before.get(name, {}):
+                continue
+            base_ratio = before[name]['ratio']
+            current['baseline_ratio'] = base_ratio
+            current['change'] = (current['ratio'] / base_ratio - 1
+                if base_ratio else 0.0)
+            current['regressed'] = current['change'] > threshold
+            if current['regressed']:
+                regressions.append('{} {}'.format(database, name))
+    return regressions
+
+def _number(value, spec='{:.2f}'):
+    return '-' if value is None else spec.format(value)
+
+def print_results(results):
+    print('calibration: {} us per number formatted'.format(
+        _number(results['calibration']['median_us'], '{:.3f}')))
+    for database, figures in results['databases'].items():
+        print(database)
+        if 'error' in figures:
+            print('  not measured: {}'.format(figures['error']))
+            continue
+        print('  {:<31}{:>6}{:>11}{:>10}{:>10}{:>9}{:>9}{:>9}'.format(
+            'benchmark', 'calls', 'median us', 'mean us', 'stdev us',
+            'ratio', 'base', 'change'))
+        for name, current in figures.items():
+            change = current.get('change')
+            print('  {:<31}{:>6}{:>11}{:>10}{:>10}{:>9}{:>9}{:>9}'
+                '{}'.format(name, current['calls'],
+                _number(current['median_us']),
+                _number(current['mean_us']),
+                _number(current['stdev_us']),
+                _number(current['ratio']),
+                _number(current.get('baseline_ratio')),
+                _number(None if change is None else change * 100,
+                    '{:+.1f}%'),
+                '  REGRESSION' if current.get('regressed') else ''))
+
+# returns the baseline saved at path, or None if there is none to
+# compare against; exits if it cannot be read
+def load_baseline(path):
+    if not exists(path):
+        return None
+    try:
+        with open(path, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    except (OSError, ValueError) as ex:
+        print('Could not read the baseline: {}'.format(ex),
+            file=stderr)
+        exit(1)
+    if 'calibration' not in baseline:
+        print('The baseline has no calibration; save a new one with '
+            '--save', file=stderr)
+        return None
+    if baseline.get('python') != python_version():
+        print('The baseline was made with Python {}'.format(
+            baseline.get('python')), file=stderr)
+    return baseline
+
+# saves results, without their comparison to a baseline, at path;
+# exits if it cannot be written
+def save_baseline(results, path):
+    for figures in results['databases'].values():
+        for current in figures.values():
+            if isinstance(current, dict):
+                for key in ('baseline_ratio', 'change', 'regressed'):
+                    current.pop(key, None)
+    try:
+        with open(path, 'w', encoding='utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    except OSError as ex:
+        print('Could not save the baseline: {}'.format(ex),
+            file=stderr)
+        exit(1)
+    print('Saved the baseline to {}'.format(path), file=stderr)
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Microbenchmarks of the formatting, statement '
+            'building and search helpers, against a saved baseline',
+        allow_abbrev=False)
+
+    parser.add_argument('--databases', nargs='+', default=DATABASES,
+        metavar='database',
+        help='the databases to run against (default: %(default)s)')
+
+    parser.add_argument('--bench', action='append', dest='names',
+        metavar='benchmark',
+        help='''only run this benchmark, e.g. format_row (may be
+        repeated)''')
+
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP,
+        help='the untimed batches run before each benchmark')
+
+    parser.add_argument('--repetitions', type=int,
+        default=DEFAULT_REPETITIONS,
+        help='the timed batches per benchmark')
+
+    parser.add_argument('--classes', type=int, default=DEFAULT_CLASSES,
+        help='the number of classes to format details for')
+
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+        metavar='file',
+        help='''the baseline to compare against, if it exists
+        (default: %(default)s)''')
+
+    parser.add_argument('--save', action='store_true',
+        help='save this run as the baseline')
+
+    parser.add_argument('--threshold', type=float,
+        default=DEFAULT_THRESHOLD, metavar='fraction',
+        help='''flag medians more than this much slower than the
+        baseline, e.g. 0.1 for 10%%''')
+
+    parser.add_argument('--json', action='store_true',
+        help='print the figures as JSON')
+
+    args = parser.parse_args()
+
+    if args.warmup < 0 or args.repetitions < 1 or args.classes < 1:
+        print('Warmup must not be negative; repetitions and classes '
+            'must be positive', file=stderr)
+        exit(1)
+
+    baseline = load_baseline(args.baseline)
+
+    options = {'warmup': args.warmup,
+        'repetitions': args.repetitions, 'classes': args.classes}
+    results = dict(options, python=python_version(),
+        threshold=args.threshold, databases={},
+        calibration=measure(calibration_batch, CALIBRATION_SIZE,
+            args.warmup, args.repetitions))
+    for database in args.databases:
+        results['databases'][database] = run_database(database,
+            args.names, options)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results)
+        if baseline is None:
+            print('No baseline at {}'.format(args.baseline))
+        elif regressions:
+            print('Slower than the baseline by more than {:.0f}%: '
+                '{}'.format(args.threshold * 100,
+                ', '.join(regressions)))
+
+    if args.save:
+        save_baseline(results, args.baseline)
+
+    if regressions:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_listview.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import argv, exit, stderr
+import argparse
+from time import perf_counter
+from PyQt5.QtWidgets import QApplication
+from reg import init_list_view, update_view
+
+# ----------------------------------------------------------------------
+
+# a catalog of count made-up classes, shaped like the server's rows
+def synthetic_rows(count):
+    return [(i, 'D{:02d}'.format(i % 97), str(100 + i % 400),
+        'QR' if i % 3 else '', 'Synthetic Class Number {}'.format(i))
+        for i in range(count)]
+
+# true if the last row of list_view is on screen
+def is_at_end(list_view):
+    model = list_view.model()
+    last = model.index(model.rowCount() - 1)
+    return list_view.viewport().rect().intersects(
+        list_view.visualRect(last))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Time the class list on a large synthetic result',
+        allow_abbrev=False)
+
+    parser.add_argument('--rows', type=int, default=100000,
+        help='the number of classes in the result')
+
+    parser.add_argument('--updates', type=int, default=20,
+        help='the number of times the whole result is replaced')
+
+    parser.add_argument('--steps', type=int, default=200,
+        help='the number of steps to scroll to the end in')
+
+    args = parser.parse_args()
+
+    app = QApplication(argv)
+    list_view = init_list_view()
+    list_view.resize(800, 600)
+    list_view.show()
+    rows = synthetic_rows(args.rows)
+
+    # replacing the result, and painting what is on screen
+    worst = 0.0
+    for _ in range(args.updates):
+        start = perf_counter()
+        update_view(list_view, rows)
+        list_view.grab()
+        worst = max(worst, perf_counter() - start)
+    print('update and paint: worst {:.1f} ms'.format(worst * 1e3))
+
+    # scrolling to the end a step at a time, as a user dragging the
+    # scroll bar would
+    model = list_view.model()
+    if model.rowCount() != args.rows:
+        print('only {} of {} rows listed'.format(model.rowCount(),
+            args.rows), file=stderr)
+        exit(1)
+    scroll_bar = list_view.verticalScrollBar()
+    worst = 0.0
+    steps = 0
+    start_all = perf_counter()
+    # a view that lays out its rows in batches may still be growing
+    # the scroll bar, so go on until the last row is on screen
+    while steps < args.steps or not is_at_end(list_view):
+        steps += 1
+        start = perf_counter()
+        scroll_bar.setValue(scroll_bar.maximum()
+            * min(steps, args.steps) // args.steps)
+        app.processEvents()
+        list_view.grab()
+        worst = max(worst, perf_counter() - start)
+    print('scroll to end: {} steps in {:.1f} ms, worst step '
+        '{:.1f} ms'.format(steps, (perf_counter() - start_all) * 1e3,
+            worst * 1e3))
+
+if __name__ == '__main__':
+    main()
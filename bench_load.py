@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_load.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr, executable
+import argparse
+import json
+import shlex
+from os import killpg
+from os.path import dirname, abspath, join
+from signal import SIGTERM, SIGKILL
+from string import ascii_lowercase
+from random import Random
+from uuid import uuid4
+from time import monotonic, sleep
+from threading import Thread, Event, Lock
+from contextlib import contextmanager, closing
+from subprocess import Popen, DEVNULL, TimeoutExpired
+from tempfile import TemporaryFile
+from socket import create_connection
+from sqlite3 import connect
+from reghelpers import DATABASE_URL
+from regreplay import RegTarget, HttpTarget, percentile, QUANTILES
+from regreplay import DEFAULT_TIMEOUT
+
+# ----------------------------------------------------------------------
+# Load test: users typing searches into the dept, number, area and
+# title fields, a request per keystroke, and now and then opening the
+# details of the class they were after, against each server mode in
+# turn. Each user waits for one answer before sending the next request,
+# but its keystrokes keep their own time: a request's latency counts
+# from when the user typed it, so time spent behind a slow answer to an
+# earlier keystroke is counted too.
+# ----------------------------------------------------------------------
+
+HERE = dirname(abspath(__file__))
+
+# how each server is started: its directory, its arguments, and true
+# if it is the Flask app. The reg server's modes also get the delay
+# and --server-args.
+SERVERS = {
+    'prefork': ('.', ['regserver.py', '{port}', '{delay}', '--mode',
+        'prefork'], False),
+    'fork': ('.', ['regserver.py', '{port}', '{delay}', '--mode',
+        'fork'], False),
+    'asyncio': ('.', ['regserver.py', '{port}', '{delay}', '--mode',
+        'asyncio'], False),
+    'serial': ('A2', ['regserver.py', '{port}'], False),
+    'flask': ('A4', ['runserver.py', '{port}'], True),
+}
+
+DEFAULT_BASE_PORT = 55200
+
+# how long a server may take to start listening, in seconds
+START_TIMEOUT = 60.0
+
+# how often each field is typed in a search; a search types at least
+# the dept
+FIELD_ODDS = (('d', 0.6), ('n', 0.35), ('a', 0.1), ('t', 0.4))
+
+# the time between keystrokes: mean and standard deviation, and the
+# shortest, in seconds
+KEYSTROKE_MEAN = 0.18
+KEYSTROKE_DEVIATION = 0.06
+KEYSTROKE_MIN = 0.04
+
+# the pause before typing into another field, in seconds
+FIELD_PAUSE = (0.4, 0.9)
+
+# how long a user looks at the results before opening details, and
+# on average between searches, in seconds
+DETAIL_PAUSE = (0.5, 2.0)
+THINK_MEAN = 2.0
+
+DEFAULT_TYPO_RATE = 0.03
+
+# rows in each page of results, as both clients ask for
+DEFAULT_PAGE_SIZE = 500
+
+# returns every (classid, dept, coursenum, area, title) in the catalog
+def load_catalog(database_url=DATABASE_URL):
+    with closing(connect(database_url, uri=True)) as connection:
+        return connection.execute('''SELECT classes.classid,
+            crosslistings.dept, crosslistings.coursenum, courses.area,
+            courses.title FROM classes, crosslistings, courses
+            WHERE classes.courseid = crosslistings.courseid
+            AND classes.courseid = courses.courseid''').fetchall()
+
+# returns what a user looking for row types: a list of (field, text)
+def search_terms(rng, row):
+    _, dept, coursenum, area, title = row
+    terms = []
+    for field, odds in FIELD_ODDS:
+        if rng.random() >= odds:
+            continue
+        if field == 'd':
+            terms.append(('d', dept.lower()))
+        elif field == 'n':
+            terms.append(('n', coursenum[:rng.randint(1,
+                len(coursenum))]))
+        elif field == 'a' and area:
+            terms.append(('a', area.lower()))
+        elif field == 't':
+            words = [word for word in title.lower().split()
+                if len(word) >= 3]
+            if words:
+                word = rng.choice(words)
+                terms.append(('t', word[:rng.randint(3, len(word))]))
+    return terms or [('d', dept.lower())]
+
+# returns the keystrokes of a search for row: a list of (seconds since
+# the previous keystroke, the fields after it). A typo is typed and
+# then deleted, each a keystroke of its own.
+def search_keystrokes(rng, row, typo_rate=DEFAULT_TYPO_RATE):
+    fields = {'d': '', 'n': '', 'a': '', 't': ''}
+    keystrokes = []
+
+    def type_key(field, text, pause=0.0):
+        fields[field] = text
+        keystrokes.append((pause + max(KEYSTROKE_MIN, rng.gauss(
+            KEYSTROKE_MEAN, KEYSTROKE_DEVIATION)), dict(fields)))
+
+    for position, (field, text) in enumerate(search_terms(rng, row)):
+        pause = rng.uniform(*FIELD_PAUSE) if position else 0.0
+        for end in range(1, len(text) + 1):
+            if rng.random() < typo_rate:
+                type_key(field, text[:end - 1] + rng.choice(
+                    ascii_lowercase), pause)
+                type_key(field, text[:end - 1])
+                pause = 0.0
+            type_key(field, text[:end], pause)
+            pause = 0.0
+    return keystrokes
+
+# ----------------------------------------------------------------------
+
+# how a user types: waits are multiplied by pace (0: none), and with
+# debounce seconds a keystroke only sends a search if no other follows
+# that soon, as the PyQt client does (the web page sends every one)
+USER_OPTIONS = {'pace': 1.0, 'debounce': 0.0, 'detail_ratio': 0.3,
+    'page_size': None, 'typo_rate': DEFAULT_TYPO_RATE,
+    'timeout': DEFAULT_TIMEOUT}
+
+# the requests of one load test: the users type for warmup seconds,
+# and then for duration seconds in which the requests that fall due
+# are measured
+class LoadRun:
+
+    def __init__(self, duration, warmup=0.0):
+        self._duration = duration
+        self._warmup = warmup
+        self._records = []
+        self._lock = Lock()
+        self._stop = Event()
+
+    # counts a request of kind that was due at the time.monotonic()
+    # time due and done at done
+    def record(self, kind, due, done, outcome):
+        with self._lock:
+            self._records.append((kind, due, done, outcome))
+
+    def is_over(self):
+        return self._stop.is_set()
+
+    # waits for seconds, or until the run is over
+    def wait(self, seconds):
+        self._stop.wait(seconds)
+
+    # runs threads, the users, for the whole run; returns the figures
+    # of the requests due in the measured period
+    def run(self, threads):
+        began = monotonic()
+        for thread in threads:
+            thread.start()
+        sleep(self._warmup + self._duration)
+        self._stop.set()
+        for thread in threads:
+            thread.join(DEFAULT_TIMEOUT)
+
+        measured_from = began + self._warmup
+        with self._lock:
+            measured = [record for record in self._records
+                if measured_from <= record[1]
+                < measured_from + self._duration]
+        return summarize(measured, self._duration)
+
+# one user's searches during load_run; options override USER_OPTIONS
+class TypingUser:
+
+    def __init__(self, rng, catalog, target, load_run, **options):
+        self._rng = rng
+        self._catalog = catalog
+        self._target = target
+        self._load_run = load_run
+        self._options = dict(USER_OPTIONS, **options)
+        self._session = uuid4().hex
+        # when the user's last action was due
+        self._clock = None
+
+    # waits until the time.monotonic() time due, or the end of the run
+    def _wait_until(self, due):
+        self._load_run.wait(max(0.0, due - monotonic()))
+
+    # the next action is due seconds (times pace) after the last one;
+    # without pauses, it is due as soon as the last one is done
+    def _after(self, seconds):
+        if self._options['pace']:
+            self._clock += seconds * self._options['pace']
+        else:
+            self._clock = monotonic()
+        self._wait_until(self._clock)
+
+    def _send(self, connection, kind, query, due):
+        outcome = self._target.send(connection, query,
+            self._options['timeout'])
+        self._load_run.record(kind, due, monotonic(), outcome)
+
+    # types a search for a random class on connection, and now and
+    # then opens its details
+    def search(self, connection):
+        options = self._options
+        row = self._rng.choice(self._catalog)
+        keystrokes = search_keystrokes(self._rng, row,
+            options['typo_rate'])
+        for position, (gap, fields) in enumerate(keystrokes):
+            self._after(gap)
+            if self._load_run.is_over():
+                return
+            following = (keystrokes[position + 1][0]
+                if position + 1 < len(keystrokes) else None)
+            if (following is not None
+                    and following < options['debounce']):
+                continue
+            due = self._clock + options['debounce'] * options['pace']
+            self._wait_until(due)
+            query = dict(fields, session=self._session)
+            if options['page_size']:
+                query.update(limit=options['page_size'], total=True)
+            self._send(connection, 'overviews', query, due)
+
+        if self._rng.random() < options['detail_ratio']:
+            self._after(self._rng.uniform(*DETAIL_PAUSE))
+            if not self._load_run.is_over():
+                self._send(connection, 'details',
+                    {'class_id': row[0]}, self._clock)
+
+    def run(self):
+        connection = self._target.connect()
+        self._clock = monotonic()
+        try:
+            while not self._load_run.is_over():
+                self.search(connection)
+                self._after(min(self._rng.expovariate(1 / THINK_MEAN),
+                    4 * THINK_MEAN))
+        finally:
+            self._target.close(connection)
+
+# runs users simulated users, seeded from seed, against target for the
+# whole of load_run; returns the figures it measured
+def run_load(target, catalog, load_run, users, seed, **options):
+    return load_run.run([Thread(target=TypingUser(Random(seed + number),
+        catalog, target, load_run, **options).run, daemon=True)
+        for number in range(users)])
+
+def summarize(records, duration):
+    to_return = {'requests': len(records),
+        'errors': sum(1 for record in records if record[3] != 'ok'),
+        'throughput': len(records) / duration}
+    for kind in ('overviews', 'details', 'all'):
+        latencies = sorted((record[2] - record[1]) * 1000
+            for record in records if kind in ('all', record[0]))
+        to_return[kind] = {'requests': len(latencies)}
+        for fraction in QUANTILES:
+            to_return[kind]['p{}'.format(round(fraction * 100))] = (
+                percentile(latencies, fraction))
+    return to_return
+
+# ----------------------------------------------------------------------
+
+# waits until something listens at port on this host, while process
+# runs
+def wait_for_port(port, process, timeout=START_TIMEOUT):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            create_connection(('localhost', port), timeout=1).close()
+            return True
+        except OSError:
+            sleep(0.1)
+    return False
+
+# with running_server(mode, port, ...): ... runs the server of mode at
+# port for the block; raises RuntimeError with the end of its output if
+# it does not start
+@contextmanager
+def running_server(mode, port, delay=0, server_args=()):
+    directory, args, _ = SERVERS[mode]
+    args = [arg.format(port=port, delay=delay) for arg in args]
+    if directory == '.':
+        args += list(server_args)
+    with TemporaryFile() as output:
+        # in a session of its own, so its workers can be stopped too
+        process = Popen([executable] + args, cwd=join(HERE, directory),
+            stdin=DEVNULL, stdout=DEVNULL, stderr=output,
+            start_new_session=True)
+        try:
+            if not wait_for_port(port, process):
+                output.seek(0)
+                lines = output.read().decode(errors='replace').strip()
+                raise RuntimeError('the {} server did not start: {}'
+                    .format(mode, lines.splitlines()[-1] if lines
+                        else 'no output'))
+            yield
+        finally:
+            _stop_server(process)
+
+def _stop_server(process):
+    try:
+        killpg(process.pid, SIGTERM)
+        process.wait(5)
+    except ProcessLookupError:
+        pass
+    except TimeoutExpired:
+        killpg(process.pid, SIGKILL)
+        process.wait()
+
+def _ms(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+def print_results(results):
+    print('{:<10}{:<11}{:>9}{:>8}{:>9}{:>9}{:>9}{:>9}'.format('mode',
+        'requests', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for mode, figures in results.items():
+        if 'error' in figures:
+            print('{:<10}{}'.format(mode, figures['error']))
+            continue
+        for kind in ('all', 'overviews', 'details'):
+            latency = figures[kind]
+            first = kind == 'all'
+            print('{:<10}{:<11}{:>9}{:>8}{:>9}{:>9}{:>9}{:>9}'.format(
+                mode if first else '', kind, latency['requests'],
+                figures['errors'] if first else '',
+                '{:.1f}'.format(figures['throughput']) if first
+                    else '',
+                _ms(latency['p50']), _ms(latency['p95']),
+                _ms(latency['p99'])))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='''Throughput and latency of each server mode under
+        simulated users typing searches''',
+        allow_abbrev=False)
+
+    parser.add_argument('--modes', nargs='+', choices=list(SERVERS),
+        default=list(SERVERS), metavar='mode',
+        help='''the servers to start and measure in turn, of {}
+        (default: all)'''.format(', '.join(SERVERS)))
+
+    parser.add_argument('--port', type=int, default=None,
+        help='''measure the server already listening at this port
+        instead of starting any''')
+
+    parser.add_argument('--host', default='localhost',
+        help='the host of the server given by --port')
+
+    parser.add_argument('--http', action='store_true',
+        help='the server given by --port is the Flask app')
+
+    parser.add_argument('--users', type=int, default=10,
+        help='the number of users typing at once')
+
+    parser.add_argument('--duration', type=float, default=20.0,
+        metavar='seconds', help='how long to measure each server')
+
+    parser.add_argument('--warmup', type=float, default=3.0,
+        metavar='seconds',
+        help='how long the users type before measuring starts')
+
+    parser.add_argument('--detail-ratio', type=float, default=0.3,
+        metavar='fraction',
+        help='the share of searches after which details are opened')
+
+    parser.add_argument('--pace', type=float, default=1.0,
+        help='''multiplies every pause between a user's actions (0:
+        send requests back to back)''')
+
+    parser.add_argument('--debounce-ms', type=float, default=0.0,
+        metavar='milliseconds',
+        help='''only search once typing has paused this long (the PyQt
+        client waits 150 ms; the web page does not wait)''')
+
+    parser.add_argument('--page-size', type=int,
+        default=DEFAULT_PAGE_SIZE, metavar='rows',
+        help='rows per page of results (0: the whole result)')
+
+    parser.add_argument('--typo-rate', type=float,
+        default=DEFAULT_TYPO_RATE, metavar='fraction',
+        help='the share of keystrokes that are typed wrong and deleted')
+
+    parser.add_argument('--delay', type=int, default=0,
+        help='the delay argument of the reg servers started')
+
+    parser.add_argument('--server-args', default='',
+        help='''more arguments for the reg servers started, e.g.
+        "--workers 4"''')
+
+    parser.add_argument('--base-port', type=int,
+        default=DEFAULT_BASE_PORT,
+        help='''the port of the first server started; the next ones
+        count up from it''')
+
+    parser.add_argument('--seed', type=int, default=1,
+        help='seeds what the users type, so runs can be compared')
+
+    parser.add_argument('--json', metavar='file',
+        help='also write the figures to this file as JSON')
+
+    args = parser.parse_args()
+
+    if args.users < 1 or args.duration <= 0 or args.pace < 0:
+        print('There must be a user, a duration and a pace that is '
+            'not negative', file=stderr)
+        exit(1)
+
+    try:
+        catalog = load_catalog()
+    except Exception as ex:
+        print(ex, file=stderr)
+        exit(1)
+
+    options = {'pace': args.pace, 'debounce': args.debounce_ms / 1000,
+        'detail_ratio': args.detail_ratio,
+        'page_size': args.page_size, 'typo_rate': args.typo_rate}
+
+    def measure(target):
+        return run_load(target, catalog,
+            LoadRun(args.duration, args.warmup), args.users, args.seed,
+            **options)
+
+    results = {}
+    if args.port is not None:
+        target = (HttpTarget if args.http else RegTarget)(args.host,
+            args.port)
+        results['flask' if args.http else 'reg'] = measure(target)
+    else:
+        for number, mode in enumerate(args.modes):
+            port = args.base_port + number
+            print('Measuring the {} server'.format(mode), file=stderr)
+            try:
+                with running_server(mode, port, args.delay,
+                        shlex.split(args.server_args)):
+                    target = (HttpTarget if SERVERS[mode][2]
+                        else RegTarget)('localhost', port)
+                    results[mode] = measure(target)
+            except RuntimeError as ex:
+                print(ex, file=stderr)
+                results[mode] = {'error': str(ex)}
+
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
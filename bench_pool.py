@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# bench_pool.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+from time import perf_counter
+from contextlib import closing
+from sqlite3 import connect
+from dbpool import pooled_connection, close_all
+from reghelpers import DATABASE_URL
+
+# ----------------------------------------------------------------------
+
+# a typical overview query, so the timings include statement work too
+QUERY_STR = '''SELECT classes.classid, crosslistings.dept,
+    crosslistings.coursenum, courses.area, courses.title
+    FROM classes, crosslistings, courses
+    WHERE classes.courseid = crosslistings.courseid
+    AND classes.courseid = courses.courseid
+    AND lower(crosslistings.dept) LIKE ? ESCAPE '\\' '''
+
+def run_query(connection):
+    with closing(connection.cursor()) as cursor:
+        cursor.execute(QUERY_STR, ['%cos%'])
+        return cursor.fetchall()
+
+# the way select_from_table worked before: a new connection per call
+def fresh_request(setup_times):
+    start = perf_counter()
+    with connect(DATABASE_URL, isolation_level=None,
+                 uri=True) as connection:
+        setup_times.append(perf_counter() - start)
+        run_query(connection)
+    connection.close()
+
+def pooled_request(setup_times):
+    start = perf_counter()
+    with pooled_connection(DATABASE_URL) as connection:
+        setup_times.append(perf_counter() - start)
+        run_query(connection)
+
+def measure(request, repetitions):
+    setup_times = []
+    start = perf_counter()
+    for _ in range(repetitions):
+        request(setup_times)
+    total = perf_counter() - start
+    setup_times.sort()
+    return (sum(setup_times) / len(setup_times),
+        setup_times[len(setup_times) // 2],
+        total / repetitions)
+
+def report(label, results):
+    mean, median, per_request = results
+    print('{:<8s} setup mean {:9.1f} us  median {:9.1f} us  '
+        'request {:9.1f} us'.format(label, mean * 1e6, median * 1e6,
+            per_request * 1e6))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Connection setup cost: fresh vs pooled',
+        allow_abbrev=False)
+
+    parser.add_argument('--repetitions', type=int, default=500,
+        help='the number of simulated requests per variant')
+
+    args = parser.parse_args()
+
+    try:
+        before = measure(fresh_request, args.repetitions)
+        after = measure(pooled_request, args.repetitions)
+        close_all()
+    except Exception as ex:
+        print(ex, file=stderr)
+        exit(1)
+
+    report('before', before)
+    report('after', after)
+    print('setup speedup: {:.1f}x'.format(before[0] / after[0]))
+
+if __name__ == '__main__':
+    main()
@@ -7,16 +7,31 @@
 
 from sys import exit, argv, stderr
 import argparse
-from socket import socket
-from pickle import dump, load
-from threading import Thread
-from queue import Queue, Empty
 from PyQt5.QtWidgets import QApplication, QFrame, QLabel, QMainWindow
 from PyQt5.QtWidgets import QGridLayout, QDesktopWidget, QVBoxLayout
 from PyQt5.QtWidgets import QHBoxLayout, QLineEdit
-from PyQt5.QtWidgets import QListWidget, QListWidgetItem, QMessageBox
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QListView, QMessageBox
+from PyQt5.QtCore import Qt, QTimer, QItemSelectionModel, QPoint
 from PyQt5.QtGui import QFont
+from regconnection import ServerConnection
+from regclientcache import ClientCache, DetailFetcher
+from regclientcache import DEFAULT_MAX_ENTRIES
+from regmirror import CatalogMirror
+from reglistmodel import OverviewModel
+from regscheduler import ResultSignal, SearchScheduler
+
+# ----------------------------------------------------------------------
+
+# how long the list has to stay put before details of the classes on
+# screen are prefetched, and for at most how many of them
+PREFETCH_DELAY_MS = 200
+DEFAULT_PREFETCH_ROWS = 20
+
+# how often a local catalog mirror asks the server what has changed
+MIRROR_SYNC_MS = 30000
+
+# how many rows the class list lays out at a time between events
+LAYOUT_BATCH_SIZE = 500
 
 # ----------------------------------------------------------------------
 # INIT GUI
@@ -74,7 +89,7 @@ def init_line_edits(line_edit_layout):
 
 
 # initialize the GUI elements
-def init_gui(args, queue):
+def init_gui(results, scheduler, fetcher, prefetch_rows):
     # layouts
     top_layout = QHBoxLayout()
     top_layout.setContentsMargins(10, 20, 10, 0)
@@ -98,25 +113,20 @@ def init_gui(args, queue):
             'a': area_edit.text(),
             't': title_edit.text()
         }
-        # send to server
-        call_server_update_data(query, False, args, queue)
+        # send to server once the user stops typing
+        scheduler.schedule(query)
 
     # slot to hangle when a class' cell is highlighted. Calls server to
     # query appropriate data
-    def class_select_slot(list_widget_item):
-        list_widget_row = list_widget_item.text().split(' ')
-        classid = ''
-        for item in list_widget_row:
-            if item != '':
-                classid = item
-                break
+    def class_select_slot(model_index):
+        classid = model_index.data(Qt.UserRole)
+        if classid is None:
+            return
 
-        query = {
-            'class_id': classid
-        }
-        # send to server
-        if len(list_widget_row) > 1:
-            call_server_update_data(query, True, args, queue)
+        # from the cache if we have them, else from the server
+        print('Sent command: get_details')
+        fetcher.fetch(classid, lambda result: results.arrived.emit(
+            (result[0], result[1], True, None)))
 
     # slots to handle events
     dept_edit.textChanged.connect(submit_slot)
@@ -124,9 +134,11 @@ def init_gui(args, queue):
     area_edit.textChanged.connect(submit_slot)
     title_edit.textChanged.connect(submit_slot)
 
-    list_view = QListWidget()
+    list_view = init_list_view()
     # slots to handle signals
-    list_view.itemActivated.connect(class_select_slot)
+    list_view.activated.connect(class_select_slot)
+    if prefetch_rows > 0:
+        init_prefetch(list_view, fetcher, prefetch_rows)
 
     layout = QGridLayout()
     layout.setContentsMargins(0, 0, 0, 0)
@@ -134,106 +146,160 @@ def init_gui(args, queue):
     layout.addWidget(list_view, 1, 0)
 
     # load initial data
-    call_server_update_data({
+    scheduler.send_now({
         'd': dept_edit.text(),
         'n': number_edit.text(),
         'a': area_edit.text(),
         't': title_edit.text()
-    },
-        False, args, queue)
+    })
 
     # returns tuple of GUI elements
     return layout, list_view
 
-# --------------------------------------------------------------------
-# THREAD HANDLING CODE
-
-# WorkerThread class - takes in params for call to server and makes
-# request on new thread
-class WorkerThread (Thread):
-
-    def __init__(self, host_details, query, is_class_details, queue):
-        Thread.__init__(self)
-        host, port = host_details
-        self._host = host
-        self._port = port
-        self._query = query
-        self._queue = queue
-        self._is_class_details = is_class_details
-
-    def run(self):
-        result = (0, 'Unsuccessful Query')
-        try:
-            with socket() as sock:
-                sock.connect((self._host, self._port))
-                out_flo = sock.makefile(mode='wb')
-                dump(self._query, out_flo)
-                out_flo.flush()
-
-                in_flo = sock.makefile(mode='rb')
-                result = load(in_flo)
-
-        except EOFError as err:
-            result = (0, str(err))
-
-        except Exception as ex:
-            result = (0, str(ex))
-
-        finally:
-            self._queue.put((result[0],
-                result[1], self._is_class_details))
+# fetches details of the classes on screen once list_view settles, so
+# opening one of them needs no round trip
+def init_prefetch(list_view, fetcher, prefetch_rows):
+    prefetch_timer = QTimer(list_view)
+    prefetch_timer.setSingleShot(True)
+    prefetch_timer.setInterval(PREFETCH_DELAY_MS)
+    prefetch_timer.timeout.connect(lambda: fetcher.prefetch(
+        visible_classids(list_view, prefetch_rows)))
+    list_view.verticalScrollBar().valueChanged.connect(
+        prefetch_timer.start)
+    list_view.model().modelReset.connect(prefetch_timer.start)
+    list_view.selectionModel().selectionChanged.connect(
+        prefetch_timer.start)
+
+# the list of classes: a view that only lays out and paints the rows
+# on screen, in one font, over an OverviewModel
+def init_list_view():
+    list_view = QListView()
+    list_view.setModel(OverviewModel())
+    list_view.setFont(QFont('Courier', 10))
+    # every row is one line of the same font, so the view can find
+    # rows by arithmetic instead of measuring each of them
+    list_view.setUniformItemSizes(True)
+    # the rows on screen are laid out at once and the rest a batch at
+    # a time between events, so a large result neither holds up the
+    # GUI when it arrives nor is laid out again as it is scrolled
+    list_view.setLayoutMode(QListView.Batched)
+    list_view.setBatchSize(LAYOUT_BATCH_SIZE)
+    return list_view
+
+# returns the classids of the selected rows and then of the rows on
+# screen, at most limit of them
+def visible_classids(list_view, limit):
+    model = list_view.model()
+    rows = [index.row()
+        for index in list_view.selectionModel().selectedIndexes()]
+    top = list_view.indexAt(QPoint(0, 0)).row()
+    if top >= 0:
+        bottom = list_view.indexAt(
+            QPoint(0, list_view.viewport().height() - 1)).row()
+        if bottom < 0:
+            bottom = model.rowCount() - 1
+        rows += range(top, bottom + 1)
+    classids = []
+    for row in rows:
+        classid = model.index(row).data(Qt.UserRole)
+        if classid is not None and classid not in classids:
+            classids.append(classid)
+    return classids[:limit]
 
 # --------------------------------------------------------------------
 # SERVER CALLING CODE
 
-# update the cells in the list view of classes
-def update_view(list_view, class_data):
-    list_view.clear()
+# returns a function asking scheduler for the page after page, or None
+# if page is the last one or there is no scheduler to ask
+def page_loader(scheduler, page):
+    if scheduler is None or page.get('cursor') is None:
+        return None
+    return lambda: scheduler.load_more(page['cursor'])
+
+# update the cells in the list view of classes; class_data is a list of
+# rows, text from an older server or the first page of them, whose
+# later pages are asked of scheduler
+def update_view(list_view, class_data, scheduler=None):
     if class_data is None:
-        return
-    for i, line in enumerate(class_data.split('\n')):
-        new_item = QListWidgetItem(line)
-        new_item.setFont(QFont('Courier', 10))
-        list_view.insertItem(i, new_item)
+        class_data = []
+    model = list_view.model()
+    if isinstance(class_data, dict):
+        model.set_rows(class_data['rows'],
+            page_loader(scheduler, class_data))
+    else:
+        model.set_rows(class_data)
 
     # auto-highlight an item
-    if list_view.count() > 0:
-        list_view.item(0).setSelected(True)
+    if model.rowCount() > 0:
+        list_view.selectionModel().select(model.index(0),
+            QItemSelectionModel.Select)
 
+# --------------------------------------------------------------------
+# RESULT HANDLING
 
-# calls server to retrieve class data, and updates class data displayed
-# in list view
-def call_server_update_data(query, is_class_details, args, queue):
-    print('Sent command: ', 'get_details'
-          if is_class_details else 'get_overviews')
-    worker_thread = WorkerThread(
-        (args.host, int(args.port)), query, is_class_details, queue)
-    worker_thread.start()
+# update the GUI with either class details or general class data output
+def show_result(result, window, list_view, scheduler):
+    return_status, update_text, is_class_details, generation = result
 
-# --------------------------------------------------------------------
-# POLL HANDLING
-
-# handle new additions to queue--new data from requests to server
-def poll_queue_helper(queue, window, list_view):
-
-    # while the queue has new data, update the GUI with either
-    # class details or general class data output
-    while True:
-        try:
-            return_status, update_text, is_class_details = queue.get(
-                    block=False)
-        except Empty:
-            break
-
-        if return_status:
-            if is_class_details:
-                QMessageBox.information(window,
-                                        'Class Details', update_text)
-            else:
-                update_view(list_view, update_text)
+    # results of a search the user has typed past
+    if not is_class_details and not scheduler.is_current(generation):
+        return
+
+    if return_status:
+        if is_class_details:
+            QMessageBox.information(window,
+                                    'Class Details', update_text)
         else:
-            QMessageBox.critical(window, 'Server Error',
-                str(update_text))
+            update_view(list_view, update_text, scheduler)
+            show_count(window, update_text)
+    else:
+        QMessageBox.critical(window, 'Server Error',
+            str(update_text))
+
+# adds a later page of the current search to the list view
+def show_page(result, window, list_view, scheduler):
+    return_status, page, generation = result
+    if not scheduler.is_current(generation):
+        return
+    if not return_status:
+        QMessageBox.critical(window, 'Server Error', str(page))
+        return
+    list_view.model().append_rows(page['rows'],
+        page_loader(scheduler, page))
+    # the end of a streamed result
+    if page.get('total') is not None:
+        show_count(window, page)
+
+# shows how many classes the search found, which the first page of a
+# paged result tells us before the rest of it arrives
+def show_count(window, class_data):
+    count = None
+    if isinstance(class_data, dict):
+        count = class_data.get('total')
+    elif isinstance(class_data, list):
+        count = len(class_data)
+    if count is None:
+        window.statusBar().clearMessage()
+    else:
+        window.statusBar().showMessage('{} classes'.format(count))
+
+# keeps mirror up to date for as long as window is open, and shows the
+# current search again whenever its contents change
+def start_mirror_sync(mirror, results, scheduler, window):
+    results.catalog_changed.connect(scheduler.refresh,
+        Qt.QueuedConnection)
+
+    def synced(changed):
+        if changed:
+            results.catalog_changed.emit()
+
+    def sync_mirror():
+        mirror.sync(synced)
+    sync_mirror()
+    sync_timer = QTimer(window)
+    sync_timer.timeout.connect(sync_mirror)
+    sync_timer.setInterval(MIRROR_SYNC_MS)
+    sync_timer.start()
 
 # --------------------------------------------------------------------
 # MAIN METHOD
@@ -251,6 +317,21 @@ def main():
     parser.add_argument('port', type=int, metavar="port",
                         help='show only those \
                             classes whose course number contains num')
+    parser.add_argument('--cache-file', metavar='file',
+                        help='keep cached results in file between runs')
+    parser.add_argument('--cache-size', type=int,
+                        default=DEFAULT_MAX_ENTRIES, metavar='entries',
+                        help='the most results to cache (0 disables)')
+    parser.add_argument('--prefetch', type=int,
+                        default=DEFAULT_PREFETCH_ROWS, metavar='rows',
+                        help='prefetch details of up to this many \
+                            classes on screen (0 disables)')
+    parser.add_argument('--stream', action='store_true',
+                        help='ask for whole results and show their \
+                            rows as they arrive, not a page at a time')
+    parser.add_argument('--mirror', action='store_true',
+                        help='download the catalog and search it \
+                            locally, syncing changes from the server')
 
     args = parser.parse_args()
 
@@ -259,19 +340,40 @@ def main():
     window = QMainWindow()
     window.setWindowTitle('Princeton University Class Search')
 
-    # create queue for multi-threaded behavior; pass it into GUI init
-    queue = Queue()
+    # results come back on the connection's reader thread and are
+    # handed to the GUI thread through this signal
+    results = ResultSignal()
+
+    # one connection to the server, shared by every request
+    connection = ServerConnection(args.host, args.port)
+
+    # results we have seen, checked against the server's catalog
+    # version before they are used
+    cache = ClientCache(connection, args.cache_size, args.cache_file)
+    app.aboutToQuit.connect(cache.save)
+    fetcher = DetailFetcher(connection, cache)
+
+    # with --mirror, searches are answered from a local copy of the
+    # catalog once it has arrived
+    mirror = CatalogMirror(connection) if args.mirror else None
+
+    # debounces and orders the searches
+    scheduler = SearchScheduler(connection, results, cache, mirror,
+        args.stream)
 
     # initialize GUI elements
-    layout, list_view = init_gui(args, queue)
-
-    # check poll every 100 milliseconds, update GUI with new poll data
-    def poll_queue():
-        poll_queue_helper(queue, window, list_view)
-    timer = QTimer()
-    timer.timeout.connect(poll_queue)
-    timer.setInterval(100)
-    timer.start()
+    layout, list_view = init_gui(results, scheduler, fetcher,
+        args.prefetch)
+
+    # show each result as soon as it arrives; queued explicitly since
+    # results are emitted from a thread Qt does not know about
+    results.arrived.connect(lambda result: show_result(result, window,
+        list_view, scheduler), Qt.QueuedConnection)
+    results.page_arrived.connect(lambda result: show_page(result,
+        window, list_view, scheduler), Qt.QueuedConnection)
+
+    if mirror is not None:
+        start_mirror_sync(mirror, results, scheduler, window)
 
     # final GUI init steps
     frame = QFrame()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regadmission.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+import asyncio
+from time import monotonic
+from heapq import heappush, heappop
+from itertools import count
+from multiprocessing import Condition, RawArray, RawValue
+from regbudget import DEADLINE_MSG, POLL_INTERVAL
+
+# ----------------------------------------------------------------------
+# Admission control: at most max_active requests do their work at once,
+# and at most max_queued more wait for a turn. Waiting requests go in
+# priority order, so a detail lookup is not stuck behind a burst of
+# overview searches typed by other clients. A request that finds the
+# queue full takes the place of the latest request of a lower priority
+# if there is one; otherwise it is answered at once with BUSY_MSG, which
+# tells the client when to try again.
+# ----------------------------------------------------------------------
+
+DETAILS_PRIORITY = 0
+OVERVIEWS_PRIORITY = 1
+# snapshots and deltas of the whole catalog
+CATALOG_PRIORITY = 2
+PRIORITY_NAMES = ('details', 'overviews', 'catalog')
+
+DEFAULT_MAX_QUEUED = 64
+
+BUSY_MSG = 'The server is busy; retry after {} ms'
+
+# bounds on the retry hint, in milliseconds
+MIN_RETRY_AFTER = 50
+MAX_RETRY_AFTER = 5000
+
+# the assumed time a request takes, in seconds, until one has finished
+DEFAULT_SERVICE_TIME = 0.1
+
+# the weight of the latest request in the average time requests take
+SERVICE_TIME_WEIGHT = 0.1
+
+# returns the priority of query, lower numbers first, or None for a
+# request that needs no turn: asking for the server's metrics is cheap,
+# and must get through when it is busy
+def query_priority(query):
+    if query.get('command') == 'stats':
+        return None
+    if query.get('command') in ('snapshot', 'delta'):
+        return CATALOG_PRIORITY
+    if 'class_id' in query:
+        return DETAILS_PRIORITY
+    return OVERVIEWS_PRIORITY
+
+# the counters below are kept in one array: the number of requests
+# working, then for each priority the number waiting, the number let
+# through, the number refused and the number that must give up their
+# place in the queue
+_PRIORITY_COUNT = len(PRIORITY_NAMES)
+_ACTIVE = 0
+_QUEUED = 1
+_ADMITTED = _QUEUED + _PRIORITY_COUNT
+_REJECTED = _ADMITTED + _PRIORITY_COUNT
+_EVICTED = _REJECTED + _PRIORITY_COUNT
+_COUNTER_COUNT = _EVICTED + _PRIORITY_COUNT
+
+class _AdmissionBase:
+
+    # counts is a sequence of _COUNTER_COUNT zeros and service_time
+    # holds the average time a request takes in its value
+    def __init__(self, max_active, max_queued, counts, service_time):
+        self._max_active = max(1, max_active)
+        self._max_queued = max(0, max_queued)
+        self._counts = counts
+        self._service_time = service_time
+
+    def _queued(self, below=_PRIORITY_COUNT):
+        return sum(self._counts[_QUEUED + priority]
+            for priority in range(below))
+
+    # true if a request of priority may start now, ahead of every
+    # request of that priority that is waiting already
+    def _may_start(self, priority, waiting=False):
+        return (self._counts[_ACTIVE] < self._max_active
+            and self._queued(priority + (0 if waiting else 1)) == 0)
+
+    # the lowest priority below priority that has requests waiting, or
+    # None
+    def _displaceable(self, priority):
+        for lower in range(_PRIORITY_COUNT - 1, priority, -1):
+            if self._counts[_QUEUED + lower]:
+                return lower
+        return None
+
+    # the answer for a request that cannot wait for a turn, telling the
+    # client when the queue should have room
+    def _busy(self):
+        per_request = self._service_time.value or DEFAULT_SERVICE_TIME
+        turns = (self._queued() + 1) / self._max_active
+        retry_after = round(per_request * turns * 1000)
+        return (False, BUSY_MSG.format(
+            min(max(retry_after, MIN_RETRY_AFTER), MAX_RETRY_AFTER)))
+
+    def _refuse(self, priority):
+        self._counts[_REJECTED + priority] += 1
+        return self._busy()
+
+    # frees a place in the queue, taken from a request of priority
+    def _displace(self, priority):
+        self._counts[_QUEUED + priority] -= 1
+        self._counts[_REJECTED + priority] += 1
+
+    def _start(self, priority):
+        self._counts[_ACTIVE] += 1
+        self._counts[_ADMITTED + priority] += 1
+
+    # ends the turn of a request that started at the time.monotonic()
+    # time started, or None if it did no work
+    def leave(self, started):
+        self._counts[_ACTIVE] -= 1
+        if started is None:
+            return
+        elapsed = monotonic() - started
+        if self._service_time.value:
+            self._service_time.value += SERVICE_TIME_WEIGHT * (
+                elapsed - self._service_time.value)
+        else:
+            self._service_time.value = elapsed
+
+    def stats(self):
+        to_return = {'active': self._counts[_ACTIVE],
+            'max_active': self._max_active,
+            'queued': self._queued(), 'max_queued': self._max_queued,
+            'rejected': sum(self._counts[_REJECTED + priority]
+                for priority in range(_PRIORITY_COUNT)),
+            'service_time': self._service_time.value}
+        for priority, name in enumerate(PRIORITY_NAMES):
+            to_return['queued_' + name] = self._counts[
+                _QUEUED + priority]
+            to_return['admitted_' + name] = self._counts[
+                _ADMITTED + priority]
+            to_return['rejected_' + name] = self._counts[
+                _REJECTED + priority]
+        return to_return
+
+# admission shared by the threads and processes of a server: made
+# before the workers are started, and passed to them
+class Admission(_AdmissionBase):
+
+    def __init__(self, max_active, max_queued=DEFAULT_MAX_QUEUED):
+        super().__init__(max_active, max_queued,
+            RawArray('q', _COUNTER_COUNT), RawValue('d', 0.0))
+        self._changed = Condition()
+
+    # waits for a turn to work on a request of priority. Returns None
+    # once it is the request's turn; the caller must then call
+    # leave(), passing the time.monotonic() time it started (or None
+    # if it did no work after all). Returns an error tuple if the queue
+    # is full, or if budget (see regbudget.py) runs out while the
+    # request waits.
+    def enter(self, priority, budget=None):
+        with self._changed:
+            if self._may_start(priority):
+                self._start(priority)
+                return None
+            refusal = self._join(priority)
+            if refusal is not None:
+                return refusal
+            return self._wait_turn(priority, budget,
+                lambda: self._may_start(priority, waiting=True))
+
+    # enter() in two steps, for a server that reads requests before it
+    # can work on them and orders them itself: counts a request of
+    # priority as waiting from the moment it is read. Returns None, or
+    # an error tuple if the queue is full. The request must then get
+    # its turn with start_queued(), or leave the queue with unqueue().
+    def queue(self, priority):
+        with self._changed:
+            return self._join(priority)
+
+    # waits for a free turn for a request queued with queue(); returns
+    # like enter(). Requests queued elsewhere are not waited for, since
+    # whoever queued them may be busy with something else.
+    def start_queued(self, priority, budget=None):
+        with self._changed:
+            return self._wait_turn(priority, budget,
+                lambda: self._counts[_ACTIVE] < self._max_active)
+
+    # takes a request queued with queue() out of the queue unanswered
+    def unqueue(self, priority):
+        with self._changed:
+            if self._counts[_EVICTED + priority]:
+                # its place was given to another request already
+                self._counts[_EVICTED + priority] -= 1
+            else:
+                self._counts[_QUEUED + priority] -= 1
+            self._changed.notify_all()
+
+    # counts a request of priority as waiting, unless the queue is full
+    # and it cannot take the place of a lower priority one; then
+    # returns the error tuple that refuses it
+    def _join(self, priority):
+        if self._queued() >= self._max_queued:
+            lower = self._displaceable(priority)
+            if lower is None:
+                return self._refuse(priority)
+            # whichever request of that priority looks first goes
+            self._displace(lower)
+            self._counts[_EVICTED + lower] += 1
+            self._changed.notify_all()
+        self._counts[_QUEUED + priority] += 1
+        return None
+
+    # waits until may_start() is true, then starts the queued request
+    def _wait_turn(self, priority, budget, may_start):
+        queued = True
+        try:
+            while True:
+                if self._counts[_EVICTED + priority]:
+                    self._counts[_EVICTED + priority] -= 1
+                    # _displace() has taken it out of the queue
+                    queued = False
+                    return self._busy()
+                if may_start():
+                    break
+                reason = None if budget is None else budget.check()
+                if reason is not None:
+                    return (False, reason)
+                self._changed.wait(POLL_INTERVAL)
+        finally:
+            if queued:
+                self._counts[_QUEUED + priority] -= 1
+        self._start(priority)
+        return None
+
+    def leave(self, started):
+        with self._changed:
+            super().leave(started)
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._changed:
+            return super().stats()
+
+# admission for the requests of one event loop
+class AsyncAdmission(_AdmissionBase):
+
+    def __init__(self, max_active, max_queued=DEFAULT_MAX_QUEUED):
+        super().__init__(max_active, max_queued,
+            [0] * _COUNTER_COUNT, RawValue('d', 0.0))
+        # (priority, arrival, future) for each waiting request
+        self._waiting = []
+        self._arrivals = count()
+
+    # like Admission.enter(), but gives up once the time.monotonic()
+    # time deadline passes (None: never)
+    async def enter(self, priority, deadline=None):
+        if self._may_start(priority):
+            self._start(priority)
+            return None
+        if self._queued() >= self._max_queued:
+            lower = self._displaceable(priority)
+            if lower is None:
+                return self._refuse(priority)
+            # the latest request of that priority goes
+            _, _, victim = max(entry for entry in self._waiting
+                if entry[0] == lower and not entry[2].done())
+            self._displace(lower)
+            victim.set_result(self._busy())
+        future = asyncio.get_running_loop().create_future()
+        heappush(self._waiting, (priority, next(self._arrivals),
+            future))
+        self._counts[_QUEUED + priority] += 1
+        timeout = None if deadline is None else max(0.0,
+            deadline - monotonic())
+        try:
+            # shielded, so a timeout leaves the future for us to check
+            return await asyncio.wait_for(asyncio.shield(future),
+                timeout)
+        except asyncio.TimeoutError:
+            return self._give_up(priority, future, (False,
+                DEADLINE_MSG))
+        except asyncio.CancelledError:
+            self._give_up(priority, future, None)
+            raise
+
+    # takes a request that stopped waiting out of the queue; if it was
+    # given its turn just then, passes the turn on
+    def _give_up(self, priority, future, result):
+        if future.done():
+            if future.result() is None:
+                self.leave(None)
+        else:
+            future.cancel()
+            self._counts[_QUEUED + priority] -= 1
+        return result
+
+    def leave(self, started):
+        super().leave(started)
+        while self._waiting and self._counts[_ACTIVE] < (
+                self._max_active):
+            priority, _, future = heappop(self._waiting)
+            # requests that gave up stay in the heap until now
+            if future.done():
+                continue
+            self._counts[_QUEUED + priority] -= 1
+            self._start(priority)
+            future.set_result(None)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# reganswer.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from time import thread_time
+from reghelpers import get_results_from_query as get_overview
+from reghelpers import get_results_refined, get_page
+from reghelpers import get_snapshot, get_delta
+from reghelpers import stream_results_from_query
+from regmetrics import timed, get_metrics
+from regbudget import applied
+from regdetails import get_table_results
+from regprotocol import PROTOCOL_VERSION, ROWS_VERSION, STREAM_VERSION
+from regformat import row_array_to_string
+
+# ----------------------------------------------------------------------
+
+# iterations of the delay loop between checks of the request's budget
+BUDGET_CHECK_ITERATIONS = 10000
+
+NO_METRICS_MSG = 'The server keeps no metrics'
+
+# ----------------------------------------------------------------------
+# uses this thread's CPU time, so concurrent requests served by threads
+# of one process each get their full delay. Stops early if budget (see
+# regbudget.py) runs out; returns why, or None.
+def consume_cpu_time(delay, budget=None):
+
+    i = 0
+    initial_time = thread_time()
+    while (thread_time() - initial_time) < delay:
+        i += 1  # Do a nonsensical computation.
+        if (budget is not None and i % BUDGET_CHECK_ITERATIONS == 0
+                and budget.check() is not None):
+            break
+    return None if budget is None else budget.check()
+
+# returns (True, results) if succceeds, (False, err_message) if fails.
+# Work stops as soon as budget runs out, and none is done for a request
+# whose deadline has already passed.
+def handle_query(query, delay, version=PROTOCOL_VERSION, budget=None):
+    # asking for the server's metrics is not part of the work it
+    # simulates
+    if query.get("command") == "stats":
+        return answer_query(query, version)
+    with applied(budget):
+        reason = consume_cpu_time(delay, budget)
+        if reason is not None:
+            return (False, reason)
+        return answer_query(query, version)
+
+# clients older than ROWS_VERSION get overviews as text. An overview
+# query with a 'limit' gets one page of its results, see regpage.py.
+def answer_query(query, version):
+    command = query.get("command")
+    # snapshot: the whole catalog, for clients that search it locally
+    if command == "snapshot":
+        print("Received command: snapshot")
+        to_return = get_snapshot()
+    # delta: what changed in the catalog since a snapshot
+    elif command == "delta":
+        print("Received command: delta")
+        to_return = get_delta(query.get("since"))
+    # stats: the server's metrics, see regmetrics.py
+    elif command == "stats":
+        print("Received command: stats")
+        metrics = get_metrics()
+        to_return = (metrics.snapshot() if metrics is not None
+            else (False, NO_METRICS_MSG))
+    # get_detail
+    elif "class_id" in query:
+        print("Received command: get_detail")
+        to_return = get_table_results(query["class_id"])
+    # get_overviews
+    else:
+        print("Received command: get_overviews")
+        # a client typing a search names its session, so each query
+        # can narrow the last one's result
+        if query.get("limit") is not None:
+            to_return = get_page(query, query.get("cursor"),
+                query["limit"], bool(query.get("total")),
+                query.get("session"))
+        elif query.get("session") is not None:
+            to_return = get_results_refined(query, query["session"])
+        else:
+            to_return = get_overview(query)
+        if version < ROWS_VERSION and isinstance(to_return, list):
+            with timed('format'):
+                to_return = row_array_to_string(to_return)
+        elif version < ROWS_VERSION and isinstance(to_return, dict):
+            # the page may be cached; leave it be
+            with timed('format'):
+                to_return = dict(to_return,
+                    rows=row_array_to_string(to_return['rows']))
+
+    # if request was successful, turn it into a tuple
+    # (if it failed, it is already a tuple)
+    if not isinstance(to_return, tuple):
+        to_return = (True, to_return)
+    return to_return
+
+# returns a generator of the batches of rows answering query, ending
+# with an error tuple if reading fails, if the client asked for them to
+# be streamed; else None, and the query goes to handle_query
+def stream_query(query, delay, version=PROTOCOL_VERSION, budget=None):
+    if (version < STREAM_VERSION or query.get("stream") is not True
+            or query.get("command") is not None or "class_id" in query
+            or query.get("limit") is not None):
+        return None
+    return stream_overviews(query, delay, budget)
+
+def stream_overviews(query, delay, budget):
+    with applied(budget):
+        reason = consume_cpu_time(delay, budget)
+    if reason is not None:
+        yield (False, reason)
+        return
+    print("Received command: get_overviews (streamed)")
+    batches = stream_results_from_query(query,
+        session_id=query.get("session"))
+    try:
+        while True:
+            # the budget applies to whichever thread reads the batch,
+            # and only while it does
+            with applied(budget), timed('db'):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+    finally:
+        batches.close()
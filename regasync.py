@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regasync.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr, exit
+import asyncio
+from time import monotonic, perf_counter
+from signal import signal, SIGTERM
+from socket import IPPROTO_TCP, TCP_NODELAY
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pickle import dumps
+from regprotocol import is_hello, encode_hello, decode_hello
+from regprotocol import encode_response, read_frame_async
+from regprotocol import encode_chunk
+from regprotocol import choose_version, loads_plain
+from regprotocol import is_cancel, ProtocolError
+from regprotocol import HELLO_SIZE, LEGACY_VERSION
+from regbudget import QueryBudget, deadline_after
+from regadmission import query_priority
+from regmetrics import call_measured, add_timings, in_progress, observe
+from reglog import log_request
+from reghelpers import catalog_version
+
+# ----------------------------------------------------------------------
+
+# clients send one small pickled dict; anything bigger is not a client
+MAX_REQUEST_BYTES = 65536
+
+# requests a framed connection may have in progress at once
+MAX_IN_FLIGHT = 32
+
+# reads one pickled request from reader. The one-shot protocol has no
+# length prefix and clients keep their end open while they wait, so we
+# unpickle whatever has arrived until it forms a complete object. Only
+# plain data is unpickled; raises ProtocolError for anything else.
+async def read_pickled(reader, data=b''):
+    while True:
+        try:
+            return loads_plain(data)
+        except ProtocolError:
+            raise
+        except Exception:
+            pass
+        if len(data) > MAX_REQUEST_BYTES:
+            return None
+        chunk = await reader.read(4096)
+        if not chunk:
+            return None
+        data += chunk
+
+# serves client sockets from a single event loop. Blocking database
+# work goes to a bounded executor, so thousands of mostly idle clients
+# need neither a process nor a thread each.
+class AsyncServer:
+
+    # handler(query, delay, version, budget) returns the response tuple
+    # for a client speaking that protocol version, giving up once the
+    # request's QueryBudget runs out; with a process executor it must be
+    # a module-level function. Pickled requests are loaded as plain
+    # data only. streamer(query, delay, version, budget), if given,
+    # returns a generator of the batches of rows to stream in answer to
+    # query (ending with an error tuple if reading fails), or None if
+    # query is not to be streamed; its batches are read by the
+    # executor's threads one at a time. settings (see
+    # reghandler.make_settings()) give the delay, the SQLite steps a
+    # request may run and the AsyncAdmission, if any, requests wait for
+    # before they go to the executor. A request that is cancelled, or
+    # whose client hangs up, is stopped in a thread executor too;
+    # process workers only see deadlines and step limits.
+    def __init__(self, server_sock, handler, executor, settings,
+                 streamer=None):
+        self._server_sock = server_sock
+        self._handler = handler
+        self._executor = executor
+        self._settings = settings
+        self._streamer = streamer
+
+    # adds how the executor spent its time on query to timings (see
+    # regmetrics.py)
+    async def _run_query(self, query, version, budget, timings):
+        # a request that needs no turn is cheap, and is about this
+        # process (e.g. asking for its metrics)
+        if query_priority(query) is None:
+            return self._handler(query, self._settings['delay'],
+                version, budget)
+        loop = asyncio.get_running_loop()
+        result, more = await loop.run_in_executor(self._executor,
+            call_measured, monotonic(), self._handler, query,
+            self._settings['delay'], version, budget)
+        add_timings(timings, more)
+        return result
+
+    # awaits answer(), which does the work for query, once admission
+    # gives it a turn; returns its result, or why query was not
+    # answered. The wait counts towards timings' queue time.
+    async def _run_admitted(self, query, deadline, answer, timings):
+        admission = self._settings['admission']
+        priority = query_priority(query)
+        if admission is None or priority is None:
+            return await answer()
+        waited = perf_counter()
+        refusal = await admission.enter(priority, deadline)
+        add_timings(timings, {'queue': perf_counter() - waited})
+        if refusal is not None:
+            return refusal
+        started = monotonic()
+        try:
+            return await answer()
+        finally:
+            admission.leave(started)
+
+    async def _serve_one_shot(self, reader, writer, first):
+        query = await read_pickled(reader, first)
+        if query is None:
+            return
+        arrived = monotonic()
+        timings = {}
+        with in_progress():
+            to_return = await self._run_admitted(query, None,
+                lambda: self._run_query(query, LEGACY_VERSION,
+                    QueryBudget(None, self._settings['max_steps']),
+                    timings),
+                timings)
+            self._write(writer, dumps, timings, to_return)
+            await writer.drain()
+        total = monotonic() - arrived
+        observe(query, total, timings, to_return[0] is True)
+        log_request(query, total, timings, to_return,
+            version=LEGACY_VERSION)
+
+    # writes encode(*args) to writer, counting the time it took to
+    # encode and its size in timings
+    def _write(self, writer, encode, timings, *args):
+        started = perf_counter()
+        data = encode(*args)
+        add_timings(timings, {'serialize': perf_counter() - started,
+            'bytes': len(data)})
+        writer.write(data)
+
+    # sends a chunk frame for each batch with send(encode, *args);
+    # returns the result for the final response
+    async def _send_chunks(self, request_id, batches, version, send,
+                           timings):
+        future = None
+        try:
+            while True:
+                future = self._executor.submit(call_measured,
+                    monotonic(), next, batches, None)
+                batch, more = await asyncio.wrap_future(future)
+                add_timings(timings, more)
+                if batch is None:
+                    return (True, [])
+                if isinstance(batch, tuple):
+                    return batch
+                await send(encode_chunk, request_id, batch, version)
+        finally:
+            # lets go of the database connection if we stopped early,
+            # once no thread is still reading a batch
+            if future is None:
+                batches.close()
+            else:
+                future.add_done_callback(lambda _: batches.close())
+
+    # answers message, which arrived at the time.monotonic() time
+    # message['arrived'] and is due at message['deadline_at'], on
+    # writer once no other answer is being written with write_lock
+    async def _answer(self, message, version, writer, write_lock):
+        budget = QueryBudget(message['deadline_at'],
+            self._settings['max_steps'])
+        timings = {}
+
+        async def send(encode, *args):
+            async with write_lock:
+                self._write(writer, encode, timings, *args)
+                await writer.drain()
+
+        async def answer():
+            batches = None
+            if self._streamer is not None:
+                batches = self._streamer(message['query'],
+                    self._settings['delay'], version, budget)
+            if batches is None:
+                return await self._run_query(message['query'], version,
+                    budget, timings)
+            return await self._send_chunks(message['id'], batches,
+                version, send, timings)
+
+        with in_progress():
+            try:
+                to_return = await self._run_admitted(message['query'],
+                    message['deadline_at'], answer, timings)
+            except asyncio.CancelledError:
+                # stops the work in the executor as well
+                budget.cancel()
+                total = monotonic() - message['arrived']
+                observe(message['query'], total, timings, False)
+                log_request(message['query'], total, timings, None,
+                    version=version, deadline=message.get('deadline'))
+                raise
+            await send(encode_response, message['id'], to_return,
+                version, catalog_version())
+        total = monotonic() - message['arrived']
+        observe(message['query'], total, timings, to_return[0] is True)
+        log_request(message['query'], total, timings, to_return,
+            version=version, deadline=message.get('deadline'))
+
+    # reads requests as they come and answers each as soon as it is
+    # done, so a quick query is not stuck behind a slow one
+    async def _serve_framed(self, reader, writer, hello):
+        version = choose_version(decode_hello(hello))
+        writer.write(encode_hello(version))
+        await writer.drain()
+
+        write_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        # request id -> the task answering it
+        tasks = {}
+        try:
+            while True:
+                message = await read_frame_async(reader, version)
+                if message is None:
+                    break
+                if is_cancel(message):
+                    # a query already running in the executor still
+                    # finishes there, but its answer is not sent
+                    task = tasks.get(message['id'])
+                    if task is not None:
+                        task.cancel()
+                    continue
+                message['arrived'] = monotonic()
+                message['deadline_at'] = deadline_after(
+                    message.get('deadline'))
+                await in_flight.acquire()
+                task = asyncio.create_task(self._answer(message,
+                    version, writer, write_lock))
+                tasks[message['id']] = task
+
+                # runs even if the task is cancelled before it starts
+                def finished(_, request_id=message['id']):
+                    tasks.pop(request_id, None)
+                    in_flight.release()
+                task.add_done_callback(finished)
+        finally:
+            # nobody is left to read the answers
+            for task in list(tasks.values()):
+                task.cancel()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # asyncio only does this itself for sockets made with an
+            # explicit IPPROTO_TCP; a streamed result is several frames
+            # in a row, and the last would wait for an acknowledgement
+            writer.get_extra_info('socket').setsockopt(IPPROTO_TCP,
+                TCP_NODELAY, 1)
+            first = await reader.read(1)
+            if not first:
+                return
+            if is_hello(first):
+                hello = first + await reader.readexactly(HELLO_SIZE - 1)
+                await self._serve_framed(reader, writer, hello)
+            else:
+                await self._serve_one_shot(reader, writer, first)
+        except Exception as ex:
+            print(ex, file=stderr)
+        finally:
+            writer.close()
+
+    # serves clients until cancelled, from an event loop that is
+    # already running
+    async def serve(self):
+        server = await asyncio.start_server(self._handle_connection,
+            sock=self._server_sock)
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        # let a plain kill unwind through the finally clause below, so
+        # process executor workers are shut down too
+        signal(SIGTERM, lambda signum, frame: exit(0))
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+# kind is 'thread' or 'process'; initializer runs once in each process
+# worker (e.g. to open database connections)
+def make_executor(kind, max_workers, initializer=None):
+    if kind == 'process':
+        return ProcessPoolExecutor(max_workers=max_workers,
+            initializer=initializer)
+    if initializer is not None:
+        initializer()
+    return ThreadPoolExecutor(max_workers=max_workers)
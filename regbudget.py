@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regbudget.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from threading import local
+from time import monotonic
+from contextlib import contextmanager
+from sqlite3 import OperationalError
+
+# ----------------------------------------------------------------------
+# A QueryBudget says when the server should give up on a request: once
+# the client has cancelled it or hung up, once its deadline has passed,
+# or once its SQLite statements have run more virtual machine steps
+# than the operator allows. The server applies the request's budget to
+# the thread answering it; every statement run through watched() then
+# checks it from a SQLite progress handler and is interrupted as soon
+# as the budget runs out.
+# ----------------------------------------------------------------------
+
+# SQLite virtual machine steps between checks of the budget
+PROGRESS_STEPS = 1000
+
+# how often to ask whether the client is still there, in seconds
+POLL_INTERVAL = 0.05
+
+CANCELLED_MSG = 'The request was cancelled'
+DEADLINE_MSG = 'The request could not be answered before its deadline'
+STEPS_MSG = 'The search was too expensive to finish'
+
+# messages that say why a request was given up on, not what its answer
+# is, so they must never be cached
+ABORTED_MSGS = (CANCELLED_MSG, DEADLINE_MSG, STEPS_MSG)
+
+# raised from watched() when the budget stops a statement
+class QueryAborted(Exception):
+    pass
+
+# the monotonic time seconds from now, or None without a (valid)
+# number of seconds
+def deadline_after(seconds):
+    if isinstance(seconds, bool) or not isinstance(seconds,
+            (int, float)):
+        return None
+    return monotonic() + seconds
+
+class QueryBudget:
+
+    # deadline is a time.monotonic() time or None, max_steps a number
+    # of virtual machine steps or None, and poll() returns true if the
+    # client has gone or cancelled the request; it is called at most
+    # every POLL_INTERVAL seconds, from the thread checking the budget
+    def __init__(self, deadline=None, max_steps=None, poll=None):
+        self._deadline = deadline
+        self._max_steps = max_steps
+        self._poll = poll
+        self._last_poll = monotonic()
+        self._steps = 0
+        self._cancelled = False
+        # the message to answer with once the budget has run out
+        self._reason = None
+
+    # a budget sent to a process worker keeps its deadline and step
+    # limit; the worker cannot hear about cancels
+    def __reduce__(self):
+        return (QueryBudget, (self._deadline, self._max_steps))
+
+    # may be called from any thread
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self.check() == CANCELLED_MSG
+
+    def get_steps(self):
+        return self._steps
+
+    # returns None while work should go on, else the message to answer
+    # with instead
+    def check(self):
+        if self._reason is None:
+            self._reason = self._find_reason()
+        return self._reason
+
+    def _find_reason(self):
+        if self._cancelled:
+            return CANCELLED_MSG
+        now = monotonic()
+        if self._deadline is not None and now >= self._deadline:
+            return DEADLINE_MSG
+        if self._max_steps is not None and (
+                self._steps > self._max_steps):
+            return STEPS_MSG
+        if self._poll is not None and (
+                now - self._last_poll >= POLL_INTERVAL):
+            self._last_poll = now
+            try:
+                gone = self._poll()
+            except OSError:
+                gone = True
+            if gone:
+                return CANCELLED_MSG
+        return None
+
+    # SQLite's progress handler, see watched(): a true result interrupts
+    # the statement
+    def on_progress(self):
+        self._steps += PROGRESS_STEPS
+        return self.check() is not None
+
+# ----------------------------------------------------------------------
+
+_local = local()
+
+# the budget applied to this thread, or None
+def current_budget():
+    return getattr(_local, 'budget', None)
+
+# with applied(budget): ... checks statements that this thread runs
+# inside the block against budget (None for no limits)
+@contextmanager
+def applied(budget):
+    previous = current_budget()
+    _local.budget = budget
+    try:
+        yield
+    finally:
+        _local.budget = previous
+
+# with watched(connection): ... runs the block's statements on
+# connection under the current budget, raising QueryAborted if it runs
+# out. The budget stays in force for the whole block, even where a
+# generator carries it on in another thread.
+@contextmanager
+def watched(connection):
+    budget = current_budget()
+    if budget is None:
+        yield
+        return
+    reason = budget.check()
+    if reason is not None:
+        raise QueryAborted(reason)
+    connection.set_progress_handler(budget.on_progress,
+        PROGRESS_STEPS)
+    try:
+        yield
+    except OperationalError:
+        # "interrupted" if the progress handler stopped the statement
+        reason = budget.check()
+        if reason is None:
+            raise
+        raise QueryAborted(reason) from None
+    finally:
+        connection.set_progress_handler(None, PROGRESS_STEPS)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regbuildindex.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+from reghelpers import build_index
+from regindex import save_index
+
+# ----------------------------------------------------------------------
+# Builds the overview search index offline, for regserver.py's
+# --index-file. It lives apart from regindex.py so that the index
+# module itself stays database-free.
+# ----------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Build the overview search index offline',
+        allow_abbrev=False)
+
+    parser.add_argument('output', nargs='?', default='reg.trigram',
+        help='the file the index should be written to')
+
+    args = parser.parse_args()
+
+    index = build_index()
+    if index is None:
+        print('Could not read the database', file=stderr)
+        exit(1)
+    save_index(index, args.output)
+    print('Indexed {} rows into {}'.format(len(index), args.output))
+
+if __name__ == '__main__':
+    main()
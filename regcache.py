@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regcache.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from threading import Lock
+from time import monotonic
+from collections import OrderedDict
+
+# ----------------------------------------------------------------------
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 300.0
+
+# every cache created, by name, so their counters can be reported
+_caches = {}
+
+# LRU cache of query results. Entries expire after ttl seconds and the
+# whole cache is dropped whenever version_func() returns something new
+# (e.g. because the database file changed).
+class QueryCache:
+
+    def __init__(self, name, version_func,
+                 max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self._version_func = version_func
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0,
+            'expirations': 0, 'invalidations': 0}
+        _caches[name] = self
+
+    def configure(self, max_entries=None, ttl=None):
+        with self._lock:
+            if max_entries is not None:
+                self._max_entries = max_entries
+            if ttl is not None:
+                self._ttl = ttl
+            self._trim()
+
+    def _trim(self):
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    # drops every entry if the data behind the cache has changed; must
+    # hold self._lock
+    def _check_version(self):
+        try:
+            version = self._version_func()
+        except OSError:
+            version = None
+        if version != self._version or version is None:
+            if self._entries:
+                self._entries.clear()
+                self._counters['invalidations'] += 1
+            self._version = version
+
+    # returns (True, value) on a hit and (False, None) on a miss
+    def get(self, key):
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and monotonic() >= entry[0]:
+                del self._entries[key]
+                self._counters['expirations'] += 1
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return (False, None)
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return (True, entry[1])
+
+    # put() only stores entries once a lookup has found the version;
+    # this checks it without a lookup
+    def check_version(self):
+        with self._lock:
+            self._check_version()
+
+    def put(self, key, value):
+        with self._lock:
+            if self._max_entries <= 0 or self._version is None:
+                return
+            self._entries[key] = (monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            self._trim()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # returns (version, [(key, value), ...]) with the least recently
+    # used entries first, e.g. to save the cache to a file
+    def export(self):
+        with self._lock:
+            now = monotonic()
+            return (self._version, [(key, entry[1])
+                for key, entry in self._entries.items()
+                if now < entry[0]])
+
+    # puts back entries saved by export(). They stay only if the next
+    # lookup finds version_func() still returning version.
+    def restore(self, version, items):
+        with self._lock:
+            if self._max_entries <= 0 or version is None:
+                return
+            self._version = version
+            expires = monotonic() + self._ttl
+            for key, value in items:
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            self._trim()
+
+    # returns the result for key, calling compute() on a miss. The
+    # result is only stored if cacheable(result) is true.
+    def get_or_compute(self, key, compute, cacheable=None):
+        found, value = self.get(key)
+        if found:
+            return value
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            to_return = dict(self._counters)
+            to_return['size'] = len(self._entries)
+            lookups = to_return['hits'] + to_return['misses']
+            to_return['hit_rate'] = (to_return['hits'] / lookups
+                if lookups else 0.0)
+            return to_return
+
+# returns {cache name: counters} for every cache in this process
+def all_stats():
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+def configure_all(max_entries=None, ttl=None):
+    for cache in _caches.values():
+        cache.configure(max_entries, ttl)
@@ -6,24 +6,21 @@
 #-----------------------------------------------------------------------
 
 from sys import exit, argv, stderr
-from socket import socket
-from pickle import dump, load
+from regconnection import ServerConnection
 
 #-----------------------------------------------------------------------
 
 def call_server(host, port, query):
   
     try:
-        with socket() as sock:
-
-            sock.connect((host, port))
-
-            out_flo = sock.makefile(mode='wb')
-            dump(query, out_flo)
-            out_flo.flush()
-
-            in_flo = sock.makefile(mode='rb')
-            result = load(in_flo)
+        connection = ServerConnection(host, port)
+        result = connection.call(query)
+        connection.close()
+
+        # the connection reports what went wrong instead of raising
+        if not result[0]:
+            print(result[1], file=stderr)
+            exit(1)
 
         if result == '':
             print('The reg server crashed', file=stderr)
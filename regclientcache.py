@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regclientcache.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr
+from os import replace
+from threading import RLock
+import wirecodec
+from regcache import QueryCache
+
+# ----------------------------------------------------------------------
+
+DEFAULT_MAX_ENTRIES = 512
+
+# cached results are checked against the server's catalog version on
+# every lookup, so they need not expire on their own
+CLIENT_TTL = 24 * 60 * 60.0
+
+# the format of cache files written by ClientCache.save()
+CACHE_FILE_FORMAT = 1
+
+def overview_key(query):
+    # the server ignores case, so "COS" and "cos" share an entry
+    return ('overview',) + tuple(query[field].lower()
+        for field in ('d', 'n', 'a', 't'))
+
+def details_key(classid):
+    return ('details', str(classid))
+
+# the results a client has seen, in memory and optionally in a file
+# that survives restarts. Entries are only used while the catalog
+# version the server reports on its responses is the one they were
+# stored under; until the server has reported one, nothing is used.
+class ClientCache:
+
+    def __init__(self, connection, max_entries=DEFAULT_MAX_ENTRIES,
+                 path=None):
+        self._connection = connection
+        self._path = path
+        self._cache = QueryCache('client',
+            connection.get_catalog_version, max_entries, CLIENT_TTL)
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as in_flo:
+                saved = wirecodec.read_message(in_flo)
+        except FileNotFoundError:
+            return
+        except (OSError, wirecodec.CodecError) as ex:
+            print('Ignoring cache file: ' + str(ex), file=stderr)
+            return
+        if not isinstance(saved, dict) or (
+                saved.get('format') != CACHE_FILE_FORMAT):
+            return
+        self._cache.restore(saved['version'], saved['entries'])
+
+    # writes the cache to its file, if it has one
+    def save(self):
+        if self._path is None:
+            return
+        version, entries = self._cache.export()
+        if version is None:
+            return
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as out_flo:
+                wirecodec.write_message(out_flo, {
+                    'format': CACHE_FILE_FORMAT, 'version': version,
+                    'entries': entries})
+            replace(temp_path, self._path)
+        except (OSError, wirecodec.CodecError) as ex:
+            print('Could not save cache file: ' + str(ex), file=stderr)
+
+    # returns the cached (True, data) result for key, or None
+    def get(self, key):
+        if self._connection.get_catalog_version() is None:
+            return None
+        found, result = self._cache.get(key)
+        return result if found else None
+
+    # only successful results are kept; errors may be transient
+    def put(self, key, result):
+        if result[0]:
+            self._cache.check_version()
+            self._cache.put(key, result)
+
+    def stats(self):
+        return self._cache.stats()
+
+# ----------------------------------------------------------------------
+
+# gets class details through a ClientCache. Concurrent requests for the
+# same class share one server request, and prefetch() fetches details
+# the user is likely to open next in the background.
+class DetailFetcher:
+
+    def __init__(self, connection, cache):
+        self._connection = connection
+        self._cache = cache
+        # the connection may call back on this thread
+        self._lock = RLock()
+        # classid -> request id, for requests in flight
+        self._in_flight = {}
+        # classid -> callbacks waiting for that request
+        self._waiters = {}
+
+    def _arrived(self, classid, result):
+        self._cache.put(details_key(classid), result)
+        with self._lock:
+            self._in_flight.pop(classid, None)
+            waiters = self._waiters.pop(classid, [])
+        for callback in waiters:
+            callback(result)
+
+    # calls callback(result), if given, with the details of classid:
+    # at once if they are cached, else once the server answers
+    def fetch(self, classid, callback=None):
+        result = self._cache.get(details_key(classid))
+        if result is not None:
+            if callback is not None:
+                callback(result)
+            return
+        with self._lock:
+            waiters = self._waiters.get(classid)
+            if waiters is not None:
+                if callback is not None:
+                    waiters.append(callback)
+                return
+            self._waiters[classid] = [] if callback is None else [
+                callback]
+            request_id = self._connection.request({'class_id': classid},
+                lambda result: self._arrived(classid, result))
+            # unless it was answered already (e.g. with an error)
+            if classid in self._waiters:
+                self._in_flight[classid] = request_id
+
+    # fetches the details of classids in the background, and cancels
+    # earlier prefetches that are no longer wanted and nobody waits for
+    def prefetch(self, classids):
+        wanted = set(classids)
+        with self._lock:
+            for classid, request_id in list(self._in_flight.items()):
+                if classid not in wanted and not self._waiters[classid]:
+                    self._connection.cancel(request_id)
+                    del self._in_flight[classid]
+                    del self._waiters[classid]
+        for classid in classids:
+            self.fetch(classid)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regconnection.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from threading import Thread, Lock, Event
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from socket import socket, SHUT_RDWR
+from pickle import dump, load
+from regprotocol import encode_hello, decode_hello, encode_frame
+from regprotocol import read_frame, is_chunk, ProtocolError
+from regprotocol import HELLO_SIZE, PROTOCOL_VERSION, FRAMED_VERSION
+from regprotocol import CANCEL_VERSION, STREAM_VERSION
+
+# ----------------------------------------------------------------------
+
+# how long to wait for the server to answer our greeting
+HELLO_TIMEOUT = 5.0
+
+# threads making one-shot requests to an old server, however fast they
+# are issued
+ONE_SHOT_THREADS = 4
+
+# sends query to the server over a connection of its own, the way
+# every client used to; returns (True, result) or (False, err_message).
+# Only used with servers too old to speak the framed protocol.
+def call_one_shot(host, port, query):
+    try:
+        with socket() as sock:
+            sock.connect((host, port))
+            out_flo = sock.makefile(mode='wb')
+            dump(query, out_flo)
+            out_flo.flush()
+
+            in_flo = sock.makefile(mode='rb')
+            return load(in_flo)
+
+    except EOFError as err:
+        return (False, str(err))
+
+    except Exception as ex:
+        return (False, str(ex))
+
+# ----------------------------------------------------------------------
+
+# one long-lived connection to the reg server that many requests share.
+# request() returns at once with a request id; the result is later
+# passed to the request's callback on the connection's reader thread.
+# Overview results can be streamed: their rows are then passed to an
+# on_chunk callback as they arrive, ahead of the result.
+# Servers that only speak the one-shot protocol are detected when we
+# connect, and then every request gets a connection of its own, made
+# by a pool of ONE_SHOT_THREADS threads.
+class ServerConnection:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+        self._lock = Lock()
+        self._sock = None
+        self._out_flo = None
+        # None until we have talked to the server, then True or False
+        self._framed = None
+        # the framed protocol version the server picked
+        self._version = None
+        self._next_id = 0
+        # request id -> query, for requests sent on the open connection
+        self._pending = {}
+        # request id -> callback(result), until the result arrives
+        self._callbacks = {}
+        # request id -> on_chunk(rows), for requests asking for a stream
+        self._chunk_callbacks = {}
+        # ids of requests some of whose chunks have been delivered
+        self._streamed = set()
+        # request id -> the time.monotonic() time its answer is due
+        self._deadlines = {}
+        # created when needed, for servers without the framed protocol
+        self._one_shot_pool = None
+        # the catalog token on the latest response, if any
+        self._catalog_version = None
+
+    def is_framed(self):
+        return self._framed
+
+    # the catalog version the server last reported, or None if it has
+    # not (yet); cached results are only good for that version
+    def get_catalog_version(self):
+        return self._catalog_version
+
+    def _deliver(self, request_id, result):
+        with self._lock:
+            callback = self._callbacks.pop(request_id, None)
+            self._chunk_callbacks.pop(request_id, None)
+            self._streamed.discard(request_id)
+            self._deadlines.pop(request_id, None)
+        if callback is not None:
+            callback(result)
+
+    def _deliver_chunk(self, request_id, rows):
+        with self._lock:
+            on_chunk = self._chunk_callbacks.get(request_id)
+            if on_chunk is not None:
+                self._streamed.add(request_id)
+        if on_chunk is not None:
+            on_chunk(rows)
+
+    # connects and negotiates a protocol version; must hold self._lock
+    def _open(self):
+        sock = socket()
+        try:
+            sock.connect((self._host, self._port))
+            sock.settimeout(HELLO_TIMEOUT)
+            sock.sendall(encode_hello(PROTOCOL_VERSION))
+            in_flo = sock.makefile(mode='rb')
+            try:
+                version = decode_hello(in_flo.read(HELLO_SIZE))
+            except ProtocolError:
+                # an old server hangs up on a greeting
+                version = None
+            sock.settimeout(None)
+        except OSError:
+            sock.close()
+            raise
+
+        if version is None or not (
+                FRAMED_VERSION <= version <= PROTOCOL_VERSION):
+            sock.close()
+            self._framed = False
+            return
+        self._framed = True
+        self._version = version
+        self._sock = sock
+        self._out_flo = sock.makefile(mode='wb')
+        Thread(target=self._read_responses,
+            args=[sock, in_flo, version], daemon=True).start()
+
+    def _read_responses(self, sock, in_flo, version):
+        try:
+            while True:
+                message = read_frame(in_flo, version)
+                if message is None:
+                    break
+                if is_chunk(message):
+                    self._deliver_chunk(message['id'], message['chunk'])
+                    continue
+                with self._lock:
+                    self._pending.pop(message['id'], None)
+                    if message.get('catalog') is not None:
+                        self._catalog_version = message['catalog']
+                self._deliver(message['id'], message['result'])
+        except (OSError, ProtocolError, EOFError):
+            pass
+
+        # the server hung up (e.g. we were idle for too long); send
+        # whatever it had not answered yet again on a new connection
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._drop()
+            unanswered = self._pending
+            self._pending = {}
+            # a stream cut short would start over, repeating its rows
+            broken = self._streamed & set(unanswered)
+        for request_id, query in sorted(unanswered.items()):
+            if request_id in broken:
+                self._deliver(request_id,
+                    (False, 'The connection to the server was lost'))
+            else:
+                self._send(request_id, query, retry=False)
+
+    # forgets the open connection; must hold self._lock
+    def _drop(self):
+        if self._sock is not None:
+            # the reader thread's file object keeps the socket open
+            # after close(), so the server would never see us leave
+            try:
+                self._sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+        self._sock = None
+        self._out_flo = None
+
+    # writes one request on the open connection; must hold self._lock
+    def _write(self, request_id, query):
+        self._pending[request_id] = query
+        if (request_id in self._chunk_callbacks
+                and self._version >= STREAM_VERSION):
+            query = dict(query, stream=True)
+        message = {'id': request_id, 'query': query}
+        # the time left, which is less if this is a resend
+        if request_id in self._deadlines:
+            message['deadline'] = max(0.0,
+                self._deadlines[request_id] - monotonic())
+        try:
+            self._out_flo.write(encode_frame(message, self._version))
+            self._out_flo.flush()
+        except OSError:
+            del self._pending[request_id]
+            self._drop()
+            raise
+
+    def _send(self, request_id, query, retry=True):
+        try:
+            with self._lock:
+                if self._sock is None and self._framed is not False:
+                    self._open()
+                if self._framed:
+                    try:
+                        self._write(request_id, query)
+                        return
+                    except OSError:
+                        if not retry:
+                            raise
+                    # the connection had gone stale; try a fresh one
+                    self._open()
+                    if self._framed:
+                        self._write(request_id, query)
+                        return
+        except OSError as ex:
+            with self._lock:
+                self._pending.pop(request_id, None)
+                self._drop()
+            self._deliver(request_id, (False, str(ex)))
+            return
+
+        # the server only speaks the one-shot protocol
+        with self._lock:
+            if self._one_shot_pool is None:
+                self._one_shot_pool = ThreadPoolExecutor(
+                    max_workers=ONE_SHOT_THREADS)
+            pool = self._one_shot_pool
+        pool.submit(self._call_one_shot, request_id, query)
+
+    def _call_one_shot(self, request_id, query):
+        # it may have been cancelled while waiting for a thread
+        with self._lock:
+            if request_id not in self._callbacks:
+                return
+        self._deliver(request_id,
+            call_one_shot(self._host, self._port, query))
+
+    # sends query; callback(result) is called once its result arrives,
+    # where result is (True, data) or (False, err_message). Returns the
+    # request id. With on_chunk, an overview query asks for its rows to
+    # be streamed: on_chunk(rows) is called for each chunk of them, and
+    # the result then holds only the rows that followed the chunks (all
+    # of them, from a server that does not stream). With deadline, the
+    # server is told not to work on the query for longer than that many
+    # seconds.
+    def request(self, query, callback, on_chunk=None, deadline=None):
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._callbacks[request_id] = callback
+            if on_chunk is not None:
+                self._chunk_callbacks[request_id] = on_chunk
+            if deadline is not None:
+                self._deadlines[request_id] = monotonic() + deadline
+        self._send(request_id, query)
+        return request_id
+
+    # gives up on a request: its callback will not be called. If the
+    # server supports it, it is also told to skip the request. Returns
+    # False if the result had already been delivered.
+    def cancel(self, request_id):
+        with self._lock:
+            if self._callbacks.pop(request_id, None) is None:
+                return False
+            self._chunk_callbacks.pop(request_id, None)
+            self._streamed.discard(request_id)
+            self._deadlines.pop(request_id, None)
+            if self._pending.pop(request_id, None) is None:
+                return True
+            if self._out_flo is None or self._version < CANCEL_VERSION:
+                return True
+            try:
+                self._out_flo.write(encode_frame(
+                    {'id': request_id, 'cancel': True}, self._version))
+                self._out_flo.flush()
+            except OSError:
+                # the reader thread notices and reconnects if needed
+                pass
+        return True
+
+    # sends query and waits for its result; the server is told how long
+    # we will wait
+    def call(self, query, timeout=None):
+        done = Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        request_id = self.request(query, callback, deadline=timeout)
+        if not done.wait(timeout):
+            with self._lock:
+                self._callbacks.pop(request_id, None)
+                self._deadlines.pop(request_id, None)
+            return (False, 'The server did not respond in time')
+        return results[0]
+
+    def close(self):
+        with self._lock:
+            self._drop()
+            self._pending = {}
+            if self._one_shot_pool is not None:
+                self._one_shot_pool.shutdown(wait=False,
+                    cancel_futures=True)
+                self._one_shot_pool = None
@@ -7,29 +7,50 @@
 
 from sys import argv, stderr
 import textwrap
+import json
 from collections import namedtuple
-from reghelpers import select_from_table
+from reghelpers import select_from_table, database_version
+from reghelpers import is_cacheable, materialization
+from regcache import QueryCache
+from regflight import SingleFlight
+from regmetrics import timed
 
 # ----------------------------------------------------------------------
 
-BASE_STMT_STR = '''SELECT classes.courseid, classes.days,
-    classes.starttime, classes.endtime, classes.bldg,
-    classes.roomnum, courses.area, courses.title, courses.descrip,
+# the class, its crosslistings and its professors in one round trip.
+# The class row is looked up once (SQLite materializes a CTE that is
+# used more than once) and every other part joins against it. The
+# first column says which part a row belongs to: 0 for the class
+# itself, 1 for a (dept, coursenum) and 2 for a professor name.
+DETAILS_STMT_STR = '''WITH class AS (
+        SELECT courseid, days, starttime, endtime, bldg, roomnum
+        FROM classes
+        WHERE classid = ?1)
+    SELECT 0, class.courseid, class.days,
+    class.starttime, class.endtime, class.bldg,
+    class.roomnum, courses.area, courses.title, courses.descrip,
     courses.prereqs
-    FROM classes, crosslistings, courses
-    WHERE classes.classid = ?
-    AND classes.courseid = crosslistings.courseid 
-    AND classes.courseid = courses.courseid'''
-
-DEPT_STMT_STR = '''SELECT crosslistings.dept, crosslistings.coursenum
-    FROM classes, crosslistings
-    WHERE classes.classid = ?
-    AND crosslistings.courseid = classes.courseid'''
-
-PROF_STMT_STR = '''SELECT profname FROM classes, coursesprofs, profs
-    WHERE classes.classid = ?
-    AND classes.courseid = coursesprofs.courseid
-    AND coursesprofs.profid = profs.profid'''
+    FROM class, courses
+    WHERE class.courseid = courses.courseid
+    UNION ALL
+    SELECT 1, crosslistings.dept, crosslistings.coursenum,
+    NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL
+    FROM class, crosslistings
+    WHERE crosslistings.courseid = class.courseid
+    UNION ALL
+    SELECT 2, profs.profname, NULL,
+    NULL, NULL, NULL, NULL, NULL, NULL, NULL, NULL
+    FROM class, coursesprofs, profs
+    WHERE class.courseid = coursesprofs.courseid
+    AND coursesprofs.profid = profs.profid
+    ORDER BY 1, 2, 3'''
+
+BASE_ROW, DEPT_ROW, PROF_ROW = 0, 1, 2
+
+# the same record, prebuilt by regmaterialize.py
+MATERIALIZED_STMT_STR = '''SELECT courseid, days, starttime, endtime,
+    bldg, roomnum, area, title, descrip, prereqs, depts, profs
+    FROM details WHERE classid = ?'''
 
 # dept, coursenum, and profnames are arrays
 
@@ -78,20 +99,47 @@ def format_details(baserows, deptdata, profnames):
     return to_return
 
 
-def get_table_results(classid):
-    base_rows = select_from_table(BASE_STMT_STR, [classid])
-    # determines if an error happened (check first here so we don't
-    # print error message 3 times)
-    for row in [base_rows]:
-        if isinstance(row, tuple):
-            return row
-    dept_rows = select_from_table(DEPT_STMT_STR, [classid])
-    prof_rows = select_from_table(PROF_STMT_STR, [classid])
+# keyed on the classid; "no such class" answers are cached as well
+details_cache = QueryCache('details', database_version)
+details_flight = SingleFlight('details')
 
+def get_table_results(classid):
+    key = str(classid)
+    return details_cache.get_or_compute(key,
+        lambda: details_flight.do(key, lambda: query_details(classid),
+            is_cacheable), is_cacheable)
+
+# returns (base_rows, dept_rows, prof_rows) from the materialized
+# catalog if it is available and from the source database otherwise
+def select_details(classid):
+    materialized_url = materialization.current_url()
+    if materialized_url is not None:
+        rows = select_from_table(MATERIALIZED_STMT_STR, [classid],
+            materialized_url)
+        if isinstance(rows, tuple):
+            return rows
+        base_rows = [row[:10] for row in rows]
+        if not rows:
+            return (base_rows, [], [])
+        dept_rows = [tuple(dept) for dept in json.loads(rows[0][10])]
+        prof_rows = [(prof,) for prof in json.loads(rows[0][11])]
+        return (base_rows, dept_rows, prof_rows)
+
+    rows = select_from_table(DETAILS_STMT_STR, [classid])
+    if isinstance(rows, tuple):
+        return rows
+    # rows arrive grouped by kind, with depts and professors sorted
+    base_rows = [row[1:] for row in rows if row[0] == BASE_ROW]
+    dept_rows = [row[1:3] for row in rows if row[0] == DEPT_ROW]
+    prof_rows = [row[1:2] for row in rows if row[0] == PROF_ROW]
+    return (base_rows, dept_rows, prof_rows)
+
+def query_details(classid):
+    details = select_details(classid)
     # determines if an error happened
-    for row in [dept_rows, prof_rows]:
-        if isinstance(row, tuple):
-            return row
+    if isinstance(details[0], bool):
+        return details
+    base_rows, dept_rows, prof_rows = details
 
     # check size of base_rows
     if len(base_rows) == 0:
@@ -102,16 +150,12 @@ def get_table_results(classid):
 
     base_rows = base_rows[0]
 
-    dept_rows.sort(key=lambda x: x[1])
-    dept_rows.sort(key=lambda x: x[0])
-
-    prof_rows.sort(key=lambda x: x[0])
-
     to_return = ""
-    to_return += format_details(
-        base_rows,
-        dept_rows,
-        prof_rows
-    )
+    with timed('format'):
+        to_return += format_details(
+            base_rows,
+            dept_rows,
+            prof_rows
+        )
 
     return to_return
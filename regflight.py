@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regflight.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from os import getpid, urandom
+from threading import Thread, Lock, Event, local
+from pickle import dumps, loads
+from multiprocessing.connection import Listener, Client
+# multiprocessing.connection imports hmac the first time it
+# authenticates; importing it here keeps a coordinator thread from
+# holding the import lock while the server forks a worker, which would
+# leave the worker stuck once it connects
+import hmac  # pylint: disable=unused-import
+from regbudget import current_budget, POLL_INTERVAL
+
+# ----------------------------------------------------------------------
+# Single flight: identical queries that arrive while one of them is
+# being answered wait for that answer instead of each reading the
+# database. Within a process the waiting is done by threads; a server
+# whose workers are processes also runs a FlightCoordinator, through
+# which the first worker to ask for a key leads the flight and hands its
+# result to the workers that asked after it. Only results that may be
+# shared (e.g. not aborted ones, see regbudget.py) are handed on; when
+# the leader's result is not, a waiting request leads a new flight.
+# ----------------------------------------------------------------------
+
+# every flight created, by name, so their counters can be reported
+_flights = {}
+
+# the coordinator's address and authkey, once processes share flights
+_channel = {}
+
+# every thread's connection to the coordinator
+_local = local()
+
+# set once the flight's leader has its result
+class _Flight(Event):
+
+    def __init__(self):
+        super().__init__()
+        self.result = None
+        self.shared = False
+
+class SingleFlight:
+
+    def __init__(self, name):
+        self._name = name
+        self._lock = Lock()
+        self._enabled = True
+        # key -> the _Flight answering it in this process
+        self._flights = {}
+        self._counters = {'executions': 0, 'coalesced': 0,
+            'shared': 0}
+        _flights[name] = self
+
+    def configure(self, enabled=None):
+        with self._lock:
+            if enabled is not None:
+                self._enabled = enabled
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    # returns compute(), or the result of a call for the same key that
+    # was already in progress. shareable(result) says whether a result
+    # may be handed to other callers (default: any). A caller that has
+    # to wait gives up with its reason once the current budget runs out.
+    def do(self, key, compute, shareable=None):
+        while True:
+            with self._lock:
+                if not self._enabled:
+                    leader = None
+                else:
+                    flight = self._flights.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = self._flights[key] = _Flight()
+            if leader is None:
+                self._count('executions')
+                return compute()
+            if leader:
+                return self._lead(key, flight, compute, shareable)
+
+            reason = _wait(flight.wait)
+            if reason is not None:
+                return (False, reason)
+            if flight.shared:
+                self._count('coalesced')
+                return flight.result
+
+    def _lead(self, key, flight, compute, shareable):
+        try:
+            found, result = _join_shared((self._name, key), compute,
+                shareable)
+            self._count('shared' if found else 'executions')
+            flight.result = result
+            flight.shared = shareable is None or shareable(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    # executions are calls that read the database in this process; the
+    # others waited for a call in this process (coalesced) or another
+    # one (shared)
+    def stats(self):
+        with self._lock:
+            to_return = dict(self._counters)
+            to_return['flights'] = len(self._flights)
+            calls = sum(self._counters.values())
+            to_return['coalescing_ratio'] = (
+                (calls - self._counters['executions']) / calls
+                if calls else 0.0)
+            return to_return
+
+# returns {flight name: counters} for every flight in this process
+def all_stats():
+    return {name: flight.stats() for name, flight in _flights.items()}
+
+def configure_all(enabled=None):
+    for flight in _flights.values():
+        flight.configure(enabled)
+
+# waits with wait(timeout) until it returns true; returns None, or the
+# reason the current budget ran out first
+def _wait(wait):
+    budget = current_budget()
+    if budget is None:
+        wait(None)
+        return None
+    while not wait(POLL_INTERVAL):
+        reason = budget.check()
+        if reason is not None:
+            return reason
+    return None
+
+# ----------------------------------------------------------------------
+# SHARING BETWEEN PROCESSES
+
+# makes processes forked from now on share their flights through the
+# coordinator at address
+def share_all(address, authkey):
+    _channel.update(address=address, authkey=authkey)
+
+# this thread's connection to the coordinator, or None if there is none
+def _connection():
+    if not _channel:
+        return None
+    # a forked child must not use its parent's connection
+    if getattr(_local, 'pid', None) != getpid():
+        _local.pid = getpid()
+        _local.conn = None
+        _local.sequence = 0
+    if _local.conn is None:
+        try:
+            _local.conn = Client(_channel['address'],
+                authkey=_channel['authkey'])
+        except (OSError, EOFError) as ex:
+            raise _ChannelError() from ex
+    return _local.conn
+
+class _ChannelError(Exception):
+    pass
+
+# returns (False, compute()) if this process leads the flight for key
+# among the processes sharing flights (or if there are none), and
+# (True, result) once another process's leader hands its result on
+def _join_shared(key, compute, shareable):
+    try:
+        conn = _connection()
+        if conn is None:
+            return (False, compute())
+        _local.sequence += 1
+        sequence = _local.sequence
+        conn.send(('begin', sequence, key))
+        reply = _reply(conn, sequence)
+    except (_ChannelError, OSError, EOFError):
+        _local.conn = None
+        return (False, compute())
+    if reply[0] == 'left':
+        return (False, (False, reply[1]))
+    if reply[0] == 'result':
+        return (True, reply[2])
+
+    result = None
+    try:
+        result = compute()
+        return (False, result)
+    finally:
+        try:
+            if result is not None and (shareable is None
+                    or shareable(result)):
+                conn.send(('end', sequence, True))
+                conn.send_bytes(dumps(result))
+            else:
+                conn.send(('end', sequence, False))
+        except (OSError, EOFError):
+            _local.conn = None
+
+# reads the coordinator's reply to request sequence: ('lead', sequence)
+# or ('result', sequence, result). If the current budget runs out
+# first, tells the coordinator we left and returns ('left', reason).
+def _reply(conn, sequence):
+    while True:
+        reason = _wait(conn.poll)
+        if reason is not None:
+            conn.send(('leave', sequence))
+            return ('left', reason)
+        reply = conn.recv()
+        if reply[0] == 'result':
+            payload = conn.recv_bytes()
+            if reply[1] != sequence:
+                continue
+            return ('result', sequence, loads(payload))
+        # an earlier request we left may still have been made a leader
+        if reply[1] != sequence:
+            conn.send(('leave', reply[1]))
+            continue
+        return reply
+
+# lets the processes of a server share flights: the first process to
+# begin a key leads the flight, and the rest wait for its result. Runs
+# in the server's main process, which is where processes are forked
+# from, with a thread per connected thread of the workers.
+class FlightCoordinator:
+
+    def __init__(self):
+        self._authkey = urandom(32)
+        self._listener = Listener(family='AF_UNIX',
+            authkey=self._authkey)
+        self._lock = Lock()
+        # key -> [leader, [followers]], each a (connection, sequence)
+        self._flights = {}
+        # connection -> the lock its messages are sent under
+        self._send_locks = {}
+        self._counters = {'flights': 0, 'coalesced': 0}
+
+    # where worker processes connect, for share_all()
+    def get_channel(self):
+        return (self._listener.address, self._authkey)
+
+    def start(self):
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # e.g. a client that failed to authenticate
+                continue
+            with self._lock:
+                self._send_locks[conn] = Lock()
+            Thread(target=self._serve, args=[conn], daemon=True).start()
+
+    def _serve(self, conn):
+        # the (key, sequence) of each request of conn's in progress
+        requests = {}
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'begin':
+                    requests[message[1]] = message[2]
+                    self._begin(conn, message[1], message[2])
+                    continue
+                key = requests.pop(message[1], None)
+                payload = None
+                if message[0] == 'end' and message[2]:
+                    payload = conn.recv_bytes()
+                if key is not None:
+                    self._end(conn, message[1], key, payload)
+        except (OSError, EOFError):
+            pass
+        # the process has gone, or dropped the connection
+        for sequence, key in requests.items():
+            self._end(conn, sequence, key, None)
+        with self._lock:
+            del self._send_locks[conn]
+        conn.close()
+
+    def _send(self, conn, message, payload=None):
+        with self._lock:
+            send_lock = self._send_locks.get(conn)
+        if send_lock is None:
+            return
+        try:
+            with send_lock:
+                conn.send(message)
+                if payload is not None:
+                    conn.send_bytes(payload)
+        except (OSError, EOFError):
+            # its own thread notices
+            pass
+
+    def _begin(self, conn, sequence, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight[1].append((conn, sequence))
+                self._counters['coalesced'] += 1
+                return
+            self._flights[key] = [(conn, sequence), []]
+            self._counters['flights'] += 1
+        self._send(conn, ('lead', sequence))
+
+    # ends conn's part in key's flight: hands payload, the pickled
+    # result, to the followers if conn led the flight, and otherwise
+    # makes the first follower the leader
+    def _end(self, conn, sequence, key, payload):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                return
+            if flight[0] != (conn, sequence):
+                # a follower that gave up waiting
+                if (conn, sequence) in flight[1]:
+                    flight[1].remove((conn, sequence))
+                return
+            if payload is None and flight[1]:
+                flight[0] = flight[1].pop(0)
+                leader = flight[0]
+                followers = []
+            else:
+                del self._flights[key]
+                leader = None
+                followers = flight[1] if payload is not None else []
+        if leader is not None:
+            self._send(leader[0], ('lead', leader[1]))
+        for follower, follower_sequence in followers:
+            self._send(follower, ('result', follower_sequence),
+                payload)
+
+    def stats(self):
+        with self._lock:
+            to_return = dict(self._counters)
+            to_return['in_flight'] = len(self._flights)
+            return to_return
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regformat.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+# The server sends overview rows as (classid, dept, coursenum, area,
+# title) tuples; these turn them into the fixed-width text clients
+# display.
+
+# ----------------------------------------------------------------------
+
+def format_row(row):
+    output = '{0:>5d}  {1:>3s}   {2:>4s}  {3:>3s} {4}'.format(
+        row[0], row[1], row[2], row[3], row[4])
+    return output
+
+def row_array_to_string(row_array):
+    to_return = ""
+    for row in row_array:
+        to_return += format_row(row)
+        to_return += "\n"
+    return to_return.rstrip("\n")
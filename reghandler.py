@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# reghandler.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr
+from os import getpid
+from time import monotonic
+from functools import partial
+from multiprocessing import Process, active_children
+from multiprocessing.connection import wait
+from socket import IPPROTO_TCP, TCP_NODELAY, MSG_PEEK
+from select import select
+from pickle import dumps, UnpicklingError
+from reghelpers import catalog_version
+from regmetrics import measuring, timed, sent, in_progress, observe
+from reglog import log_request
+from regbudget import QueryBudget, deadline_after
+from regadmission import query_priority
+from reganswer import handle_query, stream_query
+from regprotocol import is_hello, encode_hello, decode_hello
+from regprotocol import encode_response, choose_version, is_cancel
+from regprotocol import encode_chunk, load_plain
+from regprotocol import FrameReader, ProtocolError
+from regprotocol import HELLO_SIZE, LEGACY_VERSION
+
+# ----------------------------------------------------------------------
+
+# workers hang up on a framed connection after this many idle seconds,
+# so that quiet clients do not hold on to a fork child, or to the
+# sockets of a prefork worker (clients reconnect when they need to)
+KEEPALIVE_TIMEOUT = 5.0
+
+# ----------------------------------------------------------------------
+
+# writes a chunk frame for each batch of rows until batches runs out,
+# yields an error or budget runs out; returns the result for the final
+# response
+def send_chunks(request_id, batches, budget, out_flo, version):
+    try:
+        for batch in batches:
+            if isinstance(batch, tuple):
+                return batch
+            with timed('serialize'):
+                frame = encode_chunk(request_id, batch, version)
+            out_flo.write(frame)
+            out_flo.flush()
+            sent(len(frame))
+            reason = budget.check()
+            if reason is not None:
+                return (False, reason)
+        return (True, [])
+    finally:
+        # lets go of the database connection if we stopped early
+        batches.close()
+
+# does the work for message's query by calling answer() once admission
+# (see regadmission.py; None: no admission control) gives it a turn,
+# giving up if budget runs out while it waits; returns answer()'s
+# result, or why the query was not answered. A message put in the
+# queue by queue_message() waits for its turn there, if it was not
+# refused a place.
+def run_admitted(admission, message, budget, answer):
+    if message.get('refused') is not None:
+        return message['refused']
+    priority = query_priority(message['query'])
+    if admission is None or priority is None:
+        return answer()
+    with timed('queue'):
+        if message.get('queued'):
+            message['queued'] = False
+            refusal = admission.start_queued(priority, budget)
+        else:
+            refusal = admission.enter(priority, budget)
+    if refusal is not None:
+        return refusal
+    started = monotonic()
+    try:
+        return answer()
+    finally:
+        admission.leave(started)
+
+# counts message as waiting for admission from the moment it is read
+# (see Admission.queue()), so that requests a server has read but not
+# started are bounded and ordered too; the answer refusing it, if the
+# queue is full, is kept in message['refused']
+def queue_message(admission, message):
+    priority = query_priority(message['query'])
+    if admission is None or priority is None:
+        return
+    refusal = admission.queue(priority)
+    if refusal is None:
+        message['queued'] = True
+    else:
+        message['refused'] = refusal
+
+# takes message out of the queue if queue_message() put it there and
+# it has not had its turn
+def unqueue_message(admission, message):
+    if message.get('queued'):
+        message['queued'] = False
+        admission.unqueue(query_priority(message['query']))
+
+# notes when each request in messages arrived, which is now, and when
+# it must be answered by
+def received(messages):
+    for message in messages:
+        message['arrived'] = monotonic()
+        message['deadline_at'] = deadline_after(message.get('deadline'))
+    return messages
+
+# polls a framed connection while request_id runs: adds the messages
+# that have arrived to arrived, and returns true if the client has hung
+# up or cancelled the request
+def client_gone(reader, request_id, arrived):
+    arrived += received(reader.read_ready())
+    return reader.is_at_eof() or any(is_cancel(message)
+        and message['id'] == request_id for message in arrived)
+
+# true if the peer has closed its end of sock; never waits
+def peer_closed(sock):
+    readable, _, _ = select([sock], [], [], 0)
+    return bool(readable) and sock.recv(1, MSG_PEEK) == b''
+
+# drops cancelled requests, and the cancels themselves, from messages
+def drop_cancelled(messages):
+    cancelled = {message['id'] for message in messages
+        if is_cancel(message)}
+    return [message for message in messages
+        if not is_cancel(message) and message['id'] not in cancelled]
+
+# how the server answers requests: settings is a dict with the 'delay'
+# before each query, in seconds, the 'max_steps' SQLite steps a request
+# may run (None: no limit) and the 'admission' (see regadmission.py)
+# requests wait for before they do any work (None: none)
+def make_settings(delay, max_steps=None, admission=None):
+    return {'delay': delay, 'max_steps': max_steps,
+        'admission': admission}
+
+# answers message, a framed request read by reader, on out_flo. It
+# stops early if the client hangs up or cancels it, if its deadline
+# passes or if it runs more than the settings' max_steps. Returns the
+# messages that arrived while it ran.
+def answer_framed(message, reader, out_flo, version, settings):
+    arrived = []
+    budget = QueryBudget(message['deadline_at'], settings['max_steps'],
+        partial(client_gone, reader, message['id'], arrived))
+
+    def answer():
+        batches = stream_query(message['query'], settings['delay'],
+            version, budget)
+        if batches is None:
+            return handle_query(message['query'], settings['delay'],
+                version, budget)
+        return send_chunks(message['id'], batches, budget, out_flo,
+            version)
+
+    # the time spent behind earlier requests is time spent waiting, too
+    timings = {'queue': monotonic() - message['arrived']}
+    with measuring(timings), in_progress():
+        to_return = run_admitted(settings['admission'], message,
+            budget, answer)
+        cancelled = budget.is_cancelled()
+        # unless nobody is waiting for the answer
+        if not cancelled:
+            with timed('serialize'):
+                frame = encode_response(message['id'], to_return,
+                    version, catalog_version())
+            out_flo.write(frame)
+            out_flo.flush()
+            sent(len(frame))
+    total = monotonic() - message['arrived']
+    observe(message['query'], total, timings, to_return[0] is True)
+    log_request(message['query'], total, timings,
+        None if cancelled else to_return, version=version,
+        deadline=message.get('deadline'))
+    # checking the budget reads the messages that have arrived, so
+    # they are only handed over once it is no longer checked
+    return arrived
+
+# answers message, a one-shot request from sock, with a pickle on
+# out_flo
+def answer_pickled(message, sock, out_flo, settings):
+    query = message['query']
+    # the client waits with its end open, so a close means it left
+    budget = QueryBudget(None, settings['max_steps'],
+        partial(peer_closed, sock))
+    with measuring() as timings, in_progress():
+        to_return = run_admitted(settings['admission'], message, budget,
+            partial(handle_query, query, settings['delay'],
+                LEGACY_VERSION, budget))
+        cancelled = budget.is_cancelled()
+        if not cancelled:
+            with timed('serialize'):
+                data = dumps(to_return)
+            out_flo.write(data)
+            out_flo.flush()
+            sent(len(data))
+    total = monotonic() - message['arrived']
+    observe(query, total, timings, to_return[0] is True)
+    log_request(query, total, timings,
+        None if cancelled else to_return, version=LEGACY_VERSION)
+
+# answers framed requests on sock, in order, until the client hangs up
+# or stays idle for KEEPALIVE_TIMEOUT seconds
+def serve_framed(sock, in_flo, out_flo, settings):
+    version = choose_version(decode_hello(in_flo.read(HELLO_SIZE)))
+    out_flo.write(encode_hello(version))
+    out_flo.flush()
+    # the client waits for our greeting before sending anything else,
+    # so in_flo has nothing buffered and we can read the socket itself
+    reader = FrameReader(sock, version)
+    waiting = []
+    while True:
+        if not waiting:
+            try:
+                message = reader.read(KEEPALIVE_TIMEOUT)
+            except OSError:
+                # idle for too long, or the client reset the connection
+                break
+            if message is None:
+                break
+            waiting += received([message])
+        # a client that has moved on may already have cancelled some of
+        # the requests still waiting
+        waiting = drop_cancelled(
+            waiting + received(reader.read_ready()))
+        if waiting:
+            message = waiting.pop(0)
+            waiting += answer_framed(message, reader, out_flo, version,
+                settings)
+
+# sends (True, results) if succceeds, (False, err_message) if fails.
+# Pickles from clients are loaded as plain data only, since unpickling
+# anything else lets a client run arbitrary code in the server.
+def handle_client(sock, settings):
+    print('Handling client in process {}'.format(getpid()))
+    # a streamed result is several frames in a row; without this the
+    # last of them waits for the client to acknowledge the others
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    in_flo = sock.makefile(mode='rb')
+    out_flo = sock.makefile(mode='wb')
+    # a one-shot client starts with a pickle, a framed one with a hello
+    if is_hello(in_flo.peek(1)):
+        serve_framed(sock, in_flo, out_flo, settings)
+    else:
+        try:
+            query = load_plain(in_flo)
+        except (ProtocolError, UnpicklingError, EOFError) as ex:
+            print(ex, file=stderr)
+            return
+        answer_pickled({'query': query, 'arrived': monotonic()}, sock,
+            out_flo, settings)
+    print('Closed socket in child process')
+
+# the original model: one new process per accepted connection, though
+# never more than max_children at once (0: no limit); connections past
+# that wait to be accepted
+def serve_forking(server_sock, settings, max_children=0):
+    while True:
+        try:
+            # this also reaps children that have finished
+            children = active_children()
+            if max_children and len(children) >= max_children:
+                wait([child.sentinel for child in children])
+                continue
+            sock, _ = server_sock.accept()
+            with sock:
+                print('Accepted connection, opened socket')
+                process = Process(target=handle_client,
+                    args=[sock, settings])
+                process.start()
+        except Exception as ex:
+            print(ex, file=stderr)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# reghandoff.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from socket import socket, socketpair, send_fds, recv_fds
+from socket import AF_UNIX, SOCK_SEQPACKET
+from pickle import dumps, loads
+
+# the most a connection handed to another worker may carry with it
+MAX_HANDOFF_SIZE = 65536
+
+# a channel on which workers hand connections to each other, with
+# what they had read from them: any worker may send one, and the first
+# free worker to receive it takes it over
+class Handoff:
+
+    def __init__(self):
+        self._send_sock, self._receive_sock = socketpair(AF_UNIX,
+            SOCK_SEQPACKET)
+        self._send_sock.setblocking(False)
+        self._receive_sock.setblocking(False)
+
+    # lets the workers wait for a connection in their selectors
+    def fileno(self):
+        return self._receive_sock.fileno()
+
+    # hands sock over, with state; returns false if it could not be,
+    # e.g. because the channel is full
+    def send(self, sock, state):
+        payload = dumps(state)
+        if len(payload) > MAX_HANDOFF_SIZE:
+            return False
+        try:
+            send_fds(self._send_sock, [payload], [sock.fileno()])
+        except OSError:
+            return False
+        return True
+
+    # returns (sock, state) for a connection handed over, or None if
+    # there is none, or another worker took it first
+    def receive(self):
+        try:
+            payload, fds, _, _ = recv_fds(self._receive_sock,
+                MAX_HANDOFF_SIZE, 1)
+        except BlockingIOError:
+            return None
+        if not fds:
+            return None
+        sock = socket(fileno=fds[0])
+        sock.settimeout(None)
+        return (sock, loads(payload))
+
+# returns a Handoff, or None where the platform cannot pass sockets
+# between processes
+def make_handoff():
+    try:
+        return Handoff()
+    except OSError:
+        return None
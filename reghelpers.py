@@ -7,27 +7,44 @@
 
 from sys import argv, stderr
 from contextlib import closing
-from sqlite3 import connect, Error
+from threading import Lock
+from collections import OrderedDict
+from sqlite3 import Error
+from dbpool import pooled_connection, warm
+from regindex import TrigramIndex, IndexHolder, file_stamp
+from regindex import like_pattern
+from regcache import QueryCache
+from regflight import SingleFlight
+from regmetrics import timed
+from regbudget import watched, QueryAborted, ABORTED_MSGS
+from regrefine import RefinementSessions
+from regpage import page_key, decode_cursor, page_size, make_page
+from regpage import page_from_rows, DEFAULT_PAGE_SIZE
+from regpage import INVALID_PAGE_MSG
+from regmaterialize import Materialization
 
 # ----------------------------------------------------------------------
 
-DATABASE_URL = 'file:reg.sqlite?mode=ro'
+DATABASE_PATH = 'reg.sqlite'
+DATABASE_URL = 'file:' + DATABASE_PATH + '?mode=ro'
 
-def format_row(row):
-    output = '{0:>5d}  {1:>3s}   {2:>4s}  {3:>3s} {4}'.format(
-        row[0], row[1], row[2], row[3], row[4])
-    return output
+# pre-joined copy of the catalog, see regmaterialize.py
+MATERIALIZED_PATH = 'reg.materialized.sqlite'
+
+SERVER_ERROR_MSG = "A server error occurred. Please \
+                contact the system administrator."
 
 # prepared_args is an array of arguments for the prepared statement
 # returns a list of unsorted rows
 
 # returns a tuple with (False, exception) if something fails
-def select_from_table(stmt_str, prepared_args):
+def select_from_table(stmt_str, prepared_args,
+                      database_url=DATABASE_URL):
     try:
-        with connect(DATABASE_URL, isolation_level=None,
-                     uri=True) as connection:
+        with timed('db'), pooled_connection(database_url) as connection:
 
-            with closing(connection.cursor()) as cursor:
+            with closing(connection.cursor()) as cursor, \
+                 watched(connection):
 
                 to_return = []
                 cursor.execute(stmt_str, prepared_args)
@@ -40,72 +57,396 @@ def select_from_table(stmt_str, prepared_args):
 
                 return to_return
 
+    # the request's budget ran out, see regbudget.py
+    except QueryAborted as ex:
+        return (False, str(ex))
+
+    except Error as ex:
+        print(argv[0] + ": " + str(ex), file=stderr)
+        return (False, SERVER_ERROR_MSG)
+
+# rows per batch of a streamed result
+STREAM_BATCH_SIZE = 200
+
+# yields the rows stmt_str selects in lists of up to batch_size, as
+# SQLite produces them, so they never all have to be in memory at once.
+# If reading fails, yields (False, err_message) last. The database
+# connection is held until the generator finishes or is closed.
+def iter_from_table(stmt_str, prepared_args,
+                    database_url=DATABASE_URL,
+                    batch_size=STREAM_BATCH_SIZE):
+    try:
+        with pooled_connection(database_url) as connection:
+
+            with closing(connection.cursor()) as cursor, \
+                 watched(connection):
+
+                cursor.execute(stmt_str, prepared_args)
+                rows = cursor.fetchmany(batch_size)
+                while rows:
+                    yield rows
+                    rows = cursor.fetchmany(batch_size)
+
+    except QueryAborted as ex:
+        yield (False, str(ex))
+
     except Error as ex:
         print(argv[0] + ": " + str(ex), file=stderr)
-        return (False,
-            "A server error occurred. Please \
-                contact the system administrator.")
+        yield (False, SERVER_ERROR_MSG)
 
-def row_array_to_string(row_array):
-    to_return = ""
-    for row in row_array:
-        to_return += format_row(row)
-        to_return += "\n"
-    return to_return.rstrip("\n")
+# sorts overview rows by dept, course number and classid, the order
+# pages are cut in; clients format them
+def sort_results(rows):
+    rows.sort(key=page_key)
+    return rows
 
-def get_table_results(stmt_str, prepared_args):
+def get_table_results(stmt_str, prepared_args,
+                      database_url=DATABASE_URL):
 
-    rows = select_from_table(stmt_str, prepared_args)
+    rows = select_from_table(stmt_str, prepared_args, database_url)
     # checks for error state
     if isinstance(rows, tuple):
         return rows
-    rows.sort(key=lambda x: x[2])
-    rows.sort(key=lambda x: x[1])
-    to_return = ""
-    to_return += row_array_to_string(rows)
-    return to_return
+    return sort_results(rows)
 
 BASE_STMT_STR = '''SELECT classes.classid, crosslistings.dept,
     crosslistings.coursenum, courses.area, courses.title 
     FROM classes, crosslistings, courses  
     WHERE classes.courseid = crosslistings.courseid 
     AND classes.courseid = courses.courseid '''
+MATERIALIZED_STMT_STR = '''SELECT classid, dept, coursenum, area,
+    title FROM overview WHERE 1 '''
+MATERIALIZED_ORDER_STR = ' ORDER BY pos'
+# page order, and the rows after a cursor in it, in the source database
+# and in the materialized overview table
+PAGE_ORDER_STR = ''' ORDER BY crosslistings.dept,
+    crosslistings.coursenum, classes.classid'''
+MATERIALIZED_PAGE_ORDER_STR = ' ORDER BY dept, coursenum, classid'
+LIMIT_STR = ' LIMIT ?'
+AFTER_STR = ''' AND (crosslistings.dept, crosslistings.coursenum,
+    classes.classid) > (?, ?, ?)'''
+MATERIALIZED_AFTER_STR = ''' AND (dept, coursenum, classid)
+    > (?, ?, ?)'''
+COUNT_STMT_STR = 'SELECT COUNT(*) FROM ({})'
 LIKE_STATEMENT_STRING = " LIKE ? ESCAPE \'\\\'"
 
 # appends to prepared_args in place,
 # returns string to add to stmt_str
 def update_statement(and_stmt, searchstring, prepared_args):
+    prepared_args.append(like_pattern(searchstring))
+    return and_stmt + LIKE_STATEMENT_STRING
 
-    def format_searchstring(searchstring):
-        # convert to lower case
-        searchstring = searchstring.lower()
-        # escape regex characters
-        searchstring = searchstring.replace("%", r"\%")
-        searchstring = searchstring.replace("_", r"\_")
-        # sandwich with percent signs (for regex)
-        return '%{}%'.format(searchstring)
+# query key and the column it filters in the source database and in
+# the materialized overview table, in statement order
+SEARCH_FIELDS = [
+    ("d", "AND lower(crosslistings.dept)", "AND dept_l"),
+    ("n", "AND lower(crosslistings.coursenum)", "AND coursenum_l"),
+    ("a", "AND lower(courses.area)", "AND area_l"),
+    ("t", "AND lower(courses.title)", "AND title_l")
+]
 
-    prepared_args.append(format_searchstring(searchstring))
-    return and_stmt + LIKE_STATEMENT_STRING
+# identifies the version of the database that results were read from
+def database_version():
+    return file_stamp(DATABASE_PATH)
+
+# database_version() as a string for clients to validate their own
+# caches against; None if the database cannot be read
+def catalog_version():
+    try:
+        return '{}-{}'.format(*database_version())
+    except OSError:
+        return None
+
+# results are keyed on the normalized query and are only valid for the
+# database version they were read from
+overview_cache = QueryCache('overviews', database_version)
+
+# server errors may be transient, and abandoned requests say nothing
+# about the answer, so only real answers are cached
+def is_cacheable(result):
+    return not (isinstance(result, tuple) and (
+        result[1] == SERVER_ERROR_MSG or result[1] in ABORTED_MSGS))
+
+# searches ignore case, so "COS" and "cos" share a cache entry
+def query_key(query):
+    return tuple(query[field[0]].lower() for field in SEARCH_FIELDS)
+
+# identical searches made at the same time are only run once
+overview_flight = SingleFlight('overviews')
 
 def get_results_from_query(query):
-    stmt_str = BASE_STMT_STR
+    key = query_key(query)
+    return overview_cache.get_or_compute(key,
+        lambda: overview_flight.do(key, lambda: query_overviews(query),
+            is_cacheable), is_cacheable)
+
+# search sessions that type a query a character at a time
+refinement_sessions = RefinementSessions(database_version)
+
+# like get_results_from_query, but narrows the previous result of the
+# client's search session when it can
+def get_results_refined(query, session_id):
+    return refinement_sessions.search(session_id, query,
+        get_results_from_query)
+
+# returns the statement selecting query's rows from the database at
+# materialized_url (None for the source database), its arguments and
+# the LIKE pattern per query key, for the trigram index
+def overview_statement(query, materialized_url):
+    stmt_str = (BASE_STMT_STR if materialized_url is None
+        else MATERIALIZED_STMT_STR)
     prepared_args = []
-    if query["d"]:
-        stmt_str += update_statement(
-            "AND lower(crosslistings.dept)",
-                query["d"], prepared_args)
-    if query["n"]:
-        stmt_str += update_statement(
-            "AND lower(crosslistings.coursenum)",
-                query["n"], prepared_args)
-    if query["a"]:
-        stmt_str += update_statement(
-            "AND lower(courses.area)",
-                query["a"], prepared_args)
-    if query["t"]:
-        stmt_str += update_statement(
-            "AND lower(courses.title)",
-                query["t"], prepared_args)
-
-    return get_table_results(stmt_str, prepared_args)
+    patterns = {}
+    for key, and_stmt, materialized_and_stmt in SEARCH_FIELDS:
+        if query[key]:
+            stmt_str += update_statement(
+                and_stmt if materialized_url is None
+                else materialized_and_stmt, query[key], prepared_args)
+            patterns[key] = prepared_args[-1]
+    return (stmt_str, prepared_args, patterns)
+
+def query_overviews(query):
+    materialized_url = materialization.current_url()
+    stmt_str, prepared_args, patterns = overview_statement(query,
+        materialized_url)
+
+    index = get_index()
+    if index is not None:
+        with timed('db'):
+            return sort_results(index.search(patterns))
+    if materialized_url is None:
+        return get_table_results(stmt_str, prepared_args)
+    stmt_str += MATERIALIZED_ORDER_STR
+    return get_table_results(stmt_str, prepared_args, materialized_url)
+
+# ----------------------------------------------------------------------
+# PAGES
+
+# returns one page of query's results (see regpage.py): {'rows',
+# 'cursor' for the next page or None, 'total' if with_total else
+# None}. Results already at hand (the session's, indexed or cached) are
+# cut into pages; otherwise the database reads just the rows of this
+# page.
+def get_page(query, cursor=None, limit=DEFAULT_PAGE_SIZE,
+             with_total=False, session_id=None):
+    try:
+        after = decode_cursor(cursor)
+        limit = page_size(limit)
+    except (ValueError, TypeError):
+        return (False, INVALID_PAGE_MSG)
+
+    if session_id is not None:
+        rows = get_results_refined(query, session_id)
+    elif get_index() is not None:
+        rows = get_results_from_query(query)
+    else:
+        found, rows = overview_cache.get(query_key(query))
+        if not found:
+            key = ('page', query_key(query), after, limit, with_total)
+            return overview_cache.get_or_compute(key,
+                lambda: query_page(query, after, limit, with_total),
+                is_cacheable)
+    if isinstance(rows, tuple):
+        return rows
+    return page_from_rows(rows, after, limit, with_total)
+
+# reads the page of query's rows after key after from the database
+def query_page(query, after, limit, with_total):
+    materialized_url = materialization.current_url()
+    database_url = (DATABASE_URL if materialized_url is None
+        else materialized_url)
+    stmt_str, prepared_args, _ = overview_statement(query,
+        materialized_url)
+
+    total = None
+    if with_total and after is not None:
+        total = count_rows(stmt_str, prepared_args, database_url)
+        if isinstance(total, tuple):
+            return total
+
+    page_stmt_str = stmt_str
+    page_args = list(prepared_args)
+    if after is not None:
+        page_stmt_str += (AFTER_STR if materialized_url is None
+            else MATERIALIZED_AFTER_STR)
+        page_args.extend(after)
+    page_stmt_str += (PAGE_ORDER_STR if materialized_url is None
+        else MATERIALIZED_PAGE_ORDER_STR) + LIMIT_STR
+    # one row more than the page tells us whether another follows
+    page_args.append(limit + 1)
+    rows = select_from_table(page_stmt_str, page_args, database_url)
+    if isinstance(rows, tuple):
+        return rows
+
+    # a first page holding everything is its own count
+    if with_total and total is None:
+        total = (len(rows) if len(rows) <= limit
+            else count_rows(stmt_str, prepared_args, database_url))
+        if isinstance(total, tuple):
+            return total
+    return make_page(rows, limit, total)
+
+# returns the number of rows stmt_str selects, or (False, err_message)
+def count_rows(stmt_str, prepared_args, database_url):
+    rows = select_from_table(COUNT_STMT_STR.format(stmt_str),
+        prepared_args, database_url)
+    if isinstance(rows, tuple):
+        return rows
+    return rows[0][0]
+
+# ----------------------------------------------------------------------
+# STREAMS
+
+# yields query's results in page order, in lists of up to batch_size
+# rows; if reading fails, yields (False, err_message) last. Results
+# already at hand (the session's, indexed or cached) are cut into
+# batches; otherwise SQLite sorts the rows and they are sent on as they
+# are read, so the server never holds more than a batch of them.
+def stream_results_from_query(query, batch_size=STREAM_BATCH_SIZE,
+                              session_id=None):
+    rows = None
+    if session_id is not None:
+        rows = get_results_refined(query, session_id)
+    elif get_index() is not None:
+        rows = get_results_from_query(query)
+    else:
+        # a miss leaves rows None
+        _, rows = overview_cache.get(query_key(query))
+    if isinstance(rows, tuple):
+        yield rows
+        return
+    if rows is not None:
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+        return
+
+    materialized_url = materialization.current_url()
+    stmt_str, prepared_args, _ = overview_statement(query,
+        materialized_url)
+    if materialized_url is None:
+        yield from iter_from_table(stmt_str + PAGE_ORDER_STR,
+            prepared_args, DATABASE_URL, batch_size)
+    else:
+        yield from iter_from_table(
+            stmt_str + MATERIALIZED_PAGE_ORDER_STR, prepared_args,
+            materialized_url, batch_size)
+
+# ----------------------------------------------------------------------
+# MATERIALIZED CATALOG
+
+materialization = Materialization(DATABASE_PATH, MATERIALIZED_PATH)
+
+# answers queries from the pre-joined catalog from now on, building it
+# now if needed; it is rebuilt whenever reg.sqlite changes
+def enable_materialization():
+    return materialization.enable()
+
+# opens this process's database connections ahead of its first request
+def warm_connections():
+    materialized_url = materialization.current_url()
+    if materialized_url is not None:
+        warm(materialized_url)
+    warm(DATABASE_URL)
+
+# reads every overview row, in display order if we can
+def select_all_overviews():
+    materialized_url = materialization.current_url()
+    if materialized_url is None:
+        return select_from_table(BASE_STMT_STR, [])
+    return select_from_table(
+        MATERIALIZED_STMT_STR + MATERIALIZED_ORDER_STR, [],
+        materialized_url)
+
+# ----------------------------------------------------------------------
+# TRIGRAM INDEX
+
+# reads every overview row and indexes it; returns None on error
+def build_index():
+    try:
+        stamp = file_stamp(DATABASE_PATH)
+    except OSError as ex:
+        print(argv[0] + ": " + str(ex), file=stderr)
+        return None
+    rows = select_all_overviews()
+    if isinstance(rows, tuple):
+        return None
+    return TrigramIndex(rows, stamp)
+
+# the index answering get_results_from_query, if enabled
+overview_index = IndexHolder(build_index, DATABASE_PATH)
+
+# answers overview queries from a trigram index from now on. Uses the
+# prebuilt index at index_path if it matches the database, otherwise
+# builds one.
+def enable_index(index_path=None):
+    return overview_index.enable(index_path)
+
+# returns the current index, rebuilding it if the database changed, or
+# None if queries should go to SQLite
+def get_index():
+    return overview_index.get()
+
+# ----------------------------------------------------------------------
+# CATALOG SNAPSHOTS
+
+# how many catalog versions we remember to compute deltas from
+SNAPSHOT_HISTORY = 4
+
+# catalog version -> {classid: its overview rows}, oldest first
+_snapshots = OrderedDict()
+_snapshots_lock = Lock()
+
+# the order search results come in, which clients keep snapshots in
+def catalog_order(row):
+    return (row[1], row[2], row[0])
+
+# reads every overview row; returns (version, rows, rows by classid)
+# and remembers them, or None on error
+def read_snapshot():
+    version = catalog_version()
+    rows = select_all_overviews()
+    if version is None or isinstance(rows, tuple):
+        return None
+    rows.sort(key=catalog_order)
+    classes = {}
+    for row in rows:
+        classes.setdefault(row[0], []).append(row)
+    with _snapshots_lock:
+        _snapshots[version] = classes
+        _snapshots.move_to_end(version)
+        while len(_snapshots) > SNAPSHOT_HISTORY:
+            _snapshots.popitem(last=False)
+    return (version, rows, classes)
+
+# the whole catalog for a client to search locally:
+# {'version': catalog version, 'rows': overview rows}
+def get_snapshot():
+    snapshot = read_snapshot()
+    if snapshot is None:
+        return (False, SERVER_ERROR_MSG)
+    version, rows, _ = snapshot
+    return {'version': version, 'rows': rows}
+
+# what changed since catalog version since: {'version', 'since',
+# 'changed': the rows of every added or changed class, 'removed': the
+# classids of removed classes}. If we no longer know that version,
+# returns a full snapshot instead.
+def get_delta(since):
+    version = catalog_version()
+    if version is not None and version == since:
+        return {'version': version, 'since': since, 'changed': [],
+            'removed': []}
+    with _snapshots_lock:
+        old_classes = _snapshots.get(since)
+    snapshot = read_snapshot()
+    if snapshot is None:
+        return (False, SERVER_ERROR_MSG)
+    version, rows, classes = snapshot
+    if old_classes is None:
+        return {'version': version, 'rows': rows}
+    changed = [row for row in rows
+        if old_classes.get(row[0]) != classes[row[0]]]
+    removed = [classid for classid in old_classes
+        if classid not in classes]
+    return {'version': version, 'since': since, 'changed': changed,
+        'removed': removed}
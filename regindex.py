@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regindex.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+import re
+from os import stat, replace
+from string import ascii_uppercase, ascii_lowercase
+import wirecodec
+
+# ----------------------------------------------------------------------
+
+# overview rows are (classid, dept, coursenum, area, title); these are
+# the searchable columns and the query keys that filter them
+SEARCH_COLUMNS = [(1, 'd'), (2, 'n'), (3, 'a'), (4, 't')]
+
+INDEX_FORMAT = 2
+
+# SQLite's lower() and LIKE only fold ASCII letters, so we must too
+_ASCII_LOWER = str.maketrans(ascii_uppercase, ascii_lowercase)
+
+def sql_lower(value):
+    if value is None:
+        return None
+    return str(value).translate(_ASCII_LOWER)
+
+# ----------------------------------------------------------------------
+# LIKE PATTERNS
+
+# the pattern a search for searchstring uses: a case-insensitive
+# substring match, with the user's % and _ taken literally
+def like_pattern(searchstring):
+    # convert to lower case
+    searchstring = searchstring.lower()
+    # escape regex characters
+    searchstring = searchstring.replace("%", r"\%")
+    searchstring = searchstring.replace("_", r"\_")
+    # sandwich with percent signs (for regex)
+    return '%{}%'.format(searchstring)
+
+# splits a LIKE pattern into tokens: ('lit', text), ('any',) for % and
+# ('one',) for _. Returns None if the pattern can never match (SQLite
+# treats a trailing escape character that way).
+def parse_like(pattern, escape='\\'):
+    tokens = []
+    literal = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == escape:
+            if i + 1 == len(pattern):
+                return None
+            literal += pattern[i + 1]
+            i += 2
+            continue
+        if char in '%_':
+            if literal:
+                tokens.append(('lit', literal))
+                literal = ''
+            tokens.append(('any',) if char == '%' else ('one',))
+        else:
+            literal += char
+        i += 1
+    if literal:
+        tokens.append(('lit', literal))
+    return tokens
+
+# compiles a LIKE pattern into a predicate over sql_lower()ed values
+# with exactly SQLite's (ASCII case-insensitive) semantics
+def like_matcher(pattern, escape='\\'):
+    tokens = parse_like(pattern, escape)
+    if tokens is None:
+        return lambda value: False
+    regex = ''
+    for token in tokens:
+        if token[0] == 'lit':
+            regex += re.escape(sql_lower(token[1]))
+        elif token[0] == 'any':
+            regex += '.*'
+        else:
+            regex += '.'
+    compiled = re.compile(regex, re.DOTALL)
+    return lambda value: (value is not None
+        and compiled.fullmatch(value) is not None)
+
+# the literal stretches a matching value must contain
+def literal_runs(pattern, escape='\\'):
+    tokens = parse_like(pattern, escape)
+    if tokens is None:
+        return []
+    return [sql_lower(token[1]) for token in tokens
+        if token[0] == 'lit']
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+# ----------------------------------------------------------------------
+
+class TrigramIndex:
+
+    # search() returns rows in the order given here, which is either
+    # the unfiltered overview query's or the materialized display order
+    def __init__(self, rows, source_stamp=None):
+        self._rows = rows
+        self._source_stamp = source_stamp
+        self._values = {}
+        self._postings = {}
+        for column, key in SEARCH_COLUMNS:
+            values = [sql_lower(row[column]) for row in rows]
+            postings = {}
+            for row_id, value in enumerate(values):
+                if value is None:
+                    continue
+                for gram in trigrams(value):
+                    postings.setdefault(gram, []).append(row_id)
+            self._values[key] = values
+            self._postings[key] = postings
+
+    def get_source_stamp(self):
+        return self._source_stamp
+
+    def get_rows(self):
+        return self._rows
+
+    def __len__(self):
+        return len(self._rows)
+
+    # returns the set of row ids that could match pattern in column
+    # key, or None if the pattern has no trigram to narrow it down
+    def _candidates(self, key, pattern):
+        postings = self._postings[key]
+        grams = set()
+        for run in literal_runs(pattern):
+            grams |= trigrams(run)
+        if not grams:
+            return None
+        lists = sorted((postings.get(gram, []) for gram in grams),
+            key=len)
+        candidates = set(lists[0])
+        for posting in lists[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return candidates
+
+    # patterns maps query keys ('d', 'n', 'a', 't') to LIKE patterns,
+    # as built by reghelpers.update_statement; returns matching rows
+    def search(self, patterns):
+        candidates = None
+        for key, pattern in patterns.items():
+            found = self._candidates(key, pattern)
+            if found is None:
+                continue
+            if candidates is None:
+                candidates = found
+            else:
+                candidates &= found
+        if candidates is None:
+            row_ids = range(len(self._rows))
+        else:
+            row_ids = sorted(candidates)
+
+        # verify every candidate against the real LIKE semantics
+        checks = [(self._values[key], like_matcher(pattern))
+            for key, pattern in patterns.items()]
+        return [self._rows[row_id] for row_id in row_ids
+            if all(matches(values[row_id])
+                for values, matches in checks)]
+
+# ----------------------------------------------------------------------
+# OFFLINE BUILDS
+
+# identifies a version of the database file
+def file_stamp(path):
+    info = stat(path)
+    return (info.st_size, info.st_mtime_ns)
+
+# an index file holds the rows in wirecodec rather than a pickled
+# index, so loading one cannot run code. It saves reading the database;
+# indexing the rows again takes less time than decoding postings would.
+def save_index(index, path):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as out_flo:
+        out_flo.write(wirecodec.dumps({'format': INDEX_FORMAT,
+            'stamp': index.get_source_stamp(),
+            'rows': index.get_rows()}))
+    replace(temp_path, path)
+
+# returns the index stored at path, or None if it is missing, in an
+# unknown format or was built from a different version of the database
+def load_index(path, database_path):
+    try:
+        with open(path, 'rb') as in_flo:
+            saved = wirecodec.loads(in_flo.read())
+        if saved['format'] != INDEX_FORMAT:
+            return None
+        if saved['stamp'] != file_stamp(database_path):
+            return None
+        return TrigramIndex(saved['rows'], saved['stamp'])
+    except (OSError, ValueError, TypeError, KeyError, IndexError):
+        return None
+
+# ----------------------------------------------------------------------
+# THE INDEX IN USE
+
+# the index a process answers overview queries from, once enabled.
+# build() reads every overview row of the database at database_path and
+# returns a TrigramIndex of them, or None on error; the index is built
+# again whenever the database changes.
+class IndexHolder:
+
+    def __init__(self, build, database_path):
+        self._build = build
+        self._database_path = database_path
+        self._index = None
+        self._enabled = False
+
+    # answers from an index from now on. Uses the prebuilt index at
+    # index_path if it matches the database, otherwise builds one.
+    def enable(self, index_path=None):
+        self._enabled = True
+        if index_path is not None:
+            self._index = load_index(index_path, self._database_path)
+        if self._index is None:
+            self._index = self._build()
+        return self._index is not None
+
+    # returns the current index, rebuilding it if the database changed,
+    # or None if queries should go to SQLite
+    def get(self):
+        if not self._enabled:
+            return None
+        try:
+            current = self._index is not None and (
+                self._index.get_source_stamp()
+                == file_stamp(self._database_path))
+        except OSError:
+            current = False
+        if not current:
+            self._index = self._build()
+        return self._index
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# reglistmodel.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+from regformat import format_row
+
+# ----------------------------------------------------------------------
+
+# returns (classid, text) for each line of the formatted text that
+# servers older than the typed-row protocol send
+def get_list_entries(class_data):
+    return [(int(line.split()[0]), line)
+        for line in class_data.split('\n') if line.strip()]
+
+# holds the latest search results. Rows are formatted only when the
+# view asks to paint them. The view is told about every row we hold at
+# once, and lays them out a batch at a time (see init_list_view() in
+# reg.py); handing them over in chunks instead made it lay out every
+# row again for each chunk.
+# Results may come a page at a time: once the view has scrolled to the
+# last row we hold, load_more() is called to ask the server for the
+# next page, which is then passed to append_rows().
+class OverviewModel(QAbstractListModel):
+
+    def __init__(self):
+        super().__init__()
+        self._rows = []
+        self._display = format_row
+        # asks for the next page, or None if there is none
+        self._load_more = None
+        self._loading = False
+
+    # class_data is a list of overview rows, or text from an older
+    # server
+    def set_rows(self, class_data, load_more=None):
+        self.beginResetModel()
+        if isinstance(class_data, str):
+            self._rows = get_list_entries(class_data)
+            self._display = lambda entry: entry[1]
+        else:
+            self._rows = list(class_data)
+            self._display = format_row
+        self._load_more = load_more
+        self._loading = False
+        self.endResetModel()
+
+    # adds the next page of rows
+    def append_rows(self, rows, load_more=None):
+        self._load_more = load_more
+        self._loading = False
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self._rows),
+                len(self._rows) + len(rows) - 1)
+            self._rows.extend(rows)
+            self.endInsertRows()
+
+    # Qt calls the methods below by their Qt names
+    # pylint: disable=invalid-name
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return None
+        row = self._rows[index.row()]
+        if role == Qt.DisplayRole:
+            return self._display(row)
+        # rows remember their class, so nothing reads the classid back
+        # out of the display text
+        if role == Qt.UserRole:
+            return row[0]
+        return None
+
+    # the view asks for more once it has scrolled to the last row; the
+    # rest is still on the server
+    def canFetchMore(self, parent):
+        if parent.isValid():
+            return False
+        return self._load_more is not None and not self._loading
+
+    def fetchMore(self, parent):
+        if self.canFetchMore(parent):
+            self._loading = True
+            self._load_more()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# reglog.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr
+from os import open as os_open, write, getpid
+from os import O_WRONLY, O_APPEND, O_CREAT
+from time import time
+import json
+from regbudget import CANCELLED_MSG, DEADLINE_MSG, STEPS_MSG
+from regadmission import BUSY_MSG
+
+# ----------------------------------------------------------------------
+# The request log: one JSON object per line for every request a server
+# answers, with its query, how long it took in total and in each phase,
+# the bytes sent and how it turned out. regreplay.py reads it back to
+# send the same requests again. Every process of a server appends to
+# the same file, each line with a single write.
+# ----------------------------------------------------------------------
+
+# what is reported when a request fails, by its error message; other
+# failures are 'error'
+OUTCOMES = {CANCELLED_MSG: 'cancelled', DEADLINE_MSG: 'deadline',
+    STEPS_MSG: 'too_expensive'}
+
+_BUSY_PREFIX = BUSY_MSG.partition('{}')[0]
+
+# returns how result, a (True, data) or (False, err_message) tuple,
+# turned out: 'ok', 'error' or the reason it was not answered
+def outcome(result):
+    if result[0] is True:
+        return 'ok'
+    message = str(result[1])
+    if message.startswith(_BUSY_PREFIX):
+        return 'busy'
+    return OUTCOMES.get(message, 'error')
+
+class RequestLog:
+
+    def __init__(self):
+        self._enabled = False
+        self._path = None
+        self._server = None
+        self._slow_ms = None
+        self._fd = None
+        self._pid = None
+
+    # makes log() append to path (None: only report slow requests).
+    # server names what wrote the log, e.g. the server mode. Requests
+    # slower than slow_ms milliseconds (None: none are) are marked slow
+    # and reported on stderr.
+    def enable(self, path, server, slow_ms=None):
+        self._enabled = True
+        self._path = path
+        self._server = server
+        self._slow_ms = slow_ms
+        self._pid = None
+
+    def is_enabled(self):
+        return self._enabled
+
+    # the file to append to; a forked child opens its own
+    def _file(self):
+        if self._pid != getpid():
+            self._pid = getpid()
+            self._fd = None
+            if self._path is not None:
+                self._fd = os_open(self._path,
+                    O_WRONLY | O_APPEND | O_CREAT, 0o644)
+        return self._fd
+
+    # records a request for query, answered with result (None if the
+    # client left first) total seconds after it arrived. timings (see
+    # regmetrics.measuring()) tells how they were spent and how many
+    # bytes were sent; more holds other fields to log, e.g. the
+    # protocol version.
+    def log(self, query, total, timings, result, **more):
+        total_ms = round(total * 1000, 3)
+        entry = {'time': round(time() - total, 6),
+            'server': self._server, 'pid': getpid(),
+            'query': query, 'total_ms': total_ms,
+            'timings': {phase: round(seconds * 1000, 3)
+                for phase, seconds in timings.items()
+                if phase != 'bytes'},
+            'bytes': timings.get('bytes', 0)}
+        entry.update(more)
+        if result is None:
+            entry['outcome'] = 'cancelled'
+        else:
+            entry['outcome'] = outcome(result)
+            if result[0] is not True:
+                entry['error'] = str(result[1])
+        slow = self._slow_ms is not None and total_ms >= self._slow_ms
+        entry['slow'] = slow
+        if slow:
+            print('Slow request ({} ms): {}'.format(total_ms, query),
+                file=stderr)
+
+        try:
+            fd = self._file()
+            if fd is not None:
+                write(fd, (json.dumps(entry, default=str)
+                    + '\n').encode('utf-8'))
+        except OSError as ex:
+            print('Could not write the request log: {}'.format(ex),
+                file=stderr)
+
+# ----------------------------------------------------------------------
+
+# the server's request log
+_request_log = RequestLog()
+
+# makes log_request() append to path (None: only report slow requests)
+def enable_request_log(path, server, slow_ms=None):
+    _request_log.enable(path, server, slow_ms)
+    return _request_log
+
+# the server's request log, or None if it keeps none
+def get_request_log():
+    return _request_log if _request_log.is_enabled() else None
+
+# like RequestLog.log(), if the server keeps a request log
+def log_request(query, total, timings, result, **more):
+    if _request_log.is_enabled():
+        _request_log.log(query, total, timings, result, **more)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regmetrics.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr
+from os import replace, getpid
+from threading import Thread, Event, local
+from time import perf_counter, monotonic
+from contextlib import contextmanager
+from multiprocessing import Lock, RawArray
+import regcache
+import regflight
+
+# ----------------------------------------------------------------------
+# Server metrics: per command, the number of requests, errors and bytes
+# sent, and histograms of how long requests took, in total and in each
+# phase: waiting for a turn (queue), reading the catalog (db), turning
+# rows into what the client gets (format) and encoding the response
+# (serialize). The counters live in shared memory, so every worker of a
+# server adds to the same ones and any of them can report them all.
+# Each worker also adds what its own caches and flights counted since
+# its last request.
+# ----------------------------------------------------------------------
+
+COMMANDS = ('get_overviews', 'get_detail', 'snapshot', 'delta',
+    'stats')
+PHASES = ('total', 'queue', 'db', 'format', 'serialize')
+
+# upper bounds of the latency histogram buckets, in seconds; the last
+# bucket has no bound
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+    0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# what is reported of each cache (see regcache.py) and each flight
+# (see regflight.py)
+CACHE_COUNTERS = ('hits', 'misses')
+FLIGHT_COUNTERS = ('executions', 'coalesced', 'shared')
+
+# how often a metrics file is rewritten, in seconds
+DEFAULT_WRITE_INTERVAL = 10.0
+
+# returns the name of the command query asks for, as the server logs it
+def command_name(query):
+    command = query.get('command')
+    if command in ('snapshot', 'delta', 'stats'):
+        return command
+    if 'class_id' in query:
+        return 'get_detail'
+    return 'get_overviews'
+
+# ----------------------------------------------------------------------
+# MEASURING A REQUEST
+
+_local = local()
+
+# with measuring() as timings: ... adds the seconds that this thread
+# spends in timed() blocks inside the block to timings, by phase, and
+# the bytes it sends to timings['bytes']
+@contextmanager
+def measuring(timings=None):
+    previous = (getattr(_local, 'timings', None),
+        getattr(_local, 'phases', None))
+    _local.timings = {} if timings is None else timings
+    _local.phases = set()
+    try:
+        yield _local.timings
+    finally:
+        _local.timings, _local.phases = previous
+
+# with timed(phase): ... counts the block's time towards phase, unless
+# it is inside a block counted towards phase already
+@contextmanager
+def timed(phase):
+    timings = getattr(_local, 'timings', None)
+    if timings is None or phase in _local.phases:
+        yield
+        return
+    _local.phases.add(phase)
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = (timings.get(phase, 0.0)
+            + perf_counter() - started)
+        _local.phases.discard(phase)
+
+# notes that the request being measured sent size bytes
+def sent(size):
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings['bytes'] = timings.get('bytes', 0) + size
+
+# adds the timings of part of a request to those of the whole
+def add_timings(timings, more):
+    for key, value in more.items():
+        timings[key] = timings.get(key, 0) + value
+
+# calls func(*args) while measuring, e.g. in an executor; returns
+# (its result, the timings). submitted is the time.monotonic() time the
+# call was handed over; the wait until it started counts as queue time.
+def call_measured(submitted, func, *args):
+    timings = {'queue': max(0.0, monotonic() - submitted)}
+    with measuring(timings):
+        return (func(*args), timings)
+
+# ----------------------------------------------------------------------
+# COUNTING REQUESTS
+
+# the requests of each command: count, errors, bytes; then the bucket
+# counts of each (command, phase) histogram; then the counters of the
+# caches and flights
+_REQUEST_COUNTERS = ('requests', 'errors', 'bytes_sent')
+_BUCKET_COUNT = len(BUCKETS) + 1
+_HISTOGRAM_COUNT = len(COMMANDS) * len(PHASES)
+_COUNTERS_AT = (len(COMMANDS) * len(_REQUEST_COUNTERS)
+    + _HISTOGRAM_COUNT * _BUCKET_COUNT)
+# the requests in progress, in the last place
+_ACTIVE = -1
+
+class Metrics:
+
+    # workers is the number of workers the server was started with
+    def __init__(self, workers=None):
+        self._workers = workers
+        self._lock = Lock()
+        self._names = {'caches': sorted(regcache.all_stats()),
+            'flights': sorted(regflight.all_stats())}
+        self._counts = RawArray('q', _COUNTERS_AT
+            + len(self._names['caches']) * len(CACHE_COUNTERS)
+            + len(self._names['flights']) * len(FLIGHT_COUNTERS) + 1)
+        self._sums = RawArray('d', _HISTOGRAM_COUNT)
+        # the process id and what that process's caches and flights
+        # had counted when it last added them in; starts over in a
+        # forked process
+        self._seen = (None, None)
+        # name -> a function returning more {counter: number} to report
+        self._sources = {}
+
+    # adds what source() returns to snapshots, as group name; source
+    # must give the same answer in every worker, e.g. by reading shared
+    # memory
+    def add_source(self, name, source):
+        self._sources[name] = source
+
+    def _request_index(self, command, counter):
+        return (COMMANDS.index(command) * len(_REQUEST_COUNTERS)
+            + _REQUEST_COUNTERS.index(counter))
+
+    def _histogram(self, command, phase):
+        return COMMANDS.index(command) * len(PHASES) + PHASES.index(
+            phase)
+
+    def _bucket_index(self, histogram, bucket):
+        return (len(COMMANDS) * len(_REQUEST_COUNTERS)
+            + histogram * _BUCKET_COUNT + bucket)
+
+    # the counters of this process's caches and flights, in the order
+    # they are stored
+    def _local_counts(self):
+        caches = regcache.all_stats()
+        flights = regflight.all_stats()
+        return ([caches.get(name, {}).get(counter, 0)
+            for name in self._names['caches']
+            for counter in CACHE_COUNTERS]
+            + [flights.get(name, {}).get(counter, 0)
+            for name in self._names['flights']
+            for counter in FLIGHT_COUNTERS])
+
+    # with metrics.in_progress(): ... counts a request as active
+    @contextmanager
+    def in_progress(self):
+        with self._lock:
+            self._counts[_ACTIVE] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._counts[_ACTIVE] -= 1
+
+    # records a request for command that took total seconds, of which
+    # timings (see measuring()) tells how they were spent, and
+    # succeeded if ok
+    def observe(self, command, total, timings, ok):
+        local_counts = self._local_counts()
+        with self._lock:
+            pid, seen = self._seen
+            if pid != getpid():
+                seen = [0] * len(local_counts)
+            for offset, count in enumerate(local_counts):
+                self._counts[_COUNTERS_AT + offset] += (count
+                    - seen[offset])
+            self._seen = (getpid(), local_counts)
+
+            index = self._request_index(command, 'requests')
+            self._counts[index] += 1
+            if not ok:
+                self._counts[index + 1] += 1
+            self._counts[index + 2] += timings.get('bytes', 0)
+            for phase in PHASES:
+                seconds = total if phase == 'total' else timings.get(
+                    phase)
+                if seconds is None:
+                    continue
+                histogram = self._histogram(command, phase)
+                self._sums[histogram] += seconds
+                bucket = 0
+                while (bucket < len(BUCKETS)
+                        and seconds > BUCKETS[bucket]):
+                    bucket += 1
+                self._counts[self._bucket_index(histogram, bucket)] += 1
+
+    # returns every metric as a dict of plain values, e.g. to send
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            sums = list(self._sums)
+        to_return = {'requests': {command: self._request_figures(
+            command, counts, sums) for command in COMMANDS},
+            'active': counts[_ACTIVE], 'workers': self._workers}
+        for name, source in self._sources.items():
+            to_return[name] = source()
+        offset = _COUNTERS_AT
+        to_return['caches'] = {}
+        for name in self._names['caches']:
+            cache = dict(zip(CACHE_COUNTERS,
+                counts[offset:offset + len(CACHE_COUNTERS)]))
+            lookups = cache['hits'] + cache['misses']
+            cache['hit_rate'] = (cache['hits'] / lookups if lookups
+                else 0.0)
+            to_return['caches'][name] = cache
+            offset += len(CACHE_COUNTERS)
+        to_return['flights'] = {}
+        for name in self._names['flights']:
+            flight = dict(zip(FLIGHT_COUNTERS,
+                counts[offset:offset + len(FLIGHT_COUNTERS)]))
+            calls = sum(flight.values())
+            flight['coalescing_ratio'] = ((calls - flight['executions'])
+                / calls if calls else 0.0)
+            to_return['flights'][name] = flight
+            offset += len(FLIGHT_COUNTERS)
+        return to_return
+
+    # the counters and latency histograms of command, from a copy of
+    # the shared counts and sums
+    def _request_figures(self, command, counts, sums):
+        entry = {counter: counts[self._request_index(command, counter)]
+            for counter in _REQUEST_COUNTERS}
+        entry['latency'] = {}
+        for phase in PHASES:
+            histogram = self._histogram(command, phase)
+            buckets = [counts[self._bucket_index(histogram, bucket)]
+                for bucket in range(_BUCKET_COUNT)]
+            entry['latency'][phase] = _summarize(buckets,
+                sums[histogram])
+        return entry
+
+# holds the server's metrics; processes forked after enable() share
+# them
+class _Holder:
+
+    def __init__(self):
+        self._metrics = None
+
+    def enable(self, workers=None):
+        self._metrics = Metrics(workers)
+        return self._metrics
+
+    def get(self):
+        return self._metrics
+
+_holder = _Holder()
+
+def enable_metrics(workers=None):
+    return _holder.enable(workers)
+
+# the server's Metrics, or None if it keeps none
+def get_metrics():
+    return _holder.get()
+
+# with in_progress(): ... counts a request as active, if metrics are
+# kept
+@contextmanager
+def in_progress():
+    metrics = _holder.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.in_progress():
+        yield
+
+# records a request for query in the server's metrics, if it keeps any
+def observe(query, total, timings, ok):
+    metrics = _holder.get()
+    if metrics is not None:
+        metrics.observe(command_name(query), total, timings, ok)
+
+# returns a histogram's count, sum and cumulative buckets, with the
+# quantiles estimated from them
+def _summarize(buckets, total):
+    count = sum(buckets)
+    cumulative = []
+    running = 0
+    for bound, bucket in zip(BUCKETS + (None,), buckets):
+        running += bucket
+        cumulative.append([bound, running])
+    to_return = {'count': count, 'sum': total, 'buckets': cumulative}
+    for quantile in QUANTILES:
+        to_return['p{:g}'.format(quantile * 100)] = _quantile(
+            cumulative, count, quantile)
+    return to_return
+
+# estimates a quantile by interpolating inside the bucket it falls in;
+# None without observations
+def _quantile(cumulative, count, quantile):
+    if count == 0:
+        return None
+    rank = quantile * count
+    lower_bound = 0.0
+    lower_count = 0
+    for bound, running in cumulative:
+        if running >= rank:
+            if bound is None:
+                # past the last bound there is nothing to go by
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (
+                (rank - lower_count) / (running - lower_count))
+        lower_bound = bound
+        lower_count = running
+    return lower_bound
+
+# ----------------------------------------------------------------------
+# EXPOSITION
+
+def _metric(lines, name, kind, help_text):
+    lines.append('# HELP reg_{} {}'.format(name, help_text))
+    lines.append('# TYPE reg_{} {}'.format(name, kind))
+
+def _sample(lines, name, labels, value):
+    if value is None:
+        return
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(key, labels[key])
+            for key in labels) + '}'
+    lines.append('reg_{} {}'.format(name, value))
+
+# adds the lines of the per-command counters and latency histograms
+def _request_lines(lines, requests):
+    for counter, help_text in (('requests', 'Requests answered'),
+            ('errors', 'Requests answered with an error'),
+            ('bytes_sent', 'Bytes of responses sent')):
+        _metric(lines, counter + '_total', 'counter', help_text)
+        for command in COMMANDS:
+            _sample(lines, counter + '_total', {'command': command},
+                requests[command][counter])
+
+    _metric(lines, 'request_seconds', 'histogram',
+        'Time spent on requests, by phase')
+    for command in COMMANDS:
+        for phase in PHASES:
+            latency = requests[command]['latency'][phase]
+            labels = {'command': command, 'phase': phase}
+            for bound, running in latency['buckets']:
+                _sample(lines, 'request_seconds_bucket', dict(labels,
+                    le='+Inf' if bound is None else repr(bound)),
+                    running)
+            _sample(lines, 'request_seconds_sum', labels,
+                latency['sum'])
+            _sample(lines, 'request_seconds_count', labels,
+                latency['count'])
+
+# adds the lines of the cache and flight counters
+def _shared_lines(lines, snapshot):
+    _metric(lines, 'cache_lookups_total', 'counter',
+        'Cache lookups, by result')
+    for name, cache in snapshot['caches'].items():
+        for counter in CACHE_COUNTERS:
+            _sample(lines, 'cache_lookups_total', {'cache': name,
+                'result': counter}, cache[counter])
+    _metric(lines, 'flight_calls_total', 'counter',
+        'Single-flight calls, by how they were answered')
+    for name, flight in snapshot['flights'].items():
+        for counter in FLIGHT_COUNTERS:
+            _sample(lines, 'flight_calls_total', {'flight': name,
+                'outcome': counter}, flight[counter])
+
+# returns snapshot, as returned by Metrics.snapshot(), in the
+# Prometheus text format
+def exposition(snapshot):
+    lines = []
+    _request_lines(lines, snapshot['requests'])
+    _metric(lines, 'active_requests', 'gauge', 'Requests in progress')
+    _sample(lines, 'active_requests', {}, snapshot['active'])
+    _metric(lines, 'workers', 'gauge',
+        'Workers the server was started with')
+    _sample(lines, 'workers', {}, snapshot['workers'])
+    _shared_lines(lines, snapshot)
+
+    # anything else is a group of numbers, e.g. admission counters
+    for group in sorted(set(snapshot) - {'requests', 'active',
+            'workers', 'caches', 'flights'}):
+        for name, value in sorted(snapshot[group].items()):
+            if isinstance(value, (int, float)) and not isinstance(
+                    value, bool):
+                _sample(lines, '{}_{}'.format(group, name), {}, value)
+    return '\n'.join(lines) + '\n'
+
+# writes exposition(snapshot_func()) to path every interval seconds,
+# from a daemon thread; replaces the file whole, so readers never see
+# half of it. Returns an Event that stops it when set.
+def write_periodically(snapshot_func, path,
+                       interval=DEFAULT_WRITE_INTERVAL):
+    stop = Event()
+
+    def write():
+        while not stop.wait(interval):
+            text = exposition(snapshot_func())
+            try:
+                with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                    file.write(text)
+                replace(path + '.tmp', path)
+            except OSError as ex:
+                print(ex, file=stderr)
+
+    Thread(target=write, daemon=True).start()
+    return stop
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regmirror.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr
+from threading import Lock
+from regindex import TrigramIndex, like_pattern, SEARCH_COLUMNS
+
+# ----------------------------------------------------------------------
+
+SEARCH_KEYS = [key for _, key in SEARCH_COLUMNS]
+
+# same as reghelpers.catalog_order, without the server's imports
+def catalog_order(row):
+    return (row[1], row[2], row[0])
+
+# a client's copy of the whole catalog. It is downloaded once with the
+# server's snapshot command, then kept up to date with delta, and
+# searched locally with the same trigram index and LIKE semantics the
+# server uses, so results match get_results_from_query exactly.
+class CatalogMirror:
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = Lock()
+        self._version = None
+        # classid -> its overview rows
+        self._classes = {}
+        self._index = None
+        self._syncing = False
+
+    def is_ready(self):
+        return self._index is not None
+
+    def get_version(self):
+        return self._version
+
+    # asks the server what changed since our version (everything, the
+    # first time). callback(changed), if given, is called on the
+    # connection's thread when the answer has been applied.
+    def sync(self, callback=None):
+        with self._lock:
+            if self._syncing:
+                return
+            self._syncing = True
+            version = self._version
+        if version is None:
+            query = {'command': 'snapshot'}
+        else:
+            query = {'command': 'delta', 'since': version}
+        self._connection.request(query,
+            lambda result: self._synced(result, callback))
+
+    def _synced(self, result, callback):
+        changed = False
+        try:
+            if result[0]:
+                changed = self._apply(result[1])
+            else:
+                print('Could not sync the catalog: ' + str(result[1]),
+                    file=stderr)
+        finally:
+            with self._lock:
+                self._syncing = False
+        if callback is not None:
+            callback(changed)
+
+    # returns whether the catalog changed
+    def _apply(self, message):
+        if 'rows' in message:
+            classes = {}
+            for row in message['rows']:
+                classes.setdefault(row[0], []).append(row)
+        elif message['since'] != self._version:
+            return False
+        elif not message['changed'] and not message['removed']:
+            self._version = message['version']
+            return False
+        else:
+            classes = dict(self._classes)
+            for classid in message['removed']:
+                classes.pop(classid, None)
+            changed = {}
+            for row in message['changed']:
+                changed.setdefault(row[0], []).append(row)
+            classes.update(changed)
+
+        rows = sorted((row for class_rows in classes.values()
+            for row in class_rows), key=catalog_order)
+        index = TrigramIndex(rows)
+        with self._lock:
+            self._version = message['version']
+            self._classes = classes
+            self._index = index
+        return True
+
+    # returns the overview rows matching query, as the server would, or
+    # None until the first snapshot has arrived
+    def search(self, query):
+        index = self._index
+        if index is None:
+            return None
+        return index.search({key: like_pattern(query[key])
+            for key in SEARCH_KEYS if query[key]})
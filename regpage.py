@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regpage.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+import json
+from bisect import bisect_right
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+
+# ----------------------------------------------------------------------
+# Overview results come in page order, (dept, coursenum, classid), which
+# no two rows share. A page is the rows after a cursor, at most a page
+# size of them. The cursor names the last row of the previous page, so
+# the next page is found by key, without counting or re-reading the
+# rows before it.
+# ----------------------------------------------------------------------
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+INVALID_PAGE_MSG = 'Invalid page request'
+
+# overview rows are (classid, dept, coursenum, area, title)
+def page_key(row):
+    return (row[1], row[2], row[0])
+
+# returns an opaque string for the page after row
+def encode_cursor(row):
+    data = json.dumps(page_key(row)).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+# returns the key a cursor stands for, or None for no cursor (the
+# first page); raises ValueError if it is not one of ours
+def decode_cursor(cursor):
+    if cursor is None or cursor == '':
+        return None
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        key = json.loads(urlsafe_b64decode(cursor + padding))
+    except (TypeError, Base64Error, UnicodeDecodeError) as ex:
+        raise ValueError('bad cursor') from ex
+    if not (isinstance(key, list) and len(key) == 3
+            and isinstance(key[0], str) and isinstance(key[1], str)
+            and isinstance(key[2], int)):
+        raise ValueError('bad cursor')
+    return tuple(key)
+
+# returns limit as a page size; raises ValueError if it is not one
+def page_size(limit):
+    if limit is None or limit == '':
+        return DEFAULT_PAGE_SIZE
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('bad page size')
+    return min(limit, MAX_PAGE_SIZE)
+
+# rows holds the page's rows, and one more if another page follows:
+# returns {'rows', 'cursor': for the next page or None, 'total': the
+# number of rows in all pages or None if not asked for}
+def make_page(rows, limit, total=None):
+    if len(rows) <= limit:
+        return {'rows': rows, 'cursor': None, 'total': total}
+    rows = rows[:limit]
+    return {'rows': rows, 'cursor': encode_cursor(rows[-1]),
+        'total': total}
+
+# returns the page of rows, in page order, that follows key after
+def page_from_rows(rows, after, limit, with_total=False):
+    start = 0 if after is None else bisect_right(rows, after,
+        key=page_key)
+    return make_page(rows[start:start + limit + 1], limit,
+        len(rows) if with_total else None)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regprotocol.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from struct import Struct
+from io import BytesIO
+from pickle import dumps, Unpickler
+import wirecodec
+
+# ----------------------------------------------------------------------
+# A client that wants the framed protocol opens with MAGIC followed by
+# the highest version it speaks; the server answers the same way with
+# the version it picked. A one-shot client starts straight away with a
+# pickle instead (always b'\x80'), which is how the server tells them
+# apart. An old server fails to unpickle the greeting and hangs up,
+# which tells a new client to fall back to one-shot requests.
+#
+# After the greeting every message is a frame: a 4-byte big-endian
+# length and a payload. Requests are {'id': n, 'query': query} and
+# responses {'id': n, 'result': (ok, data)}; responses may come back
+# in any order. From CODEC_VERSION on, payloads are encoded with
+# wirecodec rather than pickled. Servers only load the pickles of older
+# clients as plain data, see load_plain(). From ROWS_VERSION on,
+# overviews come back as a list of (classid, dept, coursenum, area,
+# title) rows instead of preformatted text. From CANCEL_VERSION on, a
+# client may send {'id': n, 'cancel': True} for a request whose answer
+# it no longer wants; the server then skips it if it has not started
+# it yet, and sends no response for it. From CATALOG_VERSION on, every
+# response also carries 'catalog', a token that changes whenever the
+# catalog does, so clients know when their cached results are stale.
+# From STREAM_VERSION on, a query may ask for 'stream': its rows then
+# come in frames of {'id': n, 'chunk': rows} as the server reads them,
+# and the response ends the stream; the rows in its result, if any,
+# follow those of the chunks. A request may also carry 'deadline', the
+# number of seconds the client will wait for its answer; servers skip
+# or stop work past it (older ones ignore it).
+# ----------------------------------------------------------------------
+
+MAGIC = b'REG'
+HELLO_SIZE = len(MAGIC) + 1
+
+# the one-shot protocol, where each connection carries one pickle
+LEGACY_VERSION = 1
+# length-prefixed frames carrying request ids
+FRAMED_VERSION = 2
+# the same frames with wirecodec payloads
+CODEC_VERSION = 3
+# overviews as typed rows
+ROWS_VERSION = 4
+# cancel messages
+CANCEL_VERSION = 5
+# catalog version tokens on responses
+CATALOG_VERSION = 6
+# results streamed in chunks
+STREAM_VERSION = 7
+PROTOCOL_VERSION = STREAM_VERSION
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+_LENGTH = Struct('!I')
+
+class ProtocolError(Exception):
+    pass
+
+def is_hello(data):
+    return data[:1] == MAGIC[:1]
+
+def encode_hello(version):
+    return MAGIC + bytes([version])
+
+# returns the version in a greeting, or raises ProtocolError
+def decode_hello(data):
+    if len(data) != HELLO_SIZE or data[:len(MAGIC)] != MAGIC:
+        raise ProtocolError('bad protocol greeting')
+    return data[len(MAGIC)]
+
+# the version the server should answer a greeting for version with
+def choose_version(version):
+    return min(version, PROTOCOL_VERSION)
+
+# unpickles nothing but plain data: None, bools, numbers, strings,
+# bytes, lists, tuples, sets and dicts, which is all a client ever
+# sends. A pickle that names a class or a function (the way a pickle
+# runs code) raises ProtocolError instead.
+class _PlainUnpickler(Unpickler):
+
+    def find_class(self, module, name):
+        raise ProtocolError('refused to unpickle {}.{}'.format(module,
+            name))
+
+# reads one pickle of plain data from a binary file object
+def load_plain(in_flo):
+    return _PlainUnpickler(in_flo).load()
+
+def loads_plain(data):
+    return load_plain(BytesIO(data))
+
+def encode_frame(message, version=PROTOCOL_VERSION):
+    if version >= CODEC_VERSION:
+        payload = wirecodec.dumps(message)
+    else:
+        payload = dumps(message)
+    return _LENGTH.pack(len(payload)) + payload
+
+# encodes the response to request_id; catalog is the token for the
+# catalog the result came from, for clients that understand it
+def encode_response(request_id, result, version=PROTOCOL_VERSION,
+                    catalog=None):
+    message = {'id': request_id, 'result': result}
+    if version >= CATALOG_VERSION and catalog is not None:
+        message['catalog'] = catalog
+    return encode_frame(message, version)
+
+# encodes one chunk of the rows streamed in answer to request_id
+def encode_chunk(request_id, rows, version=PROTOCOL_VERSION):
+    return encode_frame({'id': request_id, 'chunk': rows}, version)
+
+def decode_payload(payload, version=PROTOCOL_VERSION):
+    if version >= CODEC_VERSION:
+        try:
+            return wirecodec.loads(payload)
+        except wirecodec.CodecError as ex:
+            raise ProtocolError(str(ex)) from ex
+    return loads_plain(payload)
+
+def decode_length(header):
+    (length,) = _LENGTH.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError('frame too large')
+    return length
+
+def _read_exactly(in_flo, size):
+    data = in_flo.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+# reads one message from a binary file object; returns None at EOF
+def read_frame(in_flo, version=PROTOCOL_VERSION):
+    header = _read_exactly(in_flo, _LENGTH.size)
+    if header is None:
+        return None
+    payload = _read_exactly(in_flo, decode_length(header))
+    if payload is None:
+        return None
+    return decode_payload(payload, version)
+
+# reads frames straight from a socket. Besides waiting for the next
+# message, it can collect the messages that have already arrived
+# without waiting, so a server that answers requests one at a time can
+# see cancels for requests it has not started yet.
+class FrameReader:
+
+    # buffered is what an earlier reader of sock had read and not
+    # parsed yet
+    def __init__(self, sock, version=PROTOCOL_VERSION, buffered=b''):
+        self._sock = sock
+        self._version = version
+        self._buffer = bytearray(buffered)
+        self._at_eof = False
+
+    # what has been read and not parsed yet: part of the next message
+    def get_buffered(self):
+        return bytes(self._buffer)
+
+    def _next_message(self):
+        if len(self._buffer) < _LENGTH.size:
+            return None
+        size = _LENGTH.size + decode_length(self._buffer[:_LENGTH.size])
+        if len(self._buffer) < size:
+            return None
+        payload = bytes(self._buffer[_LENGTH.size:size])
+        del self._buffer[:size]
+        return decode_payload(payload, self._version)
+
+    def is_at_eof(self):
+        return self._at_eof
+
+    # the socket's own timeout is put back afterwards, so that answers
+    # written to it are not cut short by a poll's timeout of 0
+    def _receive(self, timeout):
+        previous = self._sock.gettimeout()
+        self._sock.settimeout(timeout)
+        try:
+            chunk = self._sock.recv(65536)
+        finally:
+            self._sock.settimeout(previous)
+        if not chunk:
+            self._at_eof = True
+        self._buffer += chunk
+
+    # waits up to timeout seconds (None: forever) for the next message;
+    # returns None at EOF and raises OSError (e.g. on timeout)
+    def read(self, timeout=None):
+        message = self._next_message()
+        while message is None:
+            if self._at_eof:
+                return None
+            self._receive(timeout)
+            message = self._next_message()
+        return message
+
+    # returns the messages that have arrived, without waiting
+    def read_ready(self):
+        messages = []
+        while True:
+            message = self._next_message()
+            if message is not None:
+                messages.append(message)
+                continue
+            if self._at_eof:
+                return messages
+            try:
+                self._receive(0.0)
+            except OSError:
+                # nothing more has arrived (or the connection broke,
+                # which the next read will report)
+                return messages
+
+def is_cancel(message):
+    return message.get('cancel', False) is True
+
+def is_chunk(message):
+    return 'chunk' in message
+
+# the asyncio equivalent of read_frame
+async def read_frame_async(reader, version=PROTOCOL_VERSION):
+    try:
+        header = await reader.readexactly(_LENGTH.size)
+        payload = await reader.readexactly(decode_length(header))
+    except EOFError:
+        return None
+    return decode_payload(payload, version)
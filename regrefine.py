@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regrefine.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from threading import Lock
+from time import monotonic
+from collections import OrderedDict
+from regindex import like_pattern, like_matcher, sql_lower
+from regindex import SEARCH_COLUMNS
+
+# ----------------------------------------------------------------------
+
+MAX_SESSIONS = 1024
+SESSION_TTL = 300.0
+
+# true if every row matching query also matches previous: each field of
+# query contains the same field of previous, ignoring case. Searches
+# are substring matches, so "cos3" can only match rows "cos" matched.
+def narrows(previous, query):
+    return all(query[key].lower().find(previous[key].lower()) != -1
+        for _, key in SEARCH_COLUMNS)
+
+# true if query searches for just what previous did, e.g. when it asks
+# for a later page of the same result
+def same_search(previous, query):
+    return all(query[key].lower() == previous[key].lower()
+        for _, key in SEARCH_COLUMNS)
+
+# returns the rows matching query, in their order, with the same LIKE
+# semantics as the database
+def filter_rows(rows, query):
+    checks = [(column, like_matcher(like_pattern(query[key])))
+        for column, key in SEARCH_COLUMNS if query[key]]
+    return [row for row in rows
+        if all(matches(sql_lower(row[column]))
+            for column, matches in checks)]
+
+# remembers each search session's latest query and result. A query that
+# narrows the previous one in its session is answered by filtering that
+# result instead of searching the whole catalog; anything else falls
+# back to a full search. Results are only reused while version_func()
+# returns what it did when they were stored.
+class RefinementSessions:
+
+    def __init__(self, version_func, max_sessions=MAX_SESSIONS,
+                 ttl=SESSION_TTL):
+        self._version_func = version_func
+        self._max_sessions = max_sessions
+        self._ttl = ttl
+        self._lock = Lock()
+        # session id -> (expiry time, version, query, rows)
+        self._sessions = OrderedDict()
+        self._counters = {'refined': 0, 'full': 0}
+
+    def _version(self):
+        try:
+            return self._version_func()
+        except OSError:
+            return None
+
+    # returns the result for query in session session_id, calling
+    # full_search(query) when it cannot be refined
+    def search(self, session_id, query, full_search):
+        version = self._version()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+        if (entry is not None and monotonic() < entry[0]
+                and version is not None and entry[1] == version
+                and narrows(entry[2], query)):
+            rows = (entry[3] if same_search(entry[2], query)
+                else filter_rows(entry[3], query))
+            counter = 'refined'
+        else:
+            rows = full_search(query)
+            counter = 'full'
+
+        with self._lock:
+            self._counters[counter] += 1
+            # errors are not worth refining
+            if not isinstance(rows, tuple) and version is not None:
+                self._sessions[session_id] = (monotonic() + self._ttl,
+                    version, dict(query), rows)
+                while len(self._sessions) > self._max_sessions:
+                    self._sessions.popitem(last=False)
+        return rows
+
+    def stats(self):
+        with self._lock:
+            to_return = dict(self._counters)
+            to_return['sessions'] = len(self._sessions)
+            return to_return
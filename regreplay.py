@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regreplay.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+import json
+from math import ceil
+from time import monotonic, sleep
+from threading import Thread, Lock
+from queue import Queue
+from urllib.request import Request, urlopen
+from urllib.parse import urlencode
+from urllib.error import HTTPError
+from regconnection import ServerConnection
+from regmetrics import command_name
+from reglog import outcome
+
+# ----------------------------------------------------------------------
+# Sends the requests of a request log (see reglog.py) to a server again,
+# at the pace they first arrived or speedup times faster, from a number
+# of clients at once. The log may come from the reg server in any mode
+# or from the Flask app, and be sent to either: the reg server is spoken
+# to through ServerConnection, which also reaches servers that only
+# take pickles (e.g. A2/regserver.py), and the app through its search
+# results and details routes.
+# ----------------------------------------------------------------------
+
+DEFAULT_CONCURRENCY = 8
+
+# how long to wait for a request the log has no deadline for, in seconds
+DEFAULT_TIMEOUT = 30.0
+
+# the fields of an overview query, and what the search results route
+# calls them
+SEARCH_ARGS = (('d', 'dept'), ('n', 'coursenum'), ('a', 'area'),
+    ('t', 'title'))
+
+# the cookie the app names a search session with, see A4/reg.py
+SESSION_COOKIE = 'regsession'
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# returns the fraction quantile of values, which must be sorted, or
+# None if there are none
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[max(0, ceil(fraction * len(values)) - 1)]
+
+# returns the entries of the request log at path in the order their
+# requests arrived, only those of commands if given and at most limit
+# of them
+def read_log(path, commands=None, limit=None):
+    entries = []
+    skipped = 0
+    with open(path, encoding='utf-8') as log_file:
+        for line in log_file:
+            try:
+                entry = json.loads(line)
+                query = entry['query']
+                entry['command'] = command_name(query)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                skipped += 1
+                continue
+            if commands is None or entry['command'] in commands:
+                entries.append(entry)
+    if skipped:
+        print('Skipped {} lines that are not requests'.format(skipped),
+            file=stderr)
+    entries.sort(key=lambda entry: entry.get('time', 0))
+    return entries if limit is None else entries[:limit]
+
+# returns the path and arguments of the app's route answering query, or
+# None if it has none
+def to_http(query):
+    if query.get('command') is not None:
+        return None
+    if 'class_id' in query:
+        return '/regdetails?' + urlencode(
+            {'classid': query['class_id']})
+    args = {name: query.get(field) or '' for field, name in SEARCH_ARGS}
+    if query.get('limit') is not None:
+        args['limit'] = query['limit']
+        if query.get('cursor'):
+            args['cursor'] = query['cursor']
+        if query.get('total'):
+            args['total'] = '1'
+    return '/searchresults?' + urlencode(args)
+
+# ----------------------------------------------------------------------
+
+# sends requests to the reg server; each client has a connection
+class RegTarget:
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+
+    def connect(self):
+        return ServerConnection(self._host, self._port)
+
+    def can_send(self, _query):
+        return True
+
+    # returns how the request turned out, see reglog.outcome()
+    def send(self, connection, query, timeout):
+        # results come back whole rather than streamed
+        query = {key: value for key, value in query.items()
+            if key != 'stream'}
+        return outcome(connection.call(query, timeout))
+
+    def close(self, connection):
+        connection.close()
+
+# sends requests to the Flask app
+class HttpTarget:
+
+    def __init__(self, host, port):
+        self._base = 'http://{}:{}'.format(host, port)
+
+    def connect(self):
+        return None
+
+    def can_send(self, query):
+        return to_http(query) is not None
+
+    def send(self, _connection, query, timeout):
+        request = Request(self._base + to_http(query))
+        if query.get('session'):
+            request.add_header('Cookie', '{}={}'.format(SESSION_COOKIE,
+                query['session']))
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                response.read()
+                return 'ok'
+        except HTTPError as ex:
+            return 'http_{}'.format(ex.code)
+        except OSError:
+            return 'error'
+
+    def close(self, _connection):
+        pass
+
+# ----------------------------------------------------------------------
+
+# sends entries to target from concurrency clients, each request once
+# its time since the first has passed, divided by speedup (0: send them
+# all at once); returns (the seconds it took, a result dict for each
+# request sent)
+def replay(entries, target, speedup, concurrency, timeout):
+    jobs = Queue()
+    results = []
+    results_lock = Lock()
+
+    def client():
+        connection = target.connect()
+        try:
+            while True:
+                job = jobs.get()
+                if job is None:
+                    return
+                entry, due = job
+                started = monotonic()
+                result = target.send(connection, entry['query'],
+                    entry.get('deadline') or timeout)
+                with results_lock:
+                    results.append({'command': entry['command'],
+                        'outcome': result,
+                        'latency': monotonic() - started,
+                        'lag': max(0.0, started - due),
+                        'recorded': entry.get('total_ms')})
+        finally:
+            target.close(connection)
+
+    clients = [Thread(target=client, daemon=True)
+        for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+
+    began = monotonic()
+    first = entries[0].get('time', 0) if entries else 0
+    for entry in entries:
+        due = began
+        if speedup > 0:
+            due += (entry.get('time', first) - first) / speedup
+            sleep(max(0.0, due - monotonic()))
+        jobs.put((entry, due))
+    for _ in clients:
+        jobs.put(None)
+    for thread in clients:
+        thread.join()
+    return (monotonic() - began, results)
+
+# returns the figures for results: per command, and over all of them
+def summarize(elapsed, results):
+    to_return = {'requests': len(results), 'seconds': elapsed,
+        'throughput': len(results) / elapsed if elapsed else 0.0,
+        'lag_ms': _quantiles([result['lag'] * 1000
+            for result in results]),
+        'commands': {}}
+    for command in sorted({result['command'] for result in results}):
+        mine = [result for result in results
+            if result['command'] == command]
+        outcomes = {}
+        for result in mine:
+            outcomes[result['outcome']] = outcomes.get(
+                result['outcome'], 0) + 1
+        to_return['commands'][command] = {'requests': len(mine),
+            'errors': len(mine) - outcomes.get('ok', 0),
+            'outcomes': outcomes,
+            'latency_ms': _quantiles([result['latency'] * 1000
+                for result in mine]),
+            'recorded_ms': _quantiles([result['recorded']
+                for result in mine if result['recorded'] is not None])}
+    return to_return
+
+def _quantiles(values):
+    values = sorted(values)
+    return {'p{}'.format(round(fraction * 100)): percentile(values,
+        fraction) for fraction in QUANTILES}
+
+def _ms(value):
+    return '-' if value is None else '{:.1f}'.format(value)
+
+def print_summary(summary):
+    print('{} requests in {:.2f} s ({:.1f} requests/s)'.format(
+        summary['requests'], summary['seconds'],
+        summary['throughput']))
+    print('{:<14}{:>8}{:>8}{:>9}{:>9}{:>9}{:>12}{:>12}'.format(
+        'command', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms',
+        'logged p50', 'logged p99'))
+    for command, figures in summary['commands'].items():
+        latency = figures['latency_ms']
+        recorded = figures['recorded_ms']
+        print('{:<14}{:>8}{:>8}{:>9}{:>9}{:>9}{:>12}{:>12}'.format(
+            command, figures['requests'], figures['errors'],
+            _ms(latency['p50']), _ms(latency['p95']),
+            _ms(latency['p99']), _ms(recorded['p50']),
+            _ms(recorded['p99'])))
+    print('sent late by: p50 {} ms, p99 {} ms'.format(
+        _ms(summary['lag_ms']['p50']), _ms(summary['lag_ms']['p99'])))
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Sends the requests of a request log to a server',
+        allow_abbrev=False)
+
+    parser.add_argument('log', help='''a request log written by
+        regserver.py or the Flask app with --request-log''')
+
+    parser.add_argument('host', help='the host the server runs on')
+
+    parser.add_argument('port', type=int,
+        help='the port at which the server listens')
+
+    parser.add_argument('--http', action='store_true',
+        help='''the server is the Flask app (A4/runserver.py) rather
+        than a reg server''')
+
+    parser.add_argument('--speedup', type=float, default=1.0,
+        help='''send requests this many times faster than they first
+        arrived (0: as fast as the clients can)''')
+
+    parser.add_argument('--concurrency', type=int,
+        default=DEFAULT_CONCURRENCY, metavar='clients',
+        help='the number of clients sending requests at once')
+
+    parser.add_argument('--timeout', type=float,
+        default=DEFAULT_TIMEOUT, metavar='seconds',
+        help='''how long to wait for a request the log gives no
+        deadline for''')
+
+    parser.add_argument('--command', action='append',
+        dest='commands', metavar='command',
+        help='''only send requests of this command, e.g. get_detail
+        (may be repeated)''')
+
+    parser.add_argument('--limit', type=int, default=None,
+        metavar='requests',
+        help='only send the first this many requests')
+
+    parser.add_argument('--json', action='store_true',
+        help='print the figures as JSON')
+
+    args = parser.parse_args()
+
+    if args.speedup < 0 or args.concurrency < 1:
+        print('The speed-up must not be negative, and there must be a '
+            'client', file=stderr)
+        exit(1)
+
+    try:
+        entries = read_log(args.log, args.commands, args.limit)
+    except OSError as ex:
+        print(ex, file=stderr)
+        exit(1)
+
+    target = (HttpTarget if args.http else RegTarget)(args.host,
+        args.port)
+    sendable = [entry for entry in entries
+        if target.can_send(entry['query'])]
+    if len(sendable) < len(entries):
+        print('Skipped {} requests the server has no route for'.format(
+            len(entries) - len(sendable)), file=stderr)
+
+    elapsed, results = replay(sendable, target, args.speedup,
+        args.concurrency, args.timeout)
+    summary = summarize(elapsed, results)
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    else:
+        print_summary(summary)
+
+if __name__ == '__main__':
+    main()
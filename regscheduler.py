@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regscheduler.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from uuid import uuid4
+from PyQt5.QtCore import QTimer, QObject, pyqtSignal
+from regclientcache import overview_key
+
+# ----------------------------------------------------------------------
+
+# how long typing has to pause before a search is sent
+DEBOUNCE_MS = 150
+
+# how many rows the server sends at a time; the next page is asked for
+# when the view scrolls past the last one
+PAGE_SIZE = 500
+
+# ----------------------------------------------------------------------
+
+# carries results from the connection's reader thread to the GUI
+# thread, whose event loop runs the connected slot as soon as the
+# result arrives
+class ResultSignal(QObject):  # pylint: disable=too-few-public-methods
+    arrived = pyqtSignal(object)
+    # a later page of the current search
+    page_arrived = pyqtSignal(object)
+    # a catalog mirror has synced and its contents changed
+    catalog_changed = pyqtSignal()
+
+# sends the overview searches. A search goes out only once the input
+# has been quiet for DEBOUNCE_MS, and gets a generation number; results
+# of any generation but the latest are dropped. Sending a search also
+# cancels the previous one if it is still in flight. Searches in the
+# cache are answered without asking the server, and with a catalog
+# mirror every search is answered locally, as the user types. Searches
+# name a session, so the server can narrow the previous result when the
+# user has only typed more. The server sends PAGE_SIZE rows at a time;
+# load_more() asks for the next page. With stream, the whole result is
+# asked for instead, and shown as its rows stream in.
+class SearchScheduler:  # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, connection, results, cache, mirror=None,
+                 stream=False):
+        self._connection = connection
+        self._results = results
+        self._cache = cache
+        self._mirror = mirror
+        self._stream = stream
+        self._query = None
+        self._session_id = uuid4().hex
+        self._generation = 0
+        self._request_id = None
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(DEBOUNCE_MS)
+        self._timer.timeout.connect(self.send_now)
+
+    # sends query once no other query has come for DEBOUNCE_MS
+    def schedule(self, query):
+        self._query = query
+        if self._mirror is not None and self._mirror.is_ready():
+            self.send_now()
+        else:
+            self._timer.start()
+
+    def send_now(self, query=None):
+        self._timer.stop()
+        if query is not None:
+            self._query = query
+        if self._request_id is not None:
+            self._connection.cancel(self._request_id)
+            self._request_id = None
+        self._generation += 1
+        generation = self._generation
+
+        rows = None if self._mirror is None else self._mirror.search(
+            self._query)
+        if rows is not None:
+            self._results.arrived.emit((True, rows, False, generation))
+            return
+
+        key = overview_key(self._query)
+        result = self._cache.get(key)
+        if result is not None:
+            self._results.arrived.emit((result[0], result[1], False,
+                generation))
+            return
+
+        if self._stream:
+            self._send_streamed(key, generation)
+            return
+
+        # results are emitted on results for the GUI thread to display
+        def callback(result):
+            self._cache.put(key, result)
+            self._results.arrived.emit((result[0], result[1], False,
+                generation))
+
+        print('Sent command: get_overviews')
+        self._request_id = self._connection.request(
+            dict(self._query, session=self._session_id,
+                limit=PAGE_SIZE, total=True), callback)
+
+    # asks for the whole result of the current search. Its first chunk
+    # of rows is shown as soon as it arrives, and each later one is
+    # added as a page.
+    def _send_streamed(self, key, generation):
+        rows = []
+
+        def on_chunk(chunk):
+            page = {'rows': chunk, 'cursor': None, 'total': None}
+            if rows:
+                self._results.page_arrived.emit((True, page,
+                    generation))
+            else:
+                self._results.arrived.emit((True, page, False,
+                    generation))
+            rows.extend(chunk)
+
+        def callback(result):
+            # nothing streamed: an error, or the whole result at once
+            if not rows or not result[0]:
+                if result[0] and not rows:
+                    self._cache.put(key, result)
+                self._results.arrived.emit((result[0], result[1], False,
+                    generation))
+                return
+            rows.extend(result[1])
+            self._cache.put(key, (True, rows))
+            self._results.page_arrived.emit((True, {'rows': result[1],
+                'cursor': None, 'total': len(rows)}, generation))
+
+        print('Sent command: get_overviews')
+        self._request_id = self._connection.request(
+            dict(self._query, session=self._session_id), callback,
+            on_chunk)
+
+    # asks for the page of the current search after cursor; it arrives
+    # on results.page_arrived
+    def load_more(self, cursor):
+        generation = self._generation
+
+        def callback(result):
+            self._results.page_arrived.emit((result[0], result[1],
+                generation))
+
+        print('Sent command: get_overviews')
+        self._request_id = self._connection.request(
+            dict(self._query, session=self._session_id,
+                limit=PAGE_SIZE, cursor=cursor), callback)
+
+    # shows the current search again, e.g. after the catalog changed
+    def refresh(self):
+        if self._query is not None:
+            self.send_now()
+
+    def is_current(self, generation):
+        return generation == self._generation
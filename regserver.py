@@ -8,46 +8,98 @@
 from sys import stderr, exit
 import argparse
 from os import name
-from time import process_time
-from multiprocessing import Process
+from functools import partial
+from multiprocessing import cpu_count
 from socket import socket, SOL_SOCKET, SO_REUSEADDR
-from pickle import dump, load
-from reghelpers import get_results_from_query as get_overview
-from regdetails import get_table_results
+from reghelpers import enable_index, enable_materialization
+from reghelpers import warm_connections
+from regcache import configure_all as configure_caches
+from regflight import FlightCoordinator, share_all
+from regflight import configure_all as configure_flights
+from regmetrics import enable_metrics, write_periodically
+from regmetrics import DEFAULT_WRITE_INTERVAL
+from reglog import enable_request_log
+from regadmission import Admission, AsyncAdmission
+from regadmission import DEFAULT_MAX_QUEUED
+from reganswer import handle_query, stream_query
+from reghandler import serve_forking, make_settings
+from regworkers import WorkerPool, serve_multiplexed
+from reghandoff import make_handoff
+from regasync import AsyncServer, make_executor
 
 # ----------------------------------------------------------------------
-def consume_cpu_time(delay):
-
-    i = 0
-    initial_time = process_time()
-    while (process_time() - initial_time) < delay:
-        i += 1  # Do a nonsensical computation.
-
-# sends (True, results) if succceeds, (False, err_message) if fails
-def handle_client(sock, delay):
-    print('Forked child process')
-    consume_cpu_time(delay)
-    in_flo = sock.makefile(mode='rb')
-    query = load(in_flo)
-    # get_detail
-    if "class_id" in query:
-        print("Received command: get_detail")
-        to_return = get_table_results(query["class_id"])
-    # get_overviews
-    else:
-        print("Received command: get_overviews")
-        to_return = get_overview(query)
 
-    # if request was successful, turn it into a tuple
-    # (if it failed, it is already a tuple)
-    if not isinstance(to_return, tuple):
-        to_return = (True, to_return)
+# configures the caches and single flights, and builds the pre-joined
+# catalog and the search index once, before any child is forked
+def prepare(args):
+    configure_caches(args.cache_size, args.cache_ttl)
+    configure_flights(not args.no_coalesce)
+    # worker processes wait for each other's identical queries through
+    # a coordinator in this process
+    if not args.no_coalesce and (args.mode != 'asyncio'
+            or args.executor == 'process'):
+        coordinator = FlightCoordinator()
+        coordinator.start()
+        share_all(*coordinator.get_channel())
+    if not enable_materialization():
+        print('Materialized catalog unavailable, using joins',
+            file=stderr)
+    if not enable_index(args.index_file):
+        print('Search index unavailable, using the database',
+            file=stderr)
+
+def open_server_socket(port):
+    server_sock = socket()
+    print('Opened server socket')
+    if name != 'nt':
+        server_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server_sock.bind(('', port))
+    print('Bound server socket to port')
+    server_sock.listen()
+    print('Listening')
+    return server_sock
+
+# turns on the metrics and the request log; returns the admission
+# control that the mode's requests go through
+def enable_admission(args):
+    # counted in shared memory, so every worker reports them all
+    metrics = enable_metrics(args.max_children
+        if args.mode == 'fork' else args.workers)
+    if args.metrics_file is not None:
+        write_periodically(metrics.snapshot, args.metrics_file,
+            args.metrics_interval)
+    if args.request_log is not None or args.slow_ms is not None:
+        enable_request_log(args.request_log, args.mode, args.slow_ms)
+    max_active = (args.workers if args.max_active is None
+        else args.max_active)
+    if args.mode == 'asyncio':
+        admission = AsyncAdmission(max_active, args.max_queue)
+    else:
+        admission = Admission(max_active, args.max_queue)
+    metrics.add_source('admission', admission.stats)
+    return admission
 
-    out_flo = sock.makefile(mode='wb')
-    dump(to_return, out_flo)
-    out_flo.flush()
-    print('Closed socket in child process')
+# serves clients on server_sock in the mode args asks for
+def serve(args, server_sock, admission):
+    settings = make_settings(args.delay,
+        args.max_steps if args.max_steps > 0 else None, admission)
+    if args.mode == 'fork':
+        serve_forking(server_sock, settings, args.max_children)
+    elif args.mode == 'asyncio':
+        # a stream's batches are read one at a time by executor
+        # threads; a process cannot hand back a generator, so process
+        # workers answer streamed queries whole
+        AsyncServer(server_sock, handle_query,
+            make_executor(args.executor, args.workers,
+                warm_connections), settings,
+            stream_query if args.executor == 'thread' else None).run()
+    else:
+        WorkerPool(server_sock, partial(serve_multiplexed,
+            settings=settings, handoff=make_handoff()),
+            args.workers, args.max_requests,
+            warm_connections).run()
 
+# ----------------------------------------------------------------------
 
 def main():
 
@@ -62,32 +114,85 @@ def main():
         help='''the number of seconds that the server should delay
         before responding to each client request''')
 
+    parser.add_argument('--index-file', metavar='file',
+        help='''a search index built by regbuildindex.py to load instead
+        of indexing the database at startup''')
+
+    parser.add_argument('--cache-size', type=int, default=None,
+        metavar='entries',
+        help='the most results each query cache keeps (0 disables)')
+
+    parser.add_argument('--cache-ttl', type=float, default=None,
+        metavar='seconds',
+        help='how long a cached result stays valid')
+
+    parser.add_argument('--mode', choices=['prefork', 'fork',
+        'asyncio'], default='prefork',
+        help='''prefork: a fixed pool of long-lived workers (the
+        default); fork: a new process per connection; asyncio: one
+        event loop handing queries to an executor''')
+
+    parser.add_argument('--workers', type=int, default=cpu_count(),
+        help='''the number of prefork workers, or of asyncio executor
+        workers (default: cpu count)''')
+
+    parser.add_argument('--executor', choices=['thread', 'process'],
+        default='thread',
+        help='where asyncio mode runs database work')
+
+    parser.add_argument('--max-requests', type=int, default=1000,
+        help='''recycle a prefork worker after this many requests
+        (0: never)''')
+
+    parser.add_argument('--max-steps', type=int, default=0,
+        metavar='steps',
+        help='''stop any request whose SQLite statements run more than
+        this many virtual machine steps (0: no limit)''')
+
+    parser.add_argument('--max-active', type=int, default=None,
+        metavar='requests',
+        help='''the most requests that do their work at once (default:
+        the number of workers)''')
+
+    parser.add_argument('--max-queue', type=int,
+        default=DEFAULT_MAX_QUEUED, metavar='requests',
+        help='''the most requests that wait for a turn, details ahead
+        of overviews; past that, clients are told the server is busy
+        and when to retry''')
+
+    parser.add_argument('--max-children', type=int, default=128,
+        metavar='processes',
+        help='''the most connections fork mode serves at once, each in
+        a process of its own; more wait to be accepted (0: no
+        limit)''')
+
+    parser.add_argument('--metrics-file', metavar='file',
+        help='''write the server's metrics to this file in the
+        Prometheus text format, every --metrics-interval seconds''')
+
+    parser.add_argument('--metrics-interval', type=float,
+        default=DEFAULT_WRITE_INTERVAL, metavar='seconds',
+        help='how often to write the metrics file')
+
+    parser.add_argument('--request-log', metavar='file',
+        help='''append a JSON line to this file for every request
+        answered, for regreplay.py to send again''')
+
+    parser.add_argument('--slow-ms', type=float, default=None,
+        metavar='milliseconds',
+        help='''report requests that take at least this long on
+        stderr, and mark them slow in the request log''')
+
+    parser.add_argument('--no-coalesce', action='store_true',
+        help='''run every query itself, even one identical to a query
+        already running''')
+
     args = parser.parse_args()
 
     try:
-        port = args.port
-        delay = args.delay
-        #IMPLEMENT BUSY WAIT
-        server_sock = socket()
-        print('Opened server socket')
-        if name != 'nt':
-            server_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        server_sock.bind(('', port))
-        print('Bound server socket to port')
-        server_sock.listen()
-        print('Listening')
-        while True:
-            try:
-                sock, _ = server_sock.accept()
-                with sock:
-                    print('Accepted connection, opened socket')
-                    process = Process(target=handle_client,
-                        args=[sock, delay])
-                    process.start()
-                    # handle_client(sock, delay)
-                    # print('Closed socket')
-            except Exception as ex:
-                print(ex, file=stderr)
+        prepare(args)
+        server_sock = open_server_socket(args.port)
+        serve(args, server_sock, enable_admission(args))
     except Exception as ex:
         print(ex, file=stderr)
         exit(1)
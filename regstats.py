@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regstats.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import exit, stderr
+import argparse
+import json
+from regconnection import ServerConnection
+from regmetrics import exposition
+
+# ----------------------------------------------------------------------
+
+# how long to wait for the server, in seconds
+TIMEOUT = 10.0
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Prints the metrics of a running reg server',
+        allow_abbrev=False)
+
+    parser.add_argument('host', help='the host the server runs on')
+
+    parser.add_argument('port', type=int,
+        help='the port at which the server listens')
+
+    parser.add_argument('--json', action='store_true',
+        help='print the metrics as JSON instead of the text format')
+
+    args = parser.parse_args()
+
+    connection = ServerConnection(args.host, args.port)
+    try:
+        ok, stats = connection.call({'command': 'stats'}, TIMEOUT)
+    finally:
+        connection.close()
+    # servers from before the stats command answer with an overview
+    if not ok or not isinstance(stats, dict):
+        print(stats if not ok else 'The server does not report metrics',
+            file=stderr)
+        exit(1)
+
+    if args.json:
+        print(json.dumps(stats, indent=2, sort_keys=True))
+    else:
+        print(exposition(stats), end='')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+# ----------------------------------------------------------------------
+# regworkers.py
+# Author: Everett Shen, Trivan Menezes
+# ----------------------------------------------------------------------
+
+from sys import stderr, exit
+from os import getpid
+from time import monotonic
+from signal import signal, SIGTERM
+from multiprocessing import Process
+from multiprocessing.connection import wait
+from selectors import DefaultSelector, EVENT_READ
+from socket import IPPROTO_TCP, TCP_NODELAY, MSG_PEEK
+from pickle import UnpicklingError
+from regprotocol import is_hello, encode_hello, decode_hello
+from regprotocol import choose_version, load_plain
+from regprotocol import FrameReader, ProtocolError
+from regprotocol import HELLO_SIZE, LEGACY_VERSION
+from regadmission import query_priority
+from reghandler import answer_framed, answer_pickled
+from reghandler import queue_message, unqueue_message
+from reghandler import received, drop_cancelled, KEEPALIVE_TIMEOUT
+
+# ----------------------------------------------------------------------
+# A prefork worker serves all of its connections from one selector
+# loop, one request at a time: it reads the requests that have arrived
+# on any of them, then answers the most urgent one. A keep-alive
+# connection with nothing to ask costs the worker nothing, so it does
+# not keep other clients waiting to be served. Requests are queued for
+# admission (see regadmission.py) as soon as they are read, so the
+# queue bound and the busy answers apply to them, and the worker takes
+# them in priority order: details ahead of overviews, each in the order
+# they arrived. A worker that is about to answer one first hands the
+# other requests it has read, with their connections, to the workers
+# that are free (see reghandoff.py), so that no request waits for a
+# busy worker while another sits idle.
+# ----------------------------------------------------------------------
+
+# how long a new connection may take to send the rest of its greeting,
+# or of its one-shot query, once it has begun to
+GREETING_TIMEOUT = 1.0
+
+# true if message needs no turn to be answered: it was refused a place
+# in the queue, or never needed one
+def _is_quick(message):
+    return (query_priority(message['query']) is None
+        or message.get('refused') is not None)
+
+# the order in which a worker answers the requests it has read: the
+# quick ones first
+def _urgency(message):
+    if _is_quick(message):
+        return (-1, message['arrived'])
+    return (query_priority(message['query']), message['arrived'])
+
+# returns the most urgent request waiting on connections, and its
+# connection
+def _most_urgent(connections):
+    return min(((connection, message) for connection in connections
+        for message in connection.waiting),
+        key=lambda entry: _urgency(entry[1]))
+
+# a connection a worker serves, with the requests read from it and not
+# answered yet. Until its first bytes say otherwise, it is not known
+# whether it is a framed client or a one-shot one. With state, it is
+# one that another worker handed over. Its requests are answered as
+# settings (see reghandler.make_settings()) say.
+class _Connection:
+
+    def __init__(self, sock, settings, state=None):
+        self.sock = sock
+        self._settings = settings
+        self._out_flo = sock.makefile(mode='wb')
+        self._version = None
+        self._reader = None
+        self.waiting = []
+        self.idle_since = monotonic()
+        if state is not None:
+            self._version = state['version']
+            if state['buffered'] is not None:
+                self._reader = FrameReader(sock, self._version,
+                    state['buffered'])
+            self.waiting = state['waiting']
+            self.idle_since = state['idle_since']
+
+    # what another worker needs to take the connection over
+    def get_state(self):
+        return {'version': self._version,
+            'buffered': None if self._reader is None else
+                self._reader.get_buffered(),
+            'waiting': self.waiting, 'idle_since': self.idle_since}
+
+    # adds messages to the requests waiting. A client that has moved on
+    # may already have cancelled some of them, which then leave the
+    # queue.
+    def _take(self, messages):
+        waiting = drop_cancelled(self.waiting + received(messages))
+        kept = {id(message) for message in waiting}
+        for message in self.waiting:
+            if id(message) not in kept:
+                unqueue_message(self._settings['admission'], message)
+        for message in waiting:
+            if 'queued' not in message and 'refused' not in message:
+                queue_message(self._settings['admission'], message)
+        self.waiting = waiting
+
+    # reads the greeting or the one-shot query
+    def _start(self):
+        # a streamed result is several frames in a row; without this
+        # the last of them waits for the client to acknowledge the rest
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if not self.sock.recv(1, MSG_PEEK):
+            return False
+        self.sock.settimeout(GREETING_TIMEOUT)
+        try:
+            with self.sock.makefile(mode='rb') as in_flo:
+                if is_hello(in_flo.peek(1)):
+                    self._version = choose_version(decode_hello(
+                        in_flo.read(HELLO_SIZE)))
+                    self._out_flo.write(encode_hello(self._version))
+                    self._out_flo.flush()
+                    # the client waits for our greeting before it sends
+                    # anything else, so nothing is left in in_flo
+                    self._reader = FrameReader(self.sock, self._version)
+                else:
+                    query = load_plain(in_flo)
+                    self._version = LEGACY_VERSION
+                    self._take([{'id': None, 'query': query}])
+        except (ProtocolError, UnpicklingError, EOFError) as ex:
+            print(ex, file=stderr)
+            return False
+        finally:
+            self.sock.settimeout(None)
+        return True
+
+    # reads what has arrived on the connection; returns false once it
+    # should be closed
+    def receive(self):
+        self.idle_since = monotonic()
+        if self._version is None:
+            return self._start()
+        if self._reader is None:
+            # a one-shot client has nothing more to say until it
+            # leaves
+            return bool(self.sock.recv(1, MSG_PEEK))
+        self._take(self._reader.read_ready())
+        return not self._reader.is_at_eof()
+
+    # answers message, one of the requests waiting; returns false once
+    # the connection should be closed
+    def answer(self, message):
+        self.waiting.remove(message)
+        self.idle_since = monotonic()
+        try:
+            if self._reader is None:
+                answer_pickled(message, self.sock, self._out_flo,
+                    self._settings)
+                return False
+            self._take(answer_framed(message, self._reader,
+                self._out_flo, self._version, self._settings))
+            return not self._reader.is_at_eof()
+        finally:
+            # if it failed before its turn came
+            unqueue_message(self._settings['admission'], message)
+
+    # hangs up; the requests still waiting leave the queue unanswered
+    def close(self):
+        for message in self.waiting:
+            unqueue_message(self._settings['admission'], message)
+        self.release()
+
+    # lets go of the connection once another worker has it: the client
+    # stays connected, and its requests stay queued
+    def release(self):
+        self.waiting = []
+        self._out_flo.close()
+        self.sock.close()
+
+# the connections of one worker, and the selector it waits on them with
+class _Multiplexer:
+
+    def __init__(self, server_sock, settings, handoff):
+        self._server_sock = server_sock
+        self._settings = settings
+        self._handoff = handoff
+        self._selector = DefaultSelector()
+        self.connections = set()
+        # when each new connection, which may still be about to send its
+        # first request, was accepted
+        self._new = {}
+
+    def _add(self, connection, accepted=None):
+        self._selector.register(connection.sock, EVENT_READ, connection)
+        self.connections.add(connection)
+        if accepted is not None:
+            self._new[connection] = accepted
+
+    def _remove(self, connection):
+        self._selector.unregister(connection.sock)
+        self.connections.discard(connection)
+        self._new.pop(connection, None)
+
+    def close(self, connection):
+        self._remove(connection)
+        connection.close()
+
+    def close_all(self):
+        for connection in list(self.connections):
+            self.close(connection)
+        self._selector.close()
+
+    # forgets the new connections that have been quiet for too long
+    def _age(self):
+        now = monotonic()
+        for connection, accepted in list(self._new.items()):
+            if now - accepted >= GREETING_TIMEOUT:
+                del self._new[connection]
+
+    # true while this worker has nothing to do, nor is about to: only
+    # then does it listen for new connections, one at a time, so that a
+    # burst of them is spread across the idle workers instead of going
+    # to whichever wakes first; and for connections handed over
+    def _is_free(self):
+        return not self._new and not self.ready()
+
+    def _listen(self):
+        free = self._is_free()
+        for fileobj in (self._server_sock, self._handoff):
+            listening = fileobj in self._selector.get_map()
+            if fileobj is None or free == listening:
+                continue
+            if free:
+                self._selector.register(fileobj, EVENT_READ)
+            else:
+                self._selector.unregister(fileobj)
+
+    # returns true if it accepted a connection
+    def _accept(self):
+        try:
+            sock, _ = self._server_sock.accept()
+        except BlockingIOError:
+            return False
+        except OSError as ex:
+            print(ex, file=stderr)
+            return False
+        self._add(_Connection(sock, self._settings), monotonic())
+        return True
+
+    # takes over the connections handed over; returns true if there
+    # were any
+    def _take_handed(self):
+        taken = False
+        while self._handoff is not None:
+            handed = self._handoff.receive()
+            if handed is None:
+                break
+            sock, state = handed
+            self._add(_Connection(sock, self._settings, state),
+                state['accepted'])
+            taken = True
+        return taken
+
+    # hands connection to another worker; returns false if it could not
+    def _hand_over(self, connection):
+        state = dict(connection.get_state(),
+            accepted=self._new.get(connection))
+        if (self._handoff is None
+                or not self._handoff.send(connection.sock, state)):
+            return False
+        self._remove(connection)
+        connection.release()
+        return True
+
+    # how long to wait for something to arrive: not at all if there is
+    # a request to answer, and only until a new client should have
+    # asked something if there is one
+    def _timeout(self):
+        if self.ready():
+            return 0
+        if self._new:
+            return GREETING_TIMEOUT
+        return KEEPALIVE_TIMEOUT
+
+    # accepts a new connection, if free, and reads what has arrived on
+    # the others, waiting up to timeout seconds (None: as long as there
+    # is nothing to do) for something to
+    def read(self, timeout=None):
+        self._age()
+        self._listen()
+        if timeout is None:
+            timeout = self._timeout()
+        for key, _ in self._selector.select(timeout):
+            if key.fileobj is self._server_sock:
+                self._accept()
+                continue
+            if key.fileobj is self._handoff:
+                self._take_handed()
+                continue
+            try:
+                if not key.data.receive():
+                    self.close(key.data)
+                elif key.data.waiting:
+                    self._new.pop(key.data, None)
+            except Exception as ex:
+                print(ex, file=stderr)
+                self.close(key.data)
+        # hang up on clients that have been quiet for too long
+        now = monotonic()
+        for connection in list(self.connections):
+            idle = now - connection.idle_since
+            if not connection.waiting and idle > KEEPALIVE_TIMEOUT:
+                self.close(connection)
+
+    # takes in every connection waiting to be accepted or handed over,
+    # and reads what has arrived on them, so that their requests are
+    # queued (or refused) before this worker is busy again
+    def gather(self):
+        while self._accept():
+            pass
+        if self._take_handed() or self._new:
+            self.read(0)
+
+    # hands the connections other than keep that have requests waiting,
+    # or may be about to, to the workers that are free; with idle, the
+    # others too
+    def pass_on(self, keep=None, idle=False):
+        for connection in list(self.connections):
+            if connection is not keep and (idle or connection.waiting
+                    or connection in self._new):
+                self._hand_over(connection)
+
+    # the connections with requests waiting
+    def ready(self):
+        return [connection for connection in self.connections
+            if connection.waiting]
+
+    def answer(self, connection, message):
+        try:
+            if not connection.answer(message):
+                self.close(connection)
+        except Exception as ex:
+            print(ex, file=stderr)
+            self.close(connection)
+
+# serves connections accepted on server_sock, which other workers share,
+# or handed over by them on handoff, answering requests as settings
+# (see reghandler.make_settings()) say, until it has answered
+# max_requests requests (0 means never); then hands its connections
+# to the other workers (or, where it cannot, answers the requests it
+# has read already and hangs up, so that its clients connect again to
+# another worker) and returns how many requests it answered
+def serve_multiplexed(server_sock, max_requests, settings,
+                      handoff=None):
+    # another worker may take the connection we were woken for
+    server_sock.setblocking(False)
+    multiplexer = _Multiplexer(server_sock, settings, handoff)
+    answered = 0
+    try:
+        while True:
+            recycling = max_requests and answered >= max_requests
+            if recycling:
+                multiplexer.pass_on(idle=True)
+            else:
+                multiplexer.read()
+            ready = multiplexer.ready()
+            if not ready:
+                if recycling:
+                    break
+                continue
+            connection, message = _most_urgent(ready)
+            if not _is_quick(message) and not recycling:
+                multiplexer.gather()
+                connection, message = _most_urgent(multiplexer.ready())
+                multiplexer.pass_on(connection)
+            multiplexer.answer(connection, message)
+            answered += 1
+    finally:
+        multiplexer.close_all()
+    return answered
+
+# ----------------------------------------------------------------------
+
+# a long-lived worker: serves connections on the shared listening
+# socket with serve(server_sock, max_requests), which returns how many
+# requests it answered once it has answered max_requests of them (0
+# means never)
+def worker_main(server_sock, serve, max_requests, warm_up):
+    warm_up()
+    print('Worker {} ready'.format(getpid()))
+    handled = serve(server_sock, max_requests)
+    print('Worker {} recycled after {} requests'.format(
+        getpid(), handled))
+
+# keeps worker_count workers serving server_sock, replacing any that
+# exit (after max_requests, or because they crashed)
+class WorkerPool:
+
+    def __init__(self, server_sock, serve, worker_count,
+                 max_requests=0, warm_up=None):
+        self._server_sock = server_sock
+        self._serve = serve
+        self._worker_count = worker_count
+        self._max_requests = max_requests
+        self._warm_up = warm_up if warm_up is not None else (
+            lambda: None)
+        # maps each worker's sentinel to its Process
+        self._workers = {}
+
+    def _start_worker(self):
+        process = Process(target=worker_main,
+            args=[self._server_sock, self._serve,
+                self._max_requests, self._warm_up])
+        process.start()
+        self._workers[process.sentinel] = process
+
+    def get_worker_count(self):
+        return len(self._workers)
+
+    # supervises the workers forever; returns only if interrupted
+    def run(self):
+        # turn a plain kill into SystemExit so the workers are stopped
+        # along with the supervisor
+        signal(SIGTERM, lambda signum, frame: exit(0))
+        try:
+            for _ in range(self._worker_count):
+                self._start_worker()
+            print('Started {} workers'.format(self._worker_count))
+            while True:
+                for sentinel in wait(list(self._workers)):
+                    process = self._workers.pop(sentinel)
+                    # joining reaps the child, so no zombies are left
+                    process.join()
+                    if process.exitcode != 0:
+                        print('Worker {} died with exit code {}'.format(
+                            process.pid, process.exitcode), file=stderr)
+                    self._start_worker()
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self._workers.values():
+            process.terminate()
+        for process in self._workers.values():
+            process.join()
+        self._workers = {}